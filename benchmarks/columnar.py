@@ -0,0 +1,85 @@
+""" Benchmarks answering the query corpus from a columnar snapshot against SQLite
+
+    python -m benchmarks.columnar --rows 100k
+
+Every query is run against the database and against a ColumnarSnapshot of
+every model, and their results are checked to be the same. Queries the
+snapshot does not support are reported as such.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from shoedog.columnar import ColumnarSnapshot
+from shoedog.errors import SnapshotUnsupportedException
+from shoedog.eval import bind_variables
+from shoedog.query_factory import QueryFactory
+from benchmarks.run import add_dataset_arguments, build_dataset
+from benchmarks.schema import query_corpus
+
+
+def _sorted(res):
+    if isinstance(res, list):
+        return sorted((_sorted(r) for r in res), key=lambda r: r['id'])
+    elif isinstance(res, dict):
+        return {k: _sorted(v) for k, v in res.items()}
+    return res
+
+
+def _median_time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_dataset_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query')
+    parser.add_argument('--output', help='write results JSON to this file')
+    args = parser.parse_args(argv)
+
+    with build_dataset(args) as (app, db, models, _):
+        start = time.perf_counter()
+        snapshot = ColumnarSnapshot(db.engine, models)
+        print(f'Loaded snapshot in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+        qf = QueryFactory(db)
+
+        results = {}
+        for name, (query_string, variables) in query_corpus(models, args.self_references).items():
+            plan = qf._plan(query_string)
+            params = bind_variables(plan.variables, variables or {})
+
+            def run_sql():
+                db.session.remove()
+                return qf.parse_query(query_string, variables)
+
+            sql_time, sql_res = _median_time(run_sql, args.repeat)
+            try:
+                snapshot_time, snapshot_res = _median_time(
+                    lambda: snapshot.evaluate(plan.ast, params), args.repeat)
+            except SnapshotUnsupportedException as e:
+                print(f'{name:<16} unsupported: {e}', file=sys.stderr)
+                results[name] = {'sql': sql_time, 'snapshot': None}
+                continue
+            if _sorted(sql_res) != _sorted(snapshot_res):
+                print(f'{name:<16} results differ from SQL', file=sys.stderr)
+                return 1
+            results[name] = {'rows': len(sql_res), 'sql': sql_time, 'snapshot': snapshot_time}
+            print(f'{name:<16} {len(sql_res):>8} rows  sql {sql_time * 1000:>9.2f}ms  '
+                  f'snapshot {snapshot_time * 1000:>9.2f}ms  {sql_time / snapshot_time:>6.1f}x',
+                  file=sys.stderr)
+        db.session.remove()
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+""" Benchmarks filtering roots on high fan-out children, with the children joined
+and loaded against the same filter as a filter-only relationship
+
+    python -m benchmarks.filter_only --rows 1k --fan-out 200
+
+The joined query returns every matching root along with all of its children, and the
+filter-only query returns the same roots with an EXISTS and no children. Both
+filter on the first integer column of the children, with --selectivity the
+fraction of values it accepts.
+"""
+import argparse
+import json
+import sys
+from shoedog.query_factory import QueryFactory
+from benchmarks.run import END_TO_END, add_dataset_arguments, bench_query, build_dataset
+from benchmarks.schema import column_name
+
+
+def _queries(root, selectivity):
+    # Integer columns are drawn uniformly from 0 to 1000
+    bound = int(1000 * selectivity)
+    block = f'children {{\n {column_name(0)} [any < {bound}]\n }}'
+    return {
+        'joined': f'query {root} {{\n {block}\n}}',
+        'filter_only': f'query {root} {{\n filter {block}\n}}',
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_dataset_arguments(parser)
+    parser.set_defaults(depth=2, fan_out=200)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query')
+    parser.add_argument('--selectivity', type=float, default=0.01,
+                        help='fraction of children values the filter accepts')
+    parser.add_argument('--output', help='write results JSON to this file')
+    args = parser.parse_args(argv)
+
+    with build_dataset(args) as (app, db, models, counts):
+        results = {}
+        matched = {}
+        for name, query_string in _queries(models[0].__name__, args.selectivity).items():
+            stages, matched[name] = bench_query(QueryFactory(db), db, query_string, None, args.repeat)
+            results[name] = {'rows': matched[name], 'stages': stages}
+            print(f'{name:<12} {matched[name]:>8} rows  {stages[END_TO_END]["median"] * 1000:>10.2f}ms median  '
+                  f'execute {stages["execute"]["median"] * 1000:>8.2f}ms  '
+                  f'hydrate {stages["hydrate"]["median"] * 1000:>8.2f}ms  '
+                  f'serialize {stages["serialize"]["median"] * 1000:>8.2f}ms', file=sys.stderr)
+        assert matched['joined'] == matched['filter_only']
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
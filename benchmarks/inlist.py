@@ -0,0 +1,70 @@
+""" Benchmarks `in` filters over growing lists of ids against SQLite
+
+    python -m benchmarks.inlist --rows 100k --sizes 10,1000,50000
+
+Every size is run as a literal list bound as one parameter per value (as it is
+below shoedog.inlist.LARGE_IN_THRESHOLD), as a literal list bound as a single
+parameter, and as an $ids variable. Lists too long for SQLite to bind one
+parameter per value are reported as failing.
+"""
+import argparse
+import json
+import sys
+from sqlalchemy.exc import OperationalError
+import shoedog.inlist
+from shoedog.query_factory import QueryFactory
+from benchmarks.run import END_TO_END, add_dataset_arguments, bench_query, build_dataset
+
+
+def _queries(root, ids):
+    literal = f'query {root} {{\n id [* in [{", ".join(str(i) for i in ids)}]]\n}}'
+    return {
+        'per_value': (literal, None, len(ids) + 1),
+        'literal': (literal, None, 0),
+        'variable': (f'query {root} {{\n id [* in $ids]\n}}', {'ids': ids}, 0),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_dataset_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query')
+    parser.add_argument('--sizes', default='10,100,1000,10000,50000',
+                        help='comma separated list lengths to run')
+    parser.add_argument('--output', help='write results JSON to this file')
+    args = parser.parse_args(argv)
+
+    with build_dataset(args) as (app, db, models, counts):
+        rows = counts[models[0].__tablename__]
+        root = models[0].__name__
+        threshold = shoedog.inlist.LARGE_IN_THRESHOLD
+        results = {}
+        for size in (int(s) for s in args.sizes.split(',')):
+            # Every other id, so half the list matches when it fits in the table
+            ids = list(range(1, 2 * size, 2))
+            for mode, (query_string, variables, mode_threshold) in _queries(root, ids).items():
+                name = f'{mode}_{size}'
+                shoedog.inlist.LARGE_IN_THRESHOLD = mode_threshold
+                try:
+                    stages, matched = bench_query(QueryFactory(db), db, query_string, variables, args.repeat)
+                except OperationalError as e:
+                    db.session.remove()
+                    results[name] = {'error': str(e.orig)}
+                    print(f'{name:<18} failed: {e.orig}', file=sys.stderr)
+                    continue
+                finally:
+                    shoedog.inlist.LARGE_IN_THRESHOLD = threshold
+                results[name] = {'rows': matched, 'stages': stages}
+                print(f'{name:<18} {matched:>8} rows  {stages[END_TO_END]["median"] * 1000:>10.2f}ms median  '
+                      f'compile {stages["compile"]["median"] * 1000:>8.2f}ms  '
+                      f'execute {stages["execute"]["median"] * 1000:>8.2f}ms', file=sys.stderr)
+                assert matched == len([i for i in ids if i <= rows])
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
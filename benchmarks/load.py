@@ -0,0 +1,159 @@
+""" Replays a corpus of query documents against a shoedoggified Flask app under load
+
+Requests are POSTed to /shoedog through the Flask test client from a pool of
+worker threads, so a single QueryFactory, connection pool and result cache are
+shared between them just like in a threaded server, without any external
+service. Throughput and p50/p95/p99 latency are reported for the whole run and
+per query, along with the query factory's stage timings and cache and
+coalescing statistics:
+
+    python -m benchmarks.load --rows 100k --workers 16 --requests 2000 --result-cache
+
+By default the synthetic benchmark schema and its corpus are used. --corpus
+replays a JSON file instead: a list of query documents, or of
+{"query": <query document>, "variables": {...}} objects, which are sent in
+order, round robin. --app module:callable replays against an existing app
+instead of the synthetic one; callable must return (app, query_factory).
+"""
+import argparse
+import importlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import cycle, islice
+from shoedog.api import shoedoggify
+from shoedog.cache import ResultCache, InProcessCacheBackend
+from benchmarks.run import add_dataset_arguments, build_dataset
+from benchmarks.schema import query_corpus
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {f'p{p}': samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+            for p in (50, 95, 99)}
+
+
+def load_corpus(path):
+    """ Returns a list of (name, query document, variables) from a corpus file """
+    with open(path) as f:
+        items = json.load(f)
+    corpus = []
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'query': item}
+        corpus.append((item.get('name', f'query_{i}'), item['query'], item.get('variables')))
+    return corpus
+
+
+def run_load(app, corpus, workers, requests):
+    """ Sends requests POSTs round robin over corpus from workers threads
+
+    Returns:
+        dict of requests, errors, seconds, throughput (requests per second) and
+        latency percentiles, overall and per query name
+    """
+    local = threading.local()
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def send(item):
+        name, query_string, variables = item
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        res = client.post('/shoedog', data=json.dumps({'query': query_string, 'variables': variables}),
+                          content_type='application/json')
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.setdefault(name, []).append(latency)
+            if res.status_code != 200:
+                errors[name] = errors.get(name, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Consume the results so exceptions raised by the client are not swallowed
+        list(pool.map(send, islice(cycle(corpus), requests)))
+    seconds = time.perf_counter() - start
+
+    all_latencies = [l for ls in latencies.values() for l in ls]
+    return {
+        'requests': len(all_latencies),
+        'errors': sum(errors.values()),
+        'seconds': seconds,
+        'throughput': len(all_latencies) / seconds,
+        'latency': percentiles(all_latencies),
+        'queries': {name: {'requests': len(ls), 'errors': errors.get(name, 0),
+                           'latency': percentiles(ls)}
+                    for name, ls in latencies.items()},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_dataset_arguments(parser)
+    parser.add_argument('--app', help='module:callable returning (app, query_factory) to load test')
+    parser.add_argument('--corpus', help='JSON file of query documents to replay')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--requests', type=int, default=1000, help='total requests to send')
+    parser.add_argument('--pool-size', type=int,
+                        help='pool at most this many database connections (default: no pooling)')
+    parser.add_argument('--result-cache', action='store_true', help='serve repeated queries from a cache')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='make identical concurrent queries share an execution')
+    parser.add_argument('--output', help='write results JSON to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with ExitStack() as stack:
+        if args.app:
+            module, name = args.app.split(':')
+            app, qf = getattr(importlib.import_module(module), name)()
+            corpus = []
+        else:
+            app, db, models, _ = stack.enter_context(build_dataset(args, pool_size=args.pool_size))
+            result_cache = ResultCache(InProcessCacheBackend()) if args.result_cache else None
+            qf = shoedoggify(app, db, result_cache=result_cache, coalesce=args.coalesce)
+            corpus = [(name, query_string, variables) for name, (query_string, variables)
+                      in query_corpus(models, self_references=args.self_references).items()]
+        if args.corpus:
+            corpus = load_corpus(args.corpus)
+        if not corpus:
+            print('No queries to replay, pass --corpus', file=sys.stderr)
+            return 1
+
+        results = run_load(app, corpus, args.workers, args.requests)
+        results['stages'] = qf.metrics.snapshot()['stages']
+        if qf.result_cache is not None:
+            results['result_cache'] = {'hits': qf.result_cache.hits, 'misses': qf.result_cache.misses}
+        if qf.single_flight is not None:
+            results['single_flight'] = qf.single_flight.metrics
+
+        latency = results['latency']
+        print(f'{results["requests"]} requests, {results["errors"]} errors in {results["seconds"]:.2f}s: '
+              f'{results["throughput"]:.1f} requests/s, p50 {latency["p50"] * 1000:.2f}ms, '
+              f'p95 {latency["p95"] * 1000:.2f}ms, p99 {latency["p99"] * 1000:.2f}ms', file=sys.stderr)
+        for name, query in results['queries'].items():
+            latency = query['latency']
+            print(f'  {name:<16} p50 {latency["p50"] * 1000:>9.2f}ms  p95 {latency["p95"] * 1000:>9.2f}ms  '
+                  f'p99 {latency["p99"] * 1000:>9.2f}ms  {query["errors"]} errors', file=sys.stderr)
+        for key in ('result_cache', 'single_flight'):
+            if key in results:
+                print(f'{key}: {results[key]}', file=sys.stderr)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+""" Measures the memory each stage of the query pipeline allocates, with tracemalloc
+
+For every stage, peak is the most memory allocated at once during the stage and
+retained is what is still allocated when it ends, both relative to the start of
+the stage. So the retained memory of tokenize is the token list, of parse the
+AST, of hydrate the ORM objects in the session's identity map, of serialize the
+response dicts and of encode the JSON string.
+"""
+import json
+import tracemalloc
+from contextlib import contextmanager
+from shoedog.metrics import StageTimer
+
+
+class MemoryStageTimer(StageTimer):
+    """ A StageTimer that also records {stage: {'peak': bytes, 'retained': bytes}}
+    in memory, and in peak the most memory allocated at once across all stages
+    since the timer was created. tracemalloc must be tracing, and stages must not
+    be nested """
+    def __init__(self, metrics=None):
+        super().__init__(metrics)
+        self.memory = {}
+        self.start, _ = tracemalloc.get_traced_memory()
+        self.peak = 0
+
+    @contextmanager
+    def __call__(self, stage):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        with super().__call__(stage):
+            yield
+        current, peak = tracemalloc.get_traced_memory()
+        self.memory[stage] = {'peak': peak - start, 'retained': current - start}
+        self.peak = max(self.peak, peak - self.start)
+
+
+def profile_query(qf, db, query_string, variables):
+    """ Runs a query once under tracemalloc, after a warm up run so one-off
+    allocations (mapper configuration, compiled caches) are not counted
+
+    Returns:
+        (dict of stages, peak, retained and bytes_per_root, number of root rows)
+    """
+    qf._execute_json(qf._plan(query_string), variables)
+    db.session.remove()
+
+    tracemalloc.start()
+    try:
+        timer = MemoryStageTimer(qf.metrics)
+        plan = qf._plan(query_string, timer)
+        res = qf._execute_json(plan, variables, timer=timer)
+        # Measured while the plan, session and response are all still alive
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    rows = len(json.loads(res))
+    del plan, res
+    db.session.remove()
+    return {
+        'stages': timer.memory,
+        'peak': timer.peak,
+        'retained': current - timer.start,
+        'bytes_per_root': timer.peak / rows if rows else None,
+    }, rows
+
+
+def growth_corpus(models):
+    """ Returns {name: (query document, variables)} for the same query shape
+    returning roughly 1%, 10% and 100% of the root rows """
+    root = models[0].__name__
+    child = ' children {\n id\n }\n' if len(models) > 1 else ''
+    query_string = f'query {root} {{\n int_0 [* < $max]\n{child}}}'
+    return {f'growth_{pct}pct': (query_string, {'max': pct * 10}) for pct in (1, 10, 100)}
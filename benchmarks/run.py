@@ -0,0 +1,216 @@
+""" Runs the shoedog benchmark suite
+
+Builds a synthetic schema, seeds it with data, then times every stage of every
+query in the corpus (tokenize, parse, plan, compile, execute, hydrate,
+serialize and encode) as well as each query end to end. Results are written as
+JSON, and can be compared against a previous run to catch regressions:
+
+    python -m benchmarks.run --rows 100k --output baseline.json
+    python -m benchmarks.run --rows 100k --baseline baseline.json
+
+With --memory, each query is also profiled with tracemalloc (see
+benchmarks.memory), over growing result sizes, and the peak memory of each stage
+and per root entity is compared against the baseline too.
+
+Exits with status 1 if any timing or memory use regressed by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import sqlalchemy
+from contextlib import contextmanager
+from shoedog.metrics import StageTimer
+from shoedog.query_factory import QueryFactory
+from benchmarks.memory import growth_corpus, profile_query
+from benchmarks.schema import build_schema, create_benchmark_app, populate, query_corpus
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+END_TO_END = 'end_to_end'
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min': samples[0],
+    }
+
+
+def bench_query(qf, db, query_string, variables, repeat):
+    """ Runs a query repeat times, returning {stage: summary} including end_to_end
+
+    Plans are built fresh on every run so tokenizing and parsing are measured
+    too, and every run gets a new session so hydration never hits the identity map
+    """
+    samples = {}
+    rows = 0
+    for _ in range(repeat):
+        db.session.remove()
+        timer = StageTimer(qf.metrics)
+        start = time.perf_counter()
+        plan = qf._plan(query_string, timer)
+        res = qf._execute_json(plan, variables, timer=timer)
+        samples.setdefault(END_TO_END, []).append(time.perf_counter() - start)
+        for stage, duration in timer.timings.items():
+            samples.setdefault(stage, []).append(duration)
+        rows = len(json.loads(res))
+    db.session.remove()
+    return {stage: summarize(s) for stage, s in samples.items()}, rows
+
+
+def _regressions(name, kind, current, base, tolerance, floor):
+    """ Yields (query, measurement, baseline, current) for every measurement in
+    current more than tolerance over base, skipping those under floor in base """
+    for key, value in current.items():
+        before = base.get(key)
+        if value is None or before is None or before < floor:
+            continue
+        if value > before * (1 + tolerance):
+            yield (name, f'{kind} {key}', before, value)
+
+
+def compare(results, baseline, tolerance, min_time, min_bytes=65536):
+    """ Returns a list of (query, measurement, baseline, current) for every median
+    timing or peak memory more than tolerance over the baseline's. Timings under
+    min_time seconds and memory under min_bytes in the baseline are too noisy to
+    compare and are skipped """
+    regressions = []
+    for name, result in results['queries'].items():
+        base = baseline['queries'].get(name, {})
+        regressions.extend(_regressions(
+            name, 'seconds',
+            {stage: s['median'] for stage, s in result['stages'].items()},
+            {stage: s['median'] for stage, s in base.get('stages', {}).items()},
+            tolerance, min_time))
+        if 'memory' in result and 'memory' in base:
+            memory, base_memory = result['memory'], base['memory']
+            regressions.extend(_regressions(
+                name, 'bytes',
+                dict({f'{stage} peak': s['peak'] for stage, s in memory['stages'].items()},
+                     peak=memory['peak'], per_root=memory['bytes_per_root']),
+                dict({f'{stage} peak': s['peak'] for stage, s in base_memory['stages'].items()},
+                     peak=base_memory['peak'], per_root=base_memory['bytes_per_root']),
+                tolerance, min_bytes))
+    return regressions
+
+
+def add_dataset_arguments(parser):
+    """ Adds the arguments describing the synthetic schema and data to parser """
+    parser.add_argument('--rows', default='1k',
+                        help='number of root rows: 1k, 100k, 1m or an integer')
+    parser.add_argument('--width', type=int, default=3, help='scalar columns per model')
+    parser.add_argument('--depth', type=int, default=3, help='number of models in the chain')
+    parser.add_argument('--fan-out', type=int, default=3, help='children per parent row')
+    parser.add_argument('--self-references', action='store_true',
+                        help='give every model a self_ref relationship')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='SQLite file to build the data in (default: a temp file)')
+
+
+@contextmanager
+def build_dataset(args, pool_size=None):
+    """ Builds and seeds the synthetic schema described by args
+
+    Unless --database was given, the data is built in a temporary SQLite file that
+    is deleted when the with block exits.
+
+    Yields:
+        (app, db, models, {table name: rows inserted})
+    """
+    rows = SCALES.get(args.rows.lower()) or int(args.rows)
+    if args.width < 3:
+        raise ValueError('--width must be at least 3 so every column type is present')
+    path = args.database
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix='shoedog-bench-', suffix='.db')
+        os.close(fd)
+    db = None
+    try:
+        app, db = create_benchmark_app(path, pool_size=pool_size)
+        models = build_schema(db, width=args.width, depth=args.depth,
+                              self_references=args.self_references)
+        db.create_all()
+        start = time.perf_counter()
+        counts = populate(db, models, rows, width=args.width, fan_out=args.fan_out,
+                          self_references=args.self_references, seed=args.seed)
+        print(f'Seeded {counts} in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+        yield app, db, models, counts
+    finally:
+        if db is not None:
+            db.session.remove()
+            db.engine.dispose()
+        if args.database is None:
+            os.unlink(path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_dataset_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query')
+    parser.add_argument('--query', action='append',
+                        help='only run the named corpus query (can be given more than once)')
+    parser.add_argument('--output', help='write results JSON to this file')
+    parser.add_argument('--baseline', help='compare against results JSON from a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--min-time', type=float, default=0.001,
+                        help='skip comparing timings faster than this many seconds in the baseline')
+    parser.add_argument('--memory', action='store_true',
+                        help='also profile the memory each stage allocates with tracemalloc')
+    parser.add_argument('--min-bytes', type=int, default=65536,
+                        help='skip comparing memory use under this many bytes in the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with build_dataset(args) as (app, db, models, counts):
+        qf = QueryFactory(db)
+        corpus = query_corpus(models, self_references=args.self_references)
+        if args.memory:
+            corpus.update(growth_corpus(models))
+        if args.query:
+            corpus = {name: corpus[name] for name in args.query}
+
+        results = {
+            'config': {k: v for k, v in vars(args).items()
+                       if k not in ('output', 'baseline', 'database', 'query')},
+            'environment': {'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__},
+            'table_rows': counts,
+            'queries': {},
+        }
+        for name, (query_string, variables) in corpus.items():
+            stages, rows = bench_query(qf, db, query_string, variables, args.repeat)
+            results['queries'][name] = {'rows': rows, 'stages': stages}
+            summary = f'{name:<16} {rows:>8} rows  {stages[END_TO_END]["median"] * 1000:>10.2f}ms median'
+            if args.memory:
+                memory, _ = profile_query(qf, db, query_string, variables)
+                results['queries'][name]['memory'] = memory
+                summary += f'  {memory["peak"] / 1024:>10.1f}KiB peak'
+                if memory['bytes_per_root'] is not None:
+                    summary += f'  {memory["bytes_per_root"]:>8.0f}B/root'
+            print(summary, file=sys.stderr)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, args.tolerance, args.min_time, args.min_bytes)
+            for name, measurement, before, after in regressions:
+                print(f'REGRESSION {name} {measurement}: {before:.6g} -> {after:.6g}', file=sys.stderr)
+            if regressions:
+                return 1
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
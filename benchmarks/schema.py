@@ -0,0 +1,140 @@
+""" Generates synthetic schemas and seeded data to benchmark shoedog against
+
+A schema is a chain of `depth` models, Level0 (the root) to Level<depth - 1>,
+where every level has a one-to-many `children` relationship to the next one.
+Every model has `width` scalar columns cycling through int_<i>, str_<i> and
+date_<i>, and optionally a `self_ref` relationship to another row of itself.
+"""
+import os
+import random
+import tempfile
+from datetime import date, timedelta
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.pool import QueuePool
+
+WORDS = [f'word{i}' for i in range(50)]
+INSERT_CHUNK_SIZE = 10000
+
+
+def column_name(i):
+    return ('int', 'str', 'date')[i % 3] + f'_{i}'
+
+
+def build_schema(db, width=3, depth=3, self_references=False):
+    """ Declares the synthetic models on db and returns them, root first """
+    models = []
+    for level in range(depth):
+        name = f'Level{level}'
+        attrs = {
+            '__tablename__': f'level{level}',
+            'id': db.Column(db.Integer, primary_key=True),
+        }
+        for i in range(width):
+            column_type = (db.Integer, db.String, db.Date)[i % 3]
+            attrs[column_name(i)] = db.Column(column_type, index=i == 0)
+        if level > 0:
+            attrs['parent_id'] = db.Column(db.Integer, db.ForeignKey(f'level{level - 1}.id'), index=True)
+        if level < depth - 1:
+            attrs['children'] = db.relationship(f'Level{level + 1}', uselist=True)
+        if self_references:
+            attrs['self_ref_id'] = db.Column(db.Integer, db.ForeignKey(f'level{level}.id'), index=True)
+            attrs['self_ref'] = db.relationship(name, uselist=False)
+        models.append(type(name, (db.Model,), attrs))
+    return models
+
+
+def _random_row(rng, width):
+    row = {}
+    for i in range(width):
+        kind = i % 3
+        if kind == 0:
+            row[column_name(i)] = rng.randint(0, 1000)
+        elif kind == 1:
+            row[column_name(i)] = rng.choice(WORDS)
+        else:
+            row[column_name(i)] = date(2000, 1, 1) + timedelta(days=rng.randint(0, 7000))
+    return row
+
+
+def populate(db, models, root_rows, width=3, fan_out=3, self_references=False, seed=0):
+    """ Inserts root_rows rows into the root model and fan_out children per parent
+    at every level below it. Returns {table name: rows inserted} """
+    rng = random.Random(seed)
+    counts = {}
+    parent_count = 0
+    for level, model in enumerate(models):
+        table = model.__table__
+        count = root_rows if level == 0 else parent_count * fan_out
+        next_id = 1
+        while next_id <= count:
+            chunk = []
+            for row_id in range(next_id, min(count, next_id + INSERT_CHUNK_SIZE - 1) + 1):
+                row = _random_row(rng, width)
+                row['id'] = row_id
+                if level > 0:
+                    row['parent_id'] = (row_id - 1) // fan_out + 1
+                if self_references:
+                    row['self_ref_id'] = rng.randint(1, count) if rng.random() < 0.5 else None
+                chunk.append(row)
+            db.session.execute(table.insert(), chunk)
+            next_id += len(chunk)
+        counts[table.name] = count
+        parent_count = count
+    db.session.commit()
+    return counts
+
+
+class _PooledSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        # Flask-SQLAlchemy never pools SQLite file connections, but pooling them
+        # lets benchmarks measure how pool sizing affects concurrent queries
+        if info.drivername == 'sqlite' and options.get('pool_size'):
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+
+def create_benchmark_app(path=None, pool_size=None):
+    """ Returns (app, db) backed by a fresh SQLite file, with an app context pushed
+
+    With pool_size, connections are pooled (at most pool_size of them, and no
+    overflow) rather than opened for every session
+    """
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix='shoedog-bench-', suffix='.db')
+        os.close(fd)
+    elif os.path.exists(path):
+        os.unlink(path)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if pool_size:
+        app.config['SQLALCHEMY_POOL_SIZE'] = pool_size
+        app.config['SQLALCHEMY_MAX_OVERFLOW'] = 0
+    db = _PooledSQLAlchemy(app)
+    app.app_context().push()
+    return app, db
+
+
+def query_corpus(models, self_references=False):
+    """ Returns {name: (query document, variables)} of representative query shapes """
+    root = models[0].__name__
+    corpus = {
+        'root_scan': (f'query {root} {{\n id\n int_0\n}}', None),
+        'root_filter': (f'query {root} {{\n int_0 [* < 100]\n}}', None),
+        'root_variable': (f'query {root} {{\n int_0 [* < $max]\n}}', {'max': 100}),
+        'root_in_list': (f'query {root} {{\n str_1 [* in [\'word1\', \'word2\', \'word3\']]\n}}', None),
+    }
+    if len(models) > 1:
+        corpus['nested'] = (f'query {root} {{\n int_0 [* < 100]\n children {{\n id\n }}\n}}', None)
+        corpus['any_filter'] = (
+            f'query {root} {{\n int_0 [* < 100]\n children {{\n str_1 [any != \'word1\']\n }}\n}}', None)
+        corpus['all_filter'] = (
+            f'query {root} {{\n int_0 [* < 100]\n children {{\n int_0 [all > 100]\n }}\n}}', None)
+        chain = ''.join(' children {\n' for _ in models[1:]) + ''.join(' }\n' for _ in models[1:])
+        corpus['deep'] = (f'query {root} {{\n int_0 [* < 100]\n{chain}}}', None)
+    if self_references:
+        corpus['self_reference'] = (
+            f'query {root} {{\n int_0 [* < 100]\n self_ref {{\n int_0 [* < 500]\n }}\n}}', None)
+    return corpus
@@ -14,6 +14,7 @@ setuptools.setup(
    long_description_content_type="text/markdown",
      url="https://github.com/jaychia/shoedog",
      packages=setuptools.find_packages(),
+     extras_require={'columnar': ['numpy']},
      classifiers=[
          "Programming Language :: Python :: 3.6",
          "License :: OSI Approved :: MIT License",
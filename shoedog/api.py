@@ -1,13 +1,130 @@
 import json
+from functools import wraps
 from flask import request, Response
+from shoedog.errors import ModelNotFoundException, PersistedQueryNotFoundException, InvalidVariableException, \
+    QueryTooExpensiveException, AdmissionTimeoutException, QueryTimeoutException
+from shoedog.metrics import StageTimer
 from shoedog.query_factory import QueryFactory
 
+# The HTTP status that each error a query can fail with is returned with
+ERROR_STATUSES = {
+    SyntaxError: 400,
+    ModelNotFoundException: 400,
+    PersistedQueryNotFoundException: 400,
+    InvalidVariableException: 400,
+    QueryTooExpensiveException: 429,
+    AdmissionTimeoutException: 503,
+    QueryTimeoutException: 504,
+}
 
-def shoedoggify(app, db):
-    qf = QueryFactory(db)
+
+def _error_response(message, status):
+    return Response(json.dumps({'error': message}), mimetype='application/json'), status
+
+
+def _json_errors(endpoint):
+    """ Makes endpoint return the errors in ERROR_STATUSES that it raises as
+    {"error": <message>} responses with their status, rather than as 500s """
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        try:
+            return endpoint(*args, **kwargs)
+        except tuple(ERROR_STATUSES) as e:
+            status = next(status for error, status in ERROR_STATUSES.items() if isinstance(e, error))
+            return _error_response(str(e), status)
+    return wrapper
+
+
+def shoedoggify(app, db, persisted_queries=None, result_cache=None, coalesce=False,
+                metrics_route=False, slow_query_log=None, admission=None, timeout=None,
+                snapshot=None, shards=None, shard_router=None, replicas=None):
+    """Sets up the /shoedog endpoint on the app
+
+    The endpoint accepts either a raw query document, or a JSON body of the form
+    {"query": <query document>, "variables": {...}}. persisted_queries is an
+    optional path to a JSON file of query documents to register (and pre-plan)
+    up front. Registered queries are executed by POSTing a JSON body of the form
+    {"id": <query id>, "variables": {...}}. With ?explain=1, the query is not run
+    and the response is its SQL, bound parameters and database plan instead.
+
+    /shoedog/batch accepts a JSON list of any of the above and returns the
+    results in order (see QueryFactory.parse_batch). Pass ?max_workers=N to run
+    the queries concurrently across pooled connections, up to the query factory's
+    max_batch_workers.
+
+    result_cache is an optional shoedog.cache.ResultCache to serve repeated
+    queries from, and coalesce makes identical concurrent queries share a single
+    execution.
+
+    With metrics_route, GET /shoedog/metrics returns the query factory's stage
+    timings and row and byte counts in the Prometheus text format.
+    slow_query_log is an optional shoedog.slowlog.SlowQueryLog to report
+    executions to, and admission an optional shoedog.cost.AdmissionController
+    to reject and queue expensive queries with. timeout is the number of seconds
+    a query may run for before it is cancelled.
+
+    snapshot is an optional shoedog.columnar.ColumnarSnapshot to answer the
+    queries it supports from, without touching the database. shards and
+    shard_router run every query across several databases, and replicas (a
+    shoedog.replicas.ReplicaPool) routes them to read replicas; see QueryFactory.
+    """
+    qf = QueryFactory(db, result_cache=result_cache, coalesce=coalesce,
+                      slow_query_log=slow_query_log, admission=admission, timeout=timeout,
+                      snapshot=snapshot, shards=shards, shard_router=shard_router,
+                      replicas=replicas)
+    if persisted_queries is not None:
+        qf.register_queries_from_file(persisted_queries)
 
     @app.route('/shoedog', methods=['POST'])
+    @_json_errors
     def shoedog():
-        data = request.data.decode('utf-8')
-        res = qf.parse_query(data)
+        if request.args.get('explain', type=int):
+            return _explain()
+
+        timer = StageTimer(qf.metrics)
+        with timer('request'):
+            payload = request.get_json(silent=True)
+            if isinstance(payload, dict) and 'id' in payload:
+                res = qf.parse_persisted_query_json(payload['id'], payload.get('variables'))
+            elif isinstance(payload, dict):
+                if not isinstance(payload.get('query'), str):
+                    return _missing_query()
+                res = qf.parse_query_json(payload['query'], payload.get('variables'))
+            else:
+                data = request.data.decode('utf-8')
+                res = qf.parse_query_json(data)
+        return Response(res, mimetype='application/json'), 200
+
+    def _missing_query():
+        return _error_response('JSON body must have a "query" or an "id"', 400)
+
+    def _explain():
+        payload = request.get_json(silent=True)
+        if isinstance(payload, dict) and 'id' in payload:
+            res = qf.explain_persisted(payload['id'], payload.get('variables'))
+        elif isinstance(payload, dict):
+            if not isinstance(payload.get('query'), str):
+                return _missing_query()
+            res = qf.explain(payload['query'], payload.get('variables'))
+        else:
+            res = qf.explain(request.data.decode('utf-8'))
+        return Response(json.dumps(res, default=str), mimetype='application/json'), 200
+
+    @app.route('/shoedog/batch', methods=['POST'])
+    @_json_errors
+    def shoedog_batch():
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, list):
+            return _error_response('JSON body must be a list of queries', 400)
+        max_workers = request.args.get('max_workers', type=int)
+        if max_workers is not None and max_workers < 1:
+            return _error_response('max_workers must be at least 1', 400)
+        res = qf.parse_batch(payload, max_workers=max_workers)
         return Response(json.dumps(res), mimetype='application/json'), 200
+
+    if metrics_route:
+        @app.route('/shoedog/metrics', methods=['GET'])
+        def shoedog_metrics():
+            return Response(qf.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4'), 200
+
+    return qf
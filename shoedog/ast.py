@@ -1,4 +1,7 @@
+from hashlib import sha1
+from numbers import Number
 from sqlalchemy import inspect
+from sqlalchemy.orm import ColumnProperty
 
 
 class AstNode:
@@ -17,58 +20,188 @@ class AstNode:
             '\n'.join(['\n'.join([f'\t{l}' for l in c.__repr__().split('\n')])
                        for c in self.children])
 
+    def canonical(self, strip_literals=False):
+        """ A canonical string for the node and its children, used to fingerprint ASTs """
+        return self.as_string() + '{' + ','.join(c.canonical(strip_literals) for c in self.children) + '}'
+
+
+def _validate_order_by(model, order_by):
+    for name, _ in order_by:
+        attr = getattr(model, name, None)
+        if attr is None or not isinstance(getattr(attr, 'property', None), ColumnProperty):
+            raise SyntaxError(f'Cannot order {model.__name__} by {name}: it is not a column')
+    return tuple(order_by)
+
+
+def _ordering_string(order_by, limit):
+    s = ''
+    if order_by:
+        s += ' order by ' + ', '.join(f'{name} desc' if desc else name for name, desc in order_by)
+    if limit is not None:
+        s += f' limit {limit}'
+    return s
+
 
 class RootNode(AstNode):
-    """ The root node of the AST representing the model at the root of the query """
-    def __init__(self, registry, root_model_name, children=[]):
+    """ The root node of the AST representing the model at the root of the query
+
+    order_by is a tuple of (attribute name, descending) pairs ordering the results,
+    and order_index the name of the index the registry knows returns rows in that
+    order, if there is one. It is None if any attribute of the root is filtered,
+    as reading through it would stop the database using an index for the filters.
+    """
+    def __init__(self, registry, root_model_name, children=[], order_by=()):
         super().__init__(children)
         self.model = registry.get_model_with_name(root_model_name)
+        self.order_by = _validate_order_by(self.model, order_by)
+        self._order_index = registry.get_index_for_order(self.model, self.order_by) if order_by else None
+
+    @property
+    def order_index(self):
+        # Children are added after the node is created, so this is checked when it is read
+        if any(isinstance(c, AttributeNode) and c.children for c in self.children):
+            return None
+        return self._order_index
 
     def __eq__(self, other):
         return type(other) == type(self) and \
             self.model == other.model and \
+            self.order_by == other.order_by and \
             len(self.children) == len(other.children) and \
             all([x == y for x, y in zip(self.children, other.children)])
 
     def as_string(self):
-        return f'<RootNode {self.model.__name__}>'
+        return f'<RootNode {self.model.__name__}{_ordering_string(self.order_by, None)}>'
 
 
 class RelationshipNode(AstNode):
-    """ The root node of the AST representing a relationship """
-    def __init__(self, registry, root_model, rel, children=[]):
+    """ The root node of the AST representing a relationship
+
+    order_by is a tuple of (attribute name, descending) pairs ordering the related
+    objects, and limit the most related objects to load per parent object. A
+    filter_only relationship filters its parent objects but is not returned
+    """
+    def __init__(self, registry, root_model, rel, children=[], order_by=(), limit=None, filter_only=False):
         super().__init__(children)
         self.rel = getattr(root_model, rel)
         self.model = registry.get_model_with_rel(self.rel)
+        if (order_by or limit is not None) and not self.rel.property.uselist:
+            raise SyntaxError(f'Cannot order or limit singular relationship {self.rel}')
+        if (order_by or limit is not None) and filter_only:
+            raise SyntaxError(f'Cannot order or limit filter-only relationship {self.rel}')
+        self.order_by = _validate_order_by(self.model, order_by)
+        self.limit = limit
+        self.filter_only = filter_only
 
     def __eq__(self, other):
         return type(other) == type(self) and \
             self.model == other.model and \
             inspect(self.rel).mapper.class_ == inspect(other.rel).mapper.class_ and \
             self.rel.key == other.rel.key and \
+            self.order_by == other.order_by and \
+            self.limit == other.limit and \
+            self.filter_only == other.filter_only and \
             len(self.children) == len(other.children) and \
             all([x == y for x, y in zip(self.children, other.children)])
 
     def as_string(self):
-        return f'<RelationshipNode {self.model.__name__}.{self.rel.key}>'
+        return f'<RelationshipNode {"filter " if self.filter_only else ""}{self.model.__name__}.{self.rel.key}' \
+            f'{_ordering_string(self.order_by, self.limit)}>'
 
 
 class AttributeNode(AstNode):
-    """ The root node of the AST representing an attribute """
-    def __init__(self, registry, root_model, attr_name, children=[]):
+    """ The root node of the AST representing an attribute
+
+    A filter_only attribute is only filtered on, which lets a relationship whose
+    attributes are all filter_only be evaluated without loading it
+    """
+    def __init__(self, registry, root_model, attr_name, children=[], filter_only=False):
         super().__init__(children)
         self.attr = getattr(root_model, attr_name)
         self.model = root_model
+        self.filter_only = filter_only
 
     def __eq__(self, other):
         return type(other) == type(self) and \
             inspect(self.attr).class_ == inspect(other.attr).class_ and \
             self.attr.key == other.attr.key and \
+            self.filter_only == other.filter_only and \
             len(self.children) == len(other.children) and \
             all([x == y for x, y in zip(self.children, other.children)])
 
     def as_string(self):
-        return f'<AttributeNode {self.attr.key}>'
+        return f'<AttributeNode {"filter " if self.filter_only else ""}{self.attr.key}>'
+
+
+def _is_numeric(attr):
+    try:
+        return issubclass(attr.type.python_type, Number)
+    except NotImplementedError:
+        return False
+
+
+class AggregateNode(AstNode):
+    """ The AST node representing an aggregate of the objects at its level of the query
+
+    func is one of count, sum, min, max or avg. count() counts the objects and takes
+    no attribute, and every other function aggregates the column attr_name, which
+    must be numeric for sum and avg
+    """
+    def __init__(self, registry, root_model, func, attr_name=''):
+        super().__init__([])
+        if func == 'count' and attr_name:
+            raise SyntaxError(f'count() does not take an attribute, but received {attr_name}')
+        if func != 'count':
+            attr = getattr(root_model, attr_name, None) if attr_name else None
+            if attr is None or not isinstance(getattr(attr, 'property', None), ColumnProperty):
+                raise SyntaxError(f'Cannot take {func} of {root_model.__name__}.{attr_name}: it is not a column')
+            if func in ('sum', 'avg') and not _is_numeric(attr):
+                raise SyntaxError(f'Cannot take {func} of {root_model.__name__}.{attr_name}: it is not numeric')
+        self.func = func
+        self.model = root_model
+        self.attr = getattr(root_model, attr_name) if attr_name else None
+
+    @property
+    def key(self):
+        """ The key the aggregate is returned under """
+        return self.func if self.attr is None else f'{self.func}_{self.attr.key}'
+
+    def __eq__(self, other):
+        return type(other) == type(self) and \
+            self.model == other.model and \
+            self.func == other.func and \
+            getattr(self.attr, 'key', None) == getattr(other.attr, 'key', None)
+
+    def add_child(self, child):
+        raise NotImplementedError('Cannot add child to AggregateNode')
+
+    def as_string(self):
+        return f'<AggregateNode {self.func}({getattr(self.attr, "key", "")})>'
+
+
+def aggregates(ast):
+    """ Returns the AggregateNodes directly under a RootNode or RelationshipNode """
+    return [c for c in ast.children if isinstance(c, AggregateNode)]
+
+
+def is_filter_only(ast):
+    """ Returns whether a node is only filtered on: a relationship is if it is
+    marked filter-only, or if it has children and all of them are """
+    if isinstance(ast, AttributeNode):
+        return ast.filter_only
+    if isinstance(ast, RelationshipNode):
+        return ast.filter_only or (bool(ast.children) and all(is_filter_only(c) for c in ast.children))
+    return False
+
+
+def exists_filters(ast):
+    """ Returns the number of any/all filters under a node, each of which compiles
+    to an EXISTS subquery """
+    if isinstance(ast, BinaryLogicNode):
+        return exists_filters(ast.left) + exists_filters(ast.right)
+    elif isinstance(ast, FilterNode):
+        return 1 if ast.subject in ('any', 'all') else 0
+    return sum(exists_filters(c) for c in ast.children)
 
 
 class FilterNode(AstNode):
@@ -92,6 +225,10 @@ class FilterNode(AstNode):
     def as_string(self):
         return f'<FilterNode {self.subject} {self.op} {self.obj}>'
 
+    def canonical(self, strip_literals=False):
+        obj = '?' if strip_literals else repr(self.obj)
+        return f'<FilterNode {self.subject} {self.op} {obj}>'
+
 
 class BinaryLogicNode(AstNode):
     """ The AST node representing a binary logical operator on filters """
@@ -110,7 +247,28 @@ class BinaryLogicNode(AstNode):
     def as_string(self):
         return f'<BinaryLogicNode {self.op}>'
 
+    def canonical(self, strip_literals=False):
+        return f'({self.left.canonical(strip_literals)} {self.op} {self.right.canonical(strip_literals)})'
+
     def __repr__(self):
         return self.as_string() + '\n' + \
             '\n'.join(['\n'.join([f'\t{l}' for l in c.__repr__().split('\n')])
                        for c in [self.left, self.right]])
+
+
+def fingerprint(ast, strip_literals=False):
+    """ Returns a hash identifying the shape of an AST
+
+    With strip_literals, ASTs that only differ in their filter values share a fingerprint
+    """
+    return sha1(ast.canonical(strip_literals).encode('utf-8')).hexdigest()
+
+
+def tables(ast):
+    """ Returns the names of every table that evaluating an AST reads from """
+    names = set()
+    if isinstance(ast, (RootNode, RelationshipNode)):
+        names.update(t.name for t in inspect(ast.model).tables)
+        for c in ast.children:
+            names.update(tables(c))
+    return names
@@ -0,0 +1,152 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from shoedog.writes import flushed_tables, track_writes, written_tables
+
+
+class CacheBackend:
+    """ Interface for the storage behind a ResultCache
+
+    Values are serialized query results (bytes). Every entry is tagged with the
+    names of the tables its query reads from, so that writes to a table can
+    invalidate every entry that depends on it. Implementations must be thread safe.
+    """
+    def get(self, key):
+        """ Returns the value stored under key, or None if there is none """
+        raise NotImplementedError(f'{type(self).__name__} has not implemented get')
+
+    def set(self, key, value, tags):
+        """ Stores value under key, tagged with the set of table names tags """
+        raise NotImplementedError(f'{type(self).__name__} has not implemented set')
+
+    def invalidate_tags(self, tags):
+        """ Removes every entry tagged with any of tags """
+        raise NotImplementedError(f'{type(self).__name__} has not implemented invalidate_tags')
+
+
+class InProcessCacheBackend(CacheBackend):
+    """ A CacheBackend holding at most max_entries entries in memory
+
+    The least recently used entry is evicted when the cache is full, and entries
+    expire ttl seconds after they are set if a ttl is given.
+    """
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at, tags)
+        self._keys_by_tag = {}
+        self._lock = Lock()
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, frozenset(tags))
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResultCache:
+    """ Caches serialized query results keyed on (AST fingerprint, bound values)
+
+    Entries are invalidated whenever an ORM session flushes or commits a write to
+    one of the tables their query reads from. Writes that bypass the ORM unit of
+    work (bulk updates, raw SQL) are not seen, so backends should have a ttl if
+    those are used.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else InProcessCacheBackend()
+        self.hits = 0
+        self.misses = 0
+        self._generation = 0
+        self._lock = Lock()
+        self._installed = False
+
+    @staticmethod
+    def key(fingerprint, variables):
+        return fingerprint + ':' + json.dumps(variables or {}, sort_keys=True, default=str)
+
+    def get_or_execute(self, fingerprint, variables, tables, execute):
+        """ Returns the cached bytes for the query, calling execute() to produce them on a miss """
+        key = self.key(fingerprint, variables)
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            self.misses += 1
+            generation = self._generation
+        value = execute()
+        with self._lock:
+            # Don't cache a result that a concurrent write may have made stale
+            if generation == self._generation:
+                self.backend.set(key, value, tables)
+        return value
+
+    def invalidate_tables(self, tables):
+        if not tables:
+            return
+        with self._lock:
+            self._generation += 1
+            self.backend.invalidate_tags(tables)
+
+    def _after_flush(self, session, flush_context):
+        self.invalidate_tables(flushed_tables(session))
+
+    def _after_transaction(self, session):
+        # Other sessions may have cached results between the flush and the commit (or
+        # rollback) that were read before the write became visible, so invalidate again
+        self.invalidate_tables(written_tables(session))
+
+    def install(self):
+        """ Starts listening for writes on every SQLAlchemy session """
+        if not self._installed:
+            track_writes()
+            event.listen(Session, 'after_flush', self._after_flush)
+            event.listen(Session, 'after_commit', self._after_transaction)
+            event.listen(Session, 'after_rollback', self._after_transaction)
+            self._installed = True
+
+    def uninstall(self):
+        if self._installed:
+            event.remove(Session, 'after_flush', self._after_flush)
+            event.remove(Session, 'after_commit', self._after_transaction)
+            event.remove(Session, 'after_rollback', self._after_transaction)
+            self._installed = False
@@ -0,0 +1,436 @@
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from threading import Lock
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+from shoedog.ast import RootNode, RelationshipNode, AttributeNode, AggregateNode, BinaryLogicNode, FilterNode, \
+    is_filter_only
+from shoedog.errors import SnapshotUnsupportedException
+from shoedog.eval import cast_obj
+from shoedog.serializer import serialize_scalar
+from shoedog.tokenizer import Variable, variable_bind_key
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# The comparison that rejects exactly the non-null rows op accepts, for all filters
+REVERSED_OPS = {
+    '==': '!=',
+    '!=': '==',
+    '>': '<=',
+    '<': '>=',
+    '>=': '<',
+    '<=': '>',
+    'in': 'not in',
+}
+
+_COMPARISONS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b,
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+}
+
+
+def _column_kind(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return 'object'
+    if python_type is bool:
+        return 'bool'
+    elif python_type is int:
+        return 'int'
+    elif python_type is float or python_type.__name__ == 'Decimal':
+        return 'float'
+    elif python_type is str:
+        return 'str'
+    elif python_type is datetime:
+        return 'object' if getattr(column.type, 'timezone', False) else 'datetime'
+    elif python_type is date:
+        return 'date'
+    return 'object'
+
+
+class _Column:
+    """ A column of a snapshotted table as a NumPy array
+
+    valid is the mask of non-null rows. Strings are dictionary encoded: values
+    holds indexes into uniques, which is sorted so that comparing codes compares
+    the strings. Columns of types that cannot be filtered on are kept as object
+    arrays of the loaded values.
+    """
+    def __init__(self, kind, raw):
+        self.valid = np.fromiter((v is not None for v in raw), dtype=bool, count=len(raw))
+        self.uniques = None
+        if kind == 'int':
+            try:
+                self.values = np.array([0 if v is None else v for v in raw], dtype=np.int64)
+            except OverflowError:
+                kind = 'object'
+        elif kind == 'float':
+            self.values = np.array([0 if v is None else v for v in raw], dtype=np.float64)
+        elif kind == 'bool':
+            self.values = np.array([bool(v) for v in raw], dtype=bool)
+        elif kind == 'str':
+            self.uniques = sorted({v for v in raw if v is not None})
+            index = {u: i for i, u in enumerate(self.uniques)}
+            self.values = np.fromiter((-1 if v is None else index[v] for v in raw),
+                                      dtype=np.int32, count=len(raw))
+        elif kind in ('date', 'datetime'):
+            unit = 'D' if kind == 'date' else 'us'
+            self.values = np.array(['NaT' if v is None else v for v in raw], dtype=f'datetime64[{unit}]')
+        if kind == 'object':
+            self.values = np.empty(len(raw), dtype=object)
+            self.values[:] = raw
+        self.kind = kind
+
+    def output(self, rows):
+        """ Returns the JSON-compatible values of the given rows, as serialize_to_json would """
+        if self.kind == 'str':
+            uniques = self.uniques
+            return [None if c < 0 else uniques[c] for c in self.values[rows].tolist()]
+        elif self.kind == 'object':
+            return [serialize_scalar(v) for v in self.values[rows].tolist()]
+        values = self.values[rows].tolist()
+        if self.kind in ('date', 'datetime'):
+            return [None if v is None else v.isoformat() for v in values]
+        valid = self.valid[rows]
+        if not valid.all():
+            values = [v if ok else None for v, ok in zip(values, valid.tolist())]
+        return values
+
+    def _scalar(self, value):
+        """ Converts a filter value to what it compares with in values. Date filters
+        are left to the database: their values are bound as datetimes, which some
+        dialects (e.g. SQLite) compare with dates as strings rather than as days """
+        if self.kind == 'str' and isinstance(value, str):
+            return value
+        elif self.kind in ('int', 'float', 'bool') and isinstance(value, (bool, int, float)):
+            return value
+        elif self.kind == 'datetime' and isinstance(value, datetime) and value.tzinfo is None:
+            return np.datetime64(value, 'us')
+        raise SnapshotUnsupportedException(
+            f'Cannot filter a {self.kind} column on {value!r} in a columnar snapshot')
+
+    def _codes(self, values):
+        """ The dictionary codes of the given strings that are in the column """
+        codes = []
+        for v in values:
+            i = bisect_left(self.uniques, v)
+            if i < len(self.uniques) and self.uniques[i] == v:
+                codes.append(i)
+        return np.array(codes, dtype=np.int32)
+
+    def compare(self, op, value):
+        """ Returns the mask of rows for which `row <op> value` is true. As in SQL,
+        comparisons with null are never true """
+        if op in ('in', 'not in'):
+            if not isinstance(value, (list, tuple)):
+                raise SnapshotUnsupportedException(f'Cannot filter with {op} on {value!r}')
+            values = [self._scalar(v) for v in value]
+            if self.kind == 'str':
+                mask = np.isin(self.values, self._codes(values))
+            else:
+                mask = np.isin(self.values, np.array(values, dtype=self.values.dtype))
+            return self.valid & (mask if op == 'in' else ~mask)
+
+        value = self._scalar(value)
+        if self.kind != 'str':
+            return self.valid & _COMPARISONS[op](self.values, value)
+        if op in ('==', '!='):
+            mask = np.isin(self.values, self._codes([value]))
+            return self.valid & (mask if op == '==' else ~mask)
+        # The uniques are sorted, so string order comparisons are code comparisons
+        if op == '<':
+            return self.valid & (self.values < bisect_left(self.uniques, value))
+        elif op == '<=':
+            return self.valid & (self.values < bisect_right(self.uniques, value))
+        elif op == '>':
+            return self.valid & (self.values >= bisect_right(self.uniques, value))
+        return self.valid & (self.values >= bisect_left(self.uniques, value))
+
+
+class _Table:
+    """ The rows of a model's table, ordered by primary key, as columns """
+    def __init__(self, session, model):
+        mapper = inspect(model)
+        if mapper.inherits is not None or mapper.polymorphic_on is not None or \
+                len(mapper.tables) != 1:
+            raise SnapshotUnsupportedException(f'Cannot snapshot {model.__name__} with inheritance')
+        self.model = model
+        self.keys = [p.key for p in mapper.column_attrs]
+        rows = session.query(*[getattr(model, key) for key in self.keys]) \
+                      .order_by(*mapper.primary_key).all()
+        raw_columns = list(zip(*rows)) if rows else [() for _ in self.keys]
+        self.size = len(rows)
+        self.columns = {
+            key: _Column(_column_kind(mapper.column_attrs[key].columns[0]), raw)
+            for key, raw in zip(self.keys, raw_columns)
+        }
+        self._keys_by_column = {
+            mapper.column_attrs[key].columns[0]: key for key in self.keys
+        }
+
+    def key_values(self, columns):
+        """ Returns (a tuple of the values of the given table columns for every row,
+        the mask of rows where none of them are null) """
+        outputs = [self.columns[self._keys_by_column[c]] for c in columns]
+        return list(zip(*[c.values.tolist() if c.kind != 'str' else c.output(slice(None))
+                          for c in outputs])), \
+            np.logical_and.reduce([c.valid for c in outputs])
+
+
+class _Relationship:
+    """ A relationship between two snapshotted tables in compressed sparse row form
+
+    The rows related to parent row i are indices[offsets[i]:offsets[i + 1]], in
+    primary key order
+    """
+    def __init__(self, parent, child, prop):
+        if prop.secondary is not None:
+            raise SnapshotUnsupportedException(f'Cannot snapshot {prop} through a secondary table')
+        local_columns = [l for l, _ in prop.local_remote_pairs]
+        remote_columns = [r for _, r in prop.local_remote_pairs]
+        parent_keys, parent_valid = parent.key_values(local_columns)
+        child_keys, child_valid = child.key_values(remote_columns)
+
+        # Factorize the join keys of both sides into the same integer space
+        ids = {}
+        parent_ids = np.fromiter((ids.setdefault(k, len(ids)) if ok else -1
+                                  for k, ok in zip(parent_keys, parent_valid.tolist())),
+                                 dtype=np.int64, count=len(parent_keys))
+        child_ids = np.fromiter((ids.get(k, -1) if ok else -1
+                                 for k, ok in zip(child_keys, child_valid.tolist())),
+                                dtype=np.int64, count=len(child_keys))
+
+        order = np.argsort(child_ids, kind='stable')
+        sorted_ids = child_ids[order]
+        starts = np.searchsorted(sorted_ids, parent_ids, side='left')
+        ends = np.searchsorted(sorted_ids, parent_ids, side='right')
+        counts = np.where(parent_ids < 0, 0, ends - starts)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.indices = order[_segment_positions(starts, counts)]
+        self.uselist = prop.uselist
+
+    def any(self, child_mask):
+        """ Segmented any: the mask of parent rows with at least one related row in child_mask """
+        hits = np.concatenate([[0], np.cumsum(child_mask[self.indices])])
+        return hits[self.offsets[1:]] > hits[self.offsets[:-1]]
+
+    def restrict(self, child_mask):
+        """ Returns (offsets, indices) of the relationship keeping only rows in child_mask """
+        keep = child_mask[self.indices]
+        hits = np.concatenate([[0], np.cumsum(keep)])
+        return hits[self.offsets], self.indices[keep]
+
+
+def _segment_positions(starts, counts):
+    """ Concatenates range(start, start + count) for every segment, vectorized """
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    segment_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.repeat(starts - segment_starts, counts) + np.arange(total)
+
+
+def _subjects(ast):
+    if isinstance(ast, BinaryLogicNode):
+        return _subjects(ast.left) | _subjects(ast.right)
+    return {ast.subject}
+
+
+def _is_quantified(attribute_node):
+    """ Whether an attribute's filters are any/all filters on the relationship
+    into its block, i.e. predicates on the parent row rather than on this row """
+    if not attribute_node.children:
+        return False
+    subjects = _subjects(attribute_node.children[0])
+    if '*' in subjects and len(subjects) > 1:
+        raise SnapshotUnsupportedException('Cannot mix * with any/all filters in a columnar snapshot')
+    return '*' not in subjects
+
+
+class _Snapshot:
+    """ The tables and relationships of one refresh of a ColumnarSnapshot """
+    def __init__(self, session, models):
+        self.tables = {model: _Table(session, model) for model in models}
+        self.relationships = {}
+        for model, table in self.tables.items():
+            for prop in inspect(model).relationships:
+                child = self.tables.get(prop.mapper.class_)
+                if child is None or prop.secondary is not None:
+                    continue
+                self.relationships[(model, prop.key)] = _Relationship(table, child, prop)
+
+    def _check(self, ast):
+        """ Raises SnapshotUnsupportedException if the AST cannot be answered exactly
+
+        Every object is loaded into a single identity map in SQL, so an object
+        reached through several relationships in the query would be serialized with
+        the relationships loaded at any of them. Models whose relationships are
+        queried may therefore only appear once in the query.
+        """
+        nodes = {}
+
+        def visit(node):
+            if node.model not in self.tables:
+                raise SnapshotUnsupportedException(f'{node.model.__name__} is not in the snapshot')
+            nodes.setdefault(node.model, []).append(node)
+            rel_keys = []
+            for c in node.children:
+                if isinstance(c, RelationshipNode):
+                    if (node.model, c.rel.key) not in self.relationships:
+                        raise SnapshotUnsupportedException(f'{c.rel} is not in the snapshot')
+                    if c.order_by or c.limit is not None:
+                        raise SnapshotUnsupportedException(f'Cannot order or limit {c.rel}')
+                    if is_filter_only(c):
+                        raise SnapshotUnsupportedException(f'Cannot filter on {c.rel} without loading it')
+                    rel_keys.append(c.rel.key)
+                    visit(c)
+                elif isinstance(c, AggregateNode):
+                    raise SnapshotUnsupportedException(f'Cannot aggregate {node.model.__name__}')
+                elif c.attr.key not in self.tables[node.model].columns:
+                    raise SnapshotUnsupportedException(f'{c.attr} is not a column')
+                else:
+                    _is_quantified(c)
+            if len(rel_keys) != len(set(rel_keys)):
+                raise SnapshotUnsupportedException('Cannot join the same relationship twice')
+
+        if ast.order_by:
+            raise SnapshotUnsupportedException(f'Cannot order {ast.model.__name__}')
+        visit(ast)
+        for model, model_nodes in nodes.items():
+            if len(model_nodes) > 1 and \
+                    any(isinstance(c, RelationshipNode) for n in model_nodes for c in n.children):
+                raise SnapshotUnsupportedException(
+                    f'{model.__name__} appears more than once in the query with relationships')
+
+    def _value(self, filter_node, attr, params):
+        if isinstance(filter_node.obj, Variable):
+            return params[variable_bind_key(filter_node.obj.name)]
+        if isinstance(filter_node.obj, list):
+            return [cast_obj(o, attr) for o in filter_node.obj]
+        return cast_obj(filter_node.obj, attr)
+
+    def _row_mask(self, ast, column, attr, params):
+        """ The mask of rows passing a tree of * filters """
+        if isinstance(ast, BinaryLogicNode):
+            left = self._row_mask(ast.left, column, attr, params)
+            right = self._row_mask(ast.right, column, attr, params)
+            return left & right if ast.op == 'and' else left | right
+        return column.compare(ast.op, self._value(ast, attr, params))
+
+    def _quantified_mask(self, ast, rel, column, attr, params):
+        """ The mask of parent rows passing a tree of any/all filters on rel """
+        if isinstance(ast, BinaryLogicNode):
+            left = self._quantified_mask(ast.left, rel, column, attr, params)
+            right = self._quantified_mask(ast.right, rel, column, attr, params)
+            return left & right if ast.op == 'and' else left | right
+        value = self._value(ast, attr, params)
+        if ast.subject == 'any':
+            return rel.any(column.compare(ast.op, value))
+        # all <op> val is just not any <not op> val
+        return ~rel.any(column.compare(REVERSED_OPS[ast.op], value))
+
+    def _matches(self, node, params, oks):
+        """ Computes the mask of the node's rows that appear in the results, i.e.
+        that pass its own filters and have a matching row for every relationship
+        in its block (relationships are inner joined). Masks are stored in oks """
+        table = self.tables[node.model]
+        mask = np.ones(table.size, dtype=bool)
+        for c in node.children:
+            if isinstance(c, AttributeNode):
+                if c.children and not _is_quantified(c):
+                    mask &= self._row_mask(c.children[0], table.columns[c.attr.key], c.attr, params)
+                continue
+            rel = self.relationships[(node.model, c.rel.key)]
+            child_table = self.tables[c.model]
+            mask &= rel.any(self._matches(c, params, oks))
+            for a in c.children:
+                if isinstance(a, AttributeNode) and _is_quantified(a):
+                    mask &= self._quantified_mask(
+                        a.children[0], rel, child_table.columns[a.attr.key], a.attr, params)
+        oks[id(node)] = mask
+        return mask
+
+    def _build(self, node, rows, oks):
+        """ Serializes the given rows of the node's table, returning a list aligned with rows """
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        table = self.tables[node.model]
+        values = [table.columns[key].output(unique_rows) for key in table.keys]
+        dicts = [dict(zip(table.keys, row_values)) for row_values in zip(*values)]
+
+        for c in node.children:
+            if not isinstance(c, RelationshipNode):
+                continue
+            rel = self.relationships[(node.model, c.rel.key)]
+            offsets, indices = rel.restrict(oks[id(c)])
+            starts = offsets[unique_rows]
+            counts = offsets[unique_rows + 1] - starts
+            child_dicts = self._build(c, indices[_segment_positions(starts, counts)], oks)
+            position = 0
+            for d, count in zip(dicts, counts.tolist()):
+                related = child_dicts[position:position + count]
+                d[c.rel.key] = related if rel.uselist else related[0]
+                position += count
+        return [dicts[i] for i in inverse.tolist()]
+
+    def evaluate(self, ast, params):
+        self._check(ast)
+        oks = {}
+        root_rows = np.flatnonzero(self._matches(ast, params, oks))
+        return self._build(ast, root_rows, oks)
+
+
+class ColumnarSnapshot:
+    """ An in-memory, read-only copy of some models' tables that queries can be
+    answered from without touching the database
+
+    Every column is held in a NumPy array (strings dictionary encoded) and every
+    relationship between the models as offset/index arrays, so filters are
+    evaluated as vectorized masks and any/all filters as segmented reductions
+    over the related rows. Results are the same as serialize_to_json(eval_ast(...))
+    on a fresh session, with roots and related rows in primary key order.
+
+    The data is loaded from bind (an Engine or Connection) on creation, and is
+    only reloaded when refresh is called.
+
+    Queries that the snapshot cannot answer exactly raise
+    SnapshotUnsupportedException from evaluate, for e.g. ones on models or
+    relationships (including many-to-many ones) that are not in the snapshot, ones
+    that reach the same model with relationships through several paths, and
+    filters mixing * with any/all.
+    """
+    def __init__(self, bind, models):
+        if np is None:
+            raise ImportError('numpy is required for columnar snapshots')
+        self.bind = bind
+        self.models = list(models)
+        self._snapshot = None
+        self._refresh_lock = Lock()
+        self.refresh()
+
+    def refresh(self):
+        """ Reloads every table from the database """
+        with self._refresh_lock:
+            session = Session(bind=self.bind)
+            try:
+                snapshot = _Snapshot(session, self.models)
+            finally:
+                session.close()
+            self._snapshot = snapshot
+
+    def evaluate(self, ast, params=None):
+        """ Returns the JSON-compatible results of an AST
+
+        Requires:
+            ast: RootNode
+            params: dict of bound variable values, see eval.bind_variables
+        """
+        assert isinstance(ast, RootNode), f'Cannot evaluate {ast} on a snapshot'
+        return self._snapshot.evaluate(ast, params or {})
@@ -4,3 +4,4 @@ valid_ops = {'<', '>', '<=', '>=', '==', '!=', 'in'}
 valid_selectors = {'*', 'all', 'any'}
 array_only_selectors = {'all', 'any'}
 binary_logical_ops = {'and', 'or'}
+aggregate_functions = {'count', 'sum', 'min', 'max', 'avg'}
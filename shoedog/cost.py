@@ -0,0 +1,127 @@
+import math
+from contextlib import contextmanager
+from threading import BoundedSemaphore
+from sqlalchemy import func, inspect
+from shoedog.ast import AttributeNode, BinaryLogicNode, FilterNode, exists_filters
+from shoedog.errors import QueryTooExpensiveException, AdmissionTimeoutException
+from shoedog.eval import relationship_blocks
+
+
+DEFAULT_WEIGHTS = {
+    'join': 1.0,  # every joined relationship
+    'fan_out': 4.0,  # multiplier for everything beneath a one-to-many relationship
+    'exists': 2.0,  # every any/all filter and filter-only relationship is an EXISTS subquery
+    'unfiltered_root': 10.0,  # a query without any filters reads the whole root table
+}
+
+
+def _has_filters(ast):
+    if isinstance(ast, (BinaryLogicNode, FilterNode)):
+        return True
+    return any(_has_filters(c) for c in ast.children)
+
+
+def _table_factor(model, row_counts):
+    """ Scales costs by the order of magnitude of a table's size, if it is known """
+    if not row_counts:
+        return 1
+    rows = sum(row_counts.get(t.name, 0) for t in inspect(model).tables)
+    return math.log10(max(rows, 1)) + 1
+
+
+def _exists_cost(ast, weights, multiplier):
+    filters = sum(exists_filters(c) for c in ast.children if isinstance(c, AttributeNode))
+    return weights['exists'] * multiplier * filters
+
+
+def _cost(ast, weights, row_counts, root_factor):
+    cost = _exists_cost(ast, weights, root_factor)
+    # Nodes define __eq__ without __hash__, so multipliers are keyed on their ids
+    multipliers = {id(ast): root_factor}
+    for node, parent, how in relationship_blocks(ast):
+        table_factor = _table_factor(node.model, row_counts)
+        m = multipliers[id(parent)] * table_factor
+        if node.rel.property.uselist:
+            m *= weights['fan_out']
+        multipliers[id(node)] = m
+        if how == 'exists':
+            # An EXISTS subquery keeps at most one row per parent row
+            cost += weights['exists'] * multipliers[id(parent)] * table_factor
+        elif how != 'shared':
+            cost += weights['join'] * m
+        cost += _exists_cost(node, weights, m)
+    return cost
+
+
+def estimate_cost(ast, weights=None, row_counts=None):
+    """ Estimates the cost of evaluating an AST, before running it
+
+    Joins and EXISTS subqueries each add to the cost, and everything beneath a
+    one-to-many relationship costs fan_out times more, so deep one-to-many chains
+    grow exponentially. Filter-only relationships cost an EXISTS subquery rather
+    than a join, and blocks that share the join of an earlier block add nothing
+    for it. A query with no filters at all pays for reading the whole
+    root table.
+
+    Requires:
+        ast: RootNode
+        weights: optional dict overriding entries of DEFAULT_WEIGHTS
+        row_counts: optional dict of {table name: number of rows}. If given, the
+            cost of each table is scaled by the order of magnitude of its size
+    """
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    root_factor = _table_factor(ast.model, row_counts)
+    cost = _cost(ast, weights, row_counts, root_factor)
+    if not _has_filters(ast):
+        cost += weights['unfiltered_root'] * root_factor
+    return cost
+
+
+def collect_row_counts(session, models):
+    """ Counts the rows in each model's tables, for use as estimate_cost's row_counts """
+    row_counts = {}
+    for model in models:
+        for table in inspect(model).tables:
+            if table.name not in row_counts:
+                row_counts[table.name] = session.query(func.count()).select_from(table).scalar()
+    return row_counts
+
+
+class AdmissionController:
+    """ Rejects queries that are too expensive and limits how many run at once
+
+    Queries costing more than max_cost are rejected with QueryTooExpensiveException.
+    Queries costing more than expensive_cost are expensive, and at most
+    max_expensive of them run at once; at most max_cheap other queries run at once.
+    Queries over a limit wait for a slot for up to timeout seconds (forever if
+    None) before being rejected with AdmissionTimeoutException. Keeping the two
+    queues separate means a backlog of expensive queries never holds up cheap ones.
+    """
+    def __init__(self, max_cost=None, expensive_cost=50, max_cheap=32, max_expensive=4,
+                 timeout=None, weights=None, row_counts=None):
+        self.max_cost = max_cost
+        self.expensive_cost = expensive_cost
+        self.timeout = timeout
+        self.weights = weights
+        self.row_counts = row_counts
+        self._cheap = BoundedSemaphore(max_cheap)
+        self._expensive = BoundedSemaphore(max_expensive)
+
+    def estimate(self, ast):
+        return estimate_cost(ast, self.weights, self.row_counts)
+
+    @contextmanager
+    def admit(self, ast):
+        """ Waits for a slot to evaluate the AST in, for the duration of the with block """
+        cost = self.estimate(ast)
+        if self.max_cost is not None and cost > self.max_cost:
+            raise QueryTooExpensiveException(
+                f'Query cost {cost:.1f} is over the budget of {self.max_cost}')
+        semaphore = self._expensive if cost > self.expensive_cost else self._cheap
+        if not semaphore.acquire(timeout=self.timeout):
+            raise AdmissionTimeoutException(
+                f'Timed out waiting {self.timeout}s to run query with cost {cost:.1f}')
+        try:
+            yield cost
+        finally:
+            semaphore.release()
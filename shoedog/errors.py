@@ -1,2 +1,38 @@
 class ModelNotFoundException(Exception):
     pass
+
+
+class PersistedQueryNotFoundException(Exception):
+    pass
+
+
+class InvalidVariableException(Exception):
+    pass
+
+
+class ExecutorFullException(Exception):
+    pass
+
+
+class QueryTooExpensiveException(Exception):
+    pass
+
+
+class AdmissionTimeoutException(Exception):
+    pass
+
+
+class QueryTimeoutException(Exception):
+    pass
+
+
+class TooManyStatementsException(Exception):
+    pass
+
+
+class SnapshotUnsupportedException(Exception):
+    pass
+
+
+class InvalidBatchItemException(Exception):
+    pass
@@ -1,9 +1,21 @@
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.types import Date
 
-from sqlalchemy.orm import contains_eager, lazyload, aliased
-from sqlalchemy import and_, or_
-from shoedog.ast import RootNode, RelationshipNode, AttributeNode, BinaryLogicNode, FilterNode
+from sqlalchemy.orm import Query, contains_eager, lazyload, aliased, scoped_session
+from sqlalchemy import and_, or_, bindparam, event, func, select, text
+from shoedog.ast import RootNode, RelationshipNode, AttributeNode, AggregateNode, BinaryLogicNode, \
+    FilterNode, aggregates, is_filter_only
+from shoedog.consts import array_only_ops
+from shoedog.errors import InvalidVariableException, QueryTimeoutException
+from shoedog.inlist import in_list
+from shoedog.metrics import StageTimer
+from shoedog.ordering import indexed_alias
+from shoedog.sharding import primary_key_attributes
+from shoedog.tokenizer import Variable, variable_bind_key
 from sqlalchemy import inspect
 
 FMAP = {
@@ -27,15 +39,26 @@ REV_FMAP = {
 }
 
 
-def _cast_obj(raw_obj, attr):
+def cast_obj(raw_obj, attr, op=None):
+    """ Returns the value a filter compares attr with: a bound parameter for a
+    $variable, or the literal from the query cast to the column's type """
     # TODO: Add more custom parsing for SQLAlchemy types
     # Possibly allow for custom type parsing here too
-    if isinstance(attr.type, Date):
+    if isinstance(raw_obj, Variable):
+        # Values for variables are cast when they are bound, see bind_variables
+        return bindparam(variable_bind_key(raw_obj.name), type_=attr.type, expanding=op in array_only_ops)
+    elif isinstance(attr.type, Date):
         return datetime.strptime(raw_obj, '%Y-%m-%d')
     else:
         return raw_obj
 
 
+def _compare(attr, method, obj):
+    if method in ('in_', 'notin_'):
+        return in_list(attr, obj, negate=method == 'notin_')
+    return getattr(attr, method)(obj)
+
+
 def _eval_filters(ast, attr, rel):
     if isinstance(ast, BinaryLogicNode):
         if ast.op == 'and':
@@ -51,33 +74,207 @@ def _eval_filters(ast, attr, rel):
         else:
             raise NotImplementedError(f'Binary op {ast.op} not implemented')
     elif isinstance(ast, FilterNode):
-        obj = _cast_obj(ast.obj, attr)
+        obj = cast_obj(ast.obj, attr, ast.op)
         non_aliased_attr = getattr(inspect(attr.class_).class_, attr.key)
 
         if ast.subject == 'any':
             if rel is None or not rel.property.uselist:
                 e = 'root query class' if rel is None else rel
                 raise SyntaxError(f'Cannot specify any filter on {e}')
-            return rel.any(getattr(non_aliased_attr, FMAP[ast.op])(obj))
+            return rel.any(_compare(non_aliased_attr, FMAP[ast.op], obj))
 
         elif ast.subject == 'all':
             if rel is None or not rel.property.uselist:
                 e = 'root query class' if rel is None else rel
                 raise SyntaxError(f'Cannot specify all filter on {e}')
             # all <op> val is just not any <not op> val
-            res = ~rel.any(getattr(non_aliased_attr, REV_FMAP[ast.op])(obj))
+            res = ~rel.any(_compare(non_aliased_attr, REV_FMAP[ast.op], obj))
             return res
 
         elif ast.subject == '*':
             if rel is not None and rel.property.uselist:
                 raise SyntaxError(f'Cannot specify * filter on singular relationship {rel}')
-            return getattr(attr, FMAP[ast.op])(obj)
+            return _compare(attr, FMAP[ast.op], obj)
 
         else:
             raise SyntaxError(f'Invalid subject for _eval_filters {ast.subject}')
 
 
-def _eval_ast(ast, query, aliased_current_model, current_rel_path):
+def _order_clauses(entity, order_by):
+    """ Returns ORDER BY clauses for (attribute name, descending) pairs on entity """
+    return [getattr(entity, name).desc() if desc else getattr(entity, name).asc()
+            for name, desc in order_by]
+
+
+def _top_n_alias(rel, ast):
+    """ Returns an alias of the related model that numbers the related rows of
+    every parent in the order given by ast.order_by (breaking ties by primary key),
+    along with the column holding that row number
+
+    Only the related rows that the block's nested relationships keep are numbered,
+    so filtering on the row number being at most ast.limit keeps the first ast.limit
+    matching related rows of every parent, in the database.
+    """
+    prop = rel.property
+    if prop.secondary is not None:
+        raise SyntaxError(f'Cannot limit {rel}: relationships through a secondary table are not supported')
+    criteria = [criterion for c in ast.children if isinstance(c, RelationshipNode)
+                for criterion in _filter_only_criteria(c, ast.model, numbering=True)]
+    partition_by = [remote for _, remote in prop.local_remote_pairs]
+    order_by = _order_clauses(ast.model, ast.order_by) + list(inspect(ast.model).primary_key)
+    row_number = func.row_number().over(partition_by=partition_by, order_by=order_by) \
+        .label('shoedog_row_number')
+    subquery = Query(ast.model).add_columns(row_number).filter(*criteria).subquery()
+    return aliased(ast.model, subquery), subquery.c.shoedog_row_number
+
+
+def _subject(ast):
+    """ Returns the subject of a filter, which is the same for all of its filters """
+    return _subject(ast.left) if isinstance(ast, BinaryLogicNode) else ast.subject
+
+
+def _aggregate_expression(node, entity):
+    if node.attr is None:
+        return func.count()
+    return getattr(func, node.func)(getattr(entity, node.attr.key))
+
+
+def _eval_aggregated_relationship(ast, query, aliased_current_model):
+    """ Adds the aggregates of a relationship to the query as correlated scalar
+    subqueries, preceded by the primary key of the parent object they belong to
+
+    Filters with the * subject restrict the related objects that are aggregated,
+    while any and all filters restrict the parent objects as they do elsewhere.
+    The related objects are never joined or loaded.
+    """
+    if not ast.rel.property.uselist:
+        raise SyntaxError(f'Cannot aggregate singular relationship {ast.rel}')
+    if ast.order_by or ast.limit is not None:
+        raise SyntaxError(f'Cannot order or limit aggregated relationship {ast.rel}')
+    aliased_rel = getattr(aliased_current_model, ast.rel.key)
+    criteria = [aliased_rel.expression]
+    for c in ast.children:
+        if isinstance(c, RelationshipNode) or (isinstance(c, AttributeNode) and not c.children):
+            raise SyntaxError(f'Cannot select {c.as_string()} alongside aggregates of {ast.rel}')
+        if isinstance(c, AttributeNode):
+            if _subject(c.children[0]) == '*':
+                criteria.append(_eval_filters(c.children[0], c.attr, None))
+            else:
+                query = query.filter(_eval_filters(c.children[0], c.attr, aliased_rel))
+    current_model = inspect(aliased_current_model).class_
+    return query.add_columns(
+        *[getattr(aliased_current_model, k) for k in primary_key_attributes(current_model)],
+        *[select([_aggregate_expression(n, ast.model)]).where(and_(*criteria)).as_scalar()
+          for n in aggregates(ast)])
+
+
+def _filter_only_criteria(ast, parent, numbering=False):
+    """ Returns the filters on parent (an entity, aliased or not) of a filter-only
+    relationship, without joining it
+
+    The relationship compiles to an EXISTS (via .any() or .has()) of a related
+    row that matches its * filters and its own filter-only relationships, which
+    keeps exactly the parents the join would have, but with one row each. Its any
+    and all filters are filters on parent, as they are elsewhere.
+
+    With numbering, ast is a joined relationship instead, and the filters are the
+    parents its join keeps, for _top_n_alias to number only those. Ordering and
+    limits do not change whether a related row is joined, and aggregated
+    relationships are not joined at all.
+    """
+    rel = getattr(parent, ast.rel.key)
+    if not numbering and (ast.order_by or ast.limit is not None):
+        raise SyntaxError(f'Cannot order or limit filter-only relationship {ast.rel}')
+    related, criteria = [], []
+    for c in ast.children:
+        if isinstance(c, RelationshipNode):
+            related.extend(_filter_only_criteria(c, ast.model, numbering))
+        elif isinstance(c, AggregateNode):
+            if not numbering:
+                raise SyntaxError(f'Cannot aggregate in filter-only relationship {ast.rel}')
+        elif c.children and _subject(c.children[0]) == '*':
+            related.append(_eval_filters(c.children[0], c.attr, None))
+        elif c.children:
+            criteria.append(_eval_filters(c.children[0], c.attr, rel))
+    if numbering and aggregates(ast):
+        return criteria
+    criterion = and_(*related) if related else None
+    return [rel.any(criterion) if ast.rel.property.uselist else rel.has(criterion)] + criteria
+
+
+# The join of a relationship from an aliased parent, for later blocks of the same relationship to reuse
+_Join = namedtuple('_Join', ['alias', 'rel_path', 'order_by', 'limit', 'constrains_rows'])
+
+
+def _constrains_rows(ast):
+    """ Returns whether a relationship block restricts which related rows are
+    joined, beyond their being related: its own relationships are inner joined
+    or filtered on """
+    return any(isinstance(c, RelationshipNode) for c in ast.children)
+
+
+def _can_share_join(ast, join):
+    """ Returns whether a relationship block can reuse the join of an earlier block
+    for the same relationship from the same parent alias
+
+    A singular relationship joins the same row for every block, so the row has to
+    pass every block's filters either way. A relationship to many objects joins
+    the related rows of each block independently, so blocks only share a join
+    if they are ordered and limited the same way and at most one of them
+    restricts which rows are joined. A limited join only numbers the rows its
+    first block keeps, so later blocks with relationships cannot share it.
+    """
+    if not ast.rel.property.uselist:
+        return True
+    if ast.limit is not None and _constrains_rows(ast):
+        return False
+    return (ast.order_by, ast.limit) == (join.order_by, join.limit) and \
+        not (join.constrains_rows and _constrains_rows(ast))
+
+
+def relationship_blocks(ast):
+    """ Yields (node, parent, how) for every relationship block beneath ast, parents
+    first, where how is how eval_ast compiles the block:
+
+    'join': the relationship is joined
+    'shared': the block reuses the join of an earlier block (see _can_share_join)
+    'exists': the block is filter-only, or nested in one, and is an EXISTS subquery
+    'aggregate': the block's aggregates are correlated scalar subqueries
+    """
+    # Joins are keyed on the first block of each, as eval_ast keys them on its alias
+    joins = {}
+
+    def visit_exists(node):
+        for c in node.children:
+            if isinstance(c, RelationshipNode):
+                yield c, node, 'exists'
+                yield from visit_exists(c)
+
+    def visit(node, join_id):
+        for c in node.children:
+            if not isinstance(c, RelationshipNode):
+                continue
+            if is_filter_only(c):
+                yield c, node, 'exists'
+                yield from visit_exists(c)
+            elif aggregates(c):
+                yield c, node, 'aggregate'
+            else:
+                join_key = (join_id, c.rel.key)
+                join = joins.get(join_key)
+                if join is not None and _can_share_join(c, join):
+                    joins[join_key] = join._replace(constrains_rows=join.constrains_rows or _constrains_rows(c))
+                    yield c, node, 'shared'
+                    yield from visit(c, join.alias)
+                else:
+                    joins[join_key] = _Join(id(c), None, c.order_by, c.limit, _constrains_rows(c))
+                    yield c, node, 'join'
+                    yield from visit(c, id(c))
+
+    return visit(ast, id(ast))
+
+
+def _eval_ast(ast, query, aliased_current_model, current_rel_path, eager=True, joins=None):
     """
     Requires:
         aliased_current_model - is the current model aliased
@@ -87,14 +284,39 @@ def _eval_ast(ast, query, aliased_current_model, current_rel_path):
             ((RootAlias.field1, Root.field1, Field1Alias),
              (Field1Alias.field2, Field1.field2, Field2Alias),
              (Field2Alias.field3, Field2.field3, Field3Alias))
+        eager - whether the objects of joined relationships are loaded, or the
+            relationships are only joined to filter on
+        joins - a dict of {(aliased parent, relationship key): _Join} of the
+            relationships joined so far, shared by the whole query
     """
+    joins = {} if joins is None else joins
     # Handle RelationshipNode
     if isinstance(ast, RelationshipNode):
+        if is_filter_only(ast):
+            return query.filter(*_filter_only_criteria(ast, aliased_current_model))
+        if aggregates(ast):
+            if not eager:
+                raise SyntaxError(f'Cannot aggregate {ast.rel} in a query with aggregates at its root')
+            return _eval_aggregated_relationship(ast, query, aliased_current_model)
+
+        # Blocks for a relationship that is already joined from the same parent
+        # reuse its alias and join, which merges their children
+        join_key = (aliased_current_model, ast.rel.key)
+        join = joins.get(join_key)
+        if join is not None and _can_share_join(ast, join):
+            joins[join_key] = join._replace(constrains_rows=join.constrains_rows or _constrains_rows(ast))
+            for c in ast.children:
+                query = _eval_ast(c, query, join.alias, join.rel_path, eager, joins)
+            return query
+
         # Get the relationship and alias it to avoid conflicts
         current_model = inspect(aliased_current_model).class_
         aliased_new_rel = getattr(aliased_current_model, ast.rel.key)
         new_rel = getattr(current_model, ast.rel.key)  # Unaliased rel
-        aliased_rel_model = aliased(new_rel)  # Create an alias of the new relationship we are diving into
+        if ast.limit is None:
+            aliased_rel_model = aliased(new_rel)  # Create an alias of the new relationship we are diving into
+        else:
+            aliased_rel_model, row_number = _top_n_alias(new_rel, ast)
 
         new_rel_path = ((aliased_new_rel, new_rel, aliased_rel_model),) \
             if not current_rel_path else \
@@ -119,12 +341,18 @@ def _eval_ast(ast, query, aliased_current_model, current_rel_path):
                 else contains_eager_chain.contains_eager(rel, alias=rel_alias)
 
         # Add the appropriate join, and annotate it with the correct alias
-        query = query.options(contains_eager_chain) \
-                     .join(aliased_rel_model, aliased_new_rel)
+        query = query.join(aliased_rel_model, aliased_new_rel)
+        joins[join_key] = _Join(aliased_rel_model, new_rel_path, ast.order_by, ast.limit, _constrains_rows(ast))
+        if ast.limit is not None:
+            query = query.filter(row_number <= ast.limit)
+        if eager:
+            # Related objects are loaded into their collections in the order their rows arrive
+            query = query.options(contains_eager_chain) \
+                         .order_by(*_order_clauses(aliased_rel_model, ast.order_by))
 
         # Run recursively on the children
         for c in ast.children:
-            query = _eval_ast(c, query, aliased_rel_model, new_rel_path)
+            query = _eval_ast(c, query, aliased_rel_model, new_rel_path, eager, joins)
         return query
 
     # Handle AttributeNode
@@ -137,15 +365,296 @@ def _eval_ast(ast, query, aliased_current_model, current_rel_path):
             filters = _eval_filters(ast.children[0], attr, aliased_rel)
             query = query.filter(filters)
         return query
+    elif isinstance(ast, AggregateNode):
+        raise SyntaxError(f'Cannot aggregate {ast.model.__name__} alongside its objects')
     else:
         assert False, f'Should not vall _eval_ast on {ast}'
 
 
-def eval_ast(ast, session):
+def _collect_variables(ast, attr, variables):
+    if isinstance(ast, BinaryLogicNode):
+        _collect_variables(ast.left, attr, variables)
+        _collect_variables(ast.right, attr, variables)
+    elif isinstance(ast, FilterNode) and isinstance(ast.obj, Variable):
+        name, is_list = ast.obj.name, ast.op in array_only_ops
+        # A variable can filter several columns, as long as they bind values the same way
+        if name in variables and (type(variables[name][0].type) is not type(attr.type) or
+                                  variables[name][1] != is_list):
+            raise SyntaxError(f'Variable ${name} is used with conflicting types')
+        variables[name] = (attr, is_list)
+    elif isinstance(ast, AttributeNode):
+        for c in ast.children:
+            _collect_variables(c, ast.attr, variables)
+    elif isinstance(ast, (RootNode, RelationshipNode)):
+        for c in ast.children:
+            _collect_variables(c, None, variables)
+    return variables
+
+
+def collect_variables(ast):
+    """ Returns a dict of {variable name: (attribute, is_list)} for every $variable in the AST """
+    return _collect_variables(ast, None, {})
+
+
+def _bind_variable(name, value, attr):
+    try:
+        python_type = attr.type.python_type
+    except NotImplementedError:
+        return value
+    if isinstance(attr.type, Date) and isinstance(value, str):
+        try:
+            return cast_obj(value, attr)
+        except ValueError:
+            raise InvalidVariableException(f'Variable ${name} must be a date formatted as YYYY-MM-DD')
+    # bool is a subclass of int, but true/false are only valid on boolean columns
+    if not isinstance(value, python_type) or (isinstance(value, bool) and python_type is not bool):
+        raise InvalidVariableException(
+            f'Variable ${name} must be of type {python_type.__name__} to filter on {attr.key}')
+    return value
+
+
+def bind_variables(variables, values):
+    """ Type-checks values against the columns their variables filter on
+
+    Requires:
+        variables: dict returned by collect_variables
+        values: dict of {variable name: value} passed along with the query
+    Returns:
+        params: dict of bound parameters for the query, keyed on variable_bind_key
+    Raises:
+        InvalidVariableException if a variable is missing, unknown or of the wrong type
+    """
+    if not isinstance(values, dict):
+        raise InvalidVariableException('Variables must be a JSON object of {name: value}')
+    unknown = set(values) - set(variables)
+    if unknown:
+        raise InvalidVariableException(f'Unknown variables {sorted(unknown)}')
+    params = {}
+    for name, (attr, is_list) in variables.items():
+        if name not in values:
+            raise InvalidVariableException(f'No value provided for variable ${name}')
+        value = values[name]
+        if is_list != isinstance(value, list):
+            e = 'a list' if is_list else 'a single value'
+            raise InvalidVariableException(f'Variable ${name} must be {e}')
+        params[variable_bind_key(name)] = [_bind_variable(name, v, attr) for v in value] if is_list \
+            else _bind_variable(name, value, attr)
+    return params
+
+
+def root_order_by(ast):
+    """ Returns the (attribute name, descending) pairs the roots of an ordered query
+    are sorted by: its order by, followed by the primary key to break ties
+
+    The primary key is sorted in the same direction as the last attribute, so an
+    index scanned backwards still returns rows in order.
+    """
+    names = {name for name, _ in ast.order_by}
+    desc = ast.order_by[-1][1]
+    return ast.order_by + tuple((k, desc) for k in primary_key_attributes(ast.model) if k not in names)
+
+
+def _aggregate_query(ast):
+    """ Builds the query for an AST with aggregates at its root, which returns a
+    single row of the aggregates of the root objects that match its filters
+
+    Relationships are joined to filter on but not loaded, and the roots are
+    aggregated over the distinct primary keys that match, so that roots joined to
+    several related rows are only counted once.
+    """
+    if ast.order_by:
+        raise SyntaxError(f'Cannot order aggregates of {ast.model.__name__}')
+    root_alias = aliased(ast.model)
+    # Selecting only aggregates would otherwise leave the roots out of the FROM clause
+    query = Query(root_alias).select_from(root_alias)
+    joins = {}
+    for c in ast.children:
+        if isinstance(c, AttributeNode) and not c.children:
+            raise SyntaxError(f'Cannot select {c.as_string()} alongside aggregates of {ast.model.__name__}')
+        if not isinstance(c, AggregateNode):
+            query = _eval_ast(c, query, root_alias, tuple(), eager=False, joins=joins)
+
+    entity = root_alias
+    if any(isinstance(c, RelationshipNode) and not is_filter_only(c) for c in ast.children):
+        keys = primary_key_attributes(ast.model)
+        matches = query.with_entities(*[getattr(root_alias, k) for k in keys]).distinct().subquery()
+        entity = aliased(ast.model)
+        query = Query(entity).select_from(entity).join(matches, and_(*[getattr(entity, k) == matches.c[k] for k in keys]))
+    return query.with_entities(*[_aggregate_expression(n, entity).label(n.key) for n in aggregates(ast)])
+
+
+def build_query(ast):
+    """ Builds the SQLAlchemy query for an AST without binding it to a session
+
+    The returned query is a reusable plan: bind it with `query.with_session(session)`
+    before executing it.
+    """
     assert isinstance(ast, RootNode), \
             'Must start evaluation on RootNode!'
-    root_alias = aliased(ast.model)
-    query = session.query(root_alias).options(lazyload('*'))
+    if aggregates(ast):
+        return _aggregate_query(ast)
+    root_alias = indexed_alias(ast.model, ast.order_index)
+    query = Query(root_alias).options(lazyload('*'))
+    if ast.order_by:
+        # Roots are ordered ahead of their related objects, and ties are broken by
+        # primary key so the joined rows of each root stay together
+        query = query.order_by(*_order_clauses(root_alias, root_order_by(ast)))
+    joins = {}
     for c in ast.children:
-        query = _eval_ast(c, query, root_alias, tuple())
-    return query.all()
+        query = _eval_ast(c, query, root_alias, tuple(), joins=joins)
+    return query
+
+
+class AggregatedRoots(list):
+    """ The root objects returned for a query with aggregated relationships
+
+    aggregates is a dict of {(table name, primary key): {relationship: {aggregate: value}}}
+    for every object whose relationship is aggregated, with the primary key
+    formatted as the serializer identifies objects.
+    """
+    def __init__(self, roots, aggregates):
+        super().__init__(roots)
+        self.aggregates = aggregates
+
+
+def _aggregated_relationships(ast):
+    """ Returns the aggregated RelationshipNodes of an AST, in the order that
+    _eval_ast adds their columns to the query """
+    res = []
+    for c in ast.children:
+        if isinstance(c, RelationshipNode):
+            res.extend([c] if aggregates(c) else _aggregated_relationships(c))
+    return res
+
+
+def _collect(ast, rows):
+    """ Converts the rows of a query with aggregates into what eval_ast returns """
+    if aggregates(ast):
+        return [row._asdict() for row in rows]
+    rels = _aggregated_relationships(ast)
+    if not rels:
+        return rows
+
+    roots, seen, values = [], set(), {}
+    for row in rows:
+        if id(row[0]) not in seen:
+            seen.add(id(row[0]))
+            roots.append(row[0])
+        i = 1
+        for rel in rels:
+            parent = inspect(rel.rel).class_
+            n = len(primary_key_attributes(parent))
+            pk, i = '.'.join(str(v) for v in row[i:i + n]), i + n
+            nodes = aggregates(rel)
+            values.setdefault((parent.__tablename__, pk), {})[rel.rel.key] = \
+                {node.key: v for node, v in zip(nodes, row[i:i + len(nodes)])}
+            i += len(nodes)
+    return AggregatedRoots(roots, values)
+
+
+# Number of SQLite virtual machine instructions between deadline checks
+SQLITE_PROGRESS_INTERVAL = 1000
+
+
+@contextmanager
+def _statement_timeout(conn, deadline):
+    """ Makes the database give up on statements run on conn once deadline (a
+    time.monotonic() value) has passed, raising QueryTimeoutException
+
+    On SQLite this replaces the connection's progress handler for the duration, and
+    removes it afterwards, as sqlite3 has no way of reading back an existing handler.
+    On PostgreSQL the statements run in a savepoint that is rolled back on timeout,
+    so that the surrounding transaction stays usable, and the connection's
+    statement_timeout is restored afterwards.
+    """
+    if deadline is None:
+        yield
+        return
+
+    dialect = conn.dialect.name
+    internal = conn.execution_options(shoedog_internal=True)
+    savepoint = None
+    if dialect == 'sqlite':
+        dbapi_conn = conn.connection.connection
+        dbapi_conn.set_progress_handler(lambda: time.monotonic() > deadline, SQLITE_PROGRESS_INTERVAL)
+    elif dialect == 'postgresql':
+        saved_timeout = internal.execute('SHOW statement_timeout').scalar()
+        savepoint = conn.begin_nested()
+        # SET LOCAL only lasts until the end of the transaction
+        timeout_ms = max(1, int((deadline - time.monotonic()) * 1000))
+        internal.execute(f'SET LOCAL statement_timeout = {timeout_ms}')
+
+    try:
+        yield
+    except DBAPIError as e:
+        if savepoint is not None:
+            savepoint.rollback()
+            savepoint = None
+        if time.monotonic() > deadline:
+            raise QueryTimeoutException('Query was cancelled after exceeding its deadline') from e
+        raise
+    finally:
+        if dialect == 'sqlite':
+            dbapi_conn.set_progress_handler(None, SQLITE_PROGRESS_INTERVAL)
+        elif dialect == 'postgresql':
+            if savepoint is not None:
+                savepoint.commit()
+            internal.execute(text("SELECT set_config('statement_timeout', :value, true)"),
+                             value=saved_timeout)
+
+
+def eval_ast(ast, session, query=None, params=None, timer=None, deadline=None):
+    """ Evaluates an AST against the session, reusing a prebuilt query if provided
+
+    params are the bound values for any $variables in the AST (see bind_variables).
+    timer is an optional StageTimer that the compile, execute and hydrate stages
+    are timed with. If a deadline (a time.monotonic() value) is given, the database
+    is made to cancel the statement once it passes (via a progress handler on
+    SQLite and statement_timeout on PostgreSQL), raising QueryTimeoutException.
+
+    Returns the list of root objects (an AggregatedRoots if relationships are
+    aggregated), or a list of a single dict of aggregates if the AST aggregates
+    its roots.
+    """
+    timer = StageTimer() if timer is None else timer
+    if query is None:
+        query = build_query(ast)
+    if params:
+        query = query.params(**params)
+    if isinstance(session, scoped_session):
+        session = session()
+    query = query.with_session(session)
+
+    # Writes are flushed before timing starts, as query.all() would flush them first
+    if session.autoflush:
+        session.flush()
+    conn = session.connection(mapper=inspect(ast.model))
+
+    # The statement is timed from the cursor events of its connection: compiling
+    # happens before it is sent, and hydration (which includes fetching rows from
+    # the cursor) after it returns
+    executions = []
+
+    def before_execute(*args):
+        executions.append([time.perf_counter(), None])
+
+    def after_execute(*args):
+        executions[-1][1] = time.perf_counter()
+
+    event.listen(conn, 'before_cursor_execute', before_execute)
+    event.listen(conn, 'after_cursor_execute', after_execute)
+    start = time.perf_counter()
+    try:
+        with _statement_timeout(conn, deadline):
+            rows = query.all()
+    finally:
+        end = time.perf_counter()
+        event.remove(conn, 'before_cursor_execute', before_execute)
+        event.remove(conn, 'after_cursor_execute', after_execute)
+        if executions:
+            sent, returned = executions[-1]
+            timer.record('compile', sent - start)
+            timer.record('execute', (returned or end) - sent)
+            if returned is not None:
+                timer.record('hydrate', end - returned)
+    return _collect(ast, rows)
@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from sqlalchemy.orm import scoped_session, sessionmaker
+from shoedog.errors import ExecutorFullException
+
+
+class QueryExecutor:
+    """Runs shoedog queries on a bounded thread pool
+
+    Queries are tokenized and parsed (or fetched from the plan cache) on the
+    caller's thread, so syntax errors are raised straight away. Evaluation and
+    serialization run on one of max_workers worker threads, each with its own
+    scoped session checked out from the engine's connection pool.
+
+    If max_queue_depth is set, submitting a query while that many queries are
+    already waiting for a worker raises ExecutorFullException.
+    """
+    def __init__(self, query_factory, engine, max_workers=4, max_queue_depth=None):
+        self.query_factory = query_factory
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self._session = scoped_session(sessionmaker(bind=engine))
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shoedog')
+        self._lock = Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._peak_queue_depth = 0
+
+    def _run(self, plan, variables):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return self.query_factory._execute(plan, variables, session=self._session())
+        finally:
+            self._session.remove()
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def _submit_plan(self, plan, variables):
+        with self._lock:
+            if self.max_queue_depth is not None and self._queued >= self.max_queue_depth:
+                raise ExecutorFullException(
+                    f'{self._queued} queries are already waiting to be executed')
+            self._queued += 1
+            self._peak_queue_depth = max(self._peak_queue_depth, self._queued)
+        try:
+            return self._pool.submit(self._run, plan, variables)
+        except RuntimeError:
+            with self._lock:
+                self._queued -= 1
+            raise
+
+    def submit(self, query_string, variables=None):
+        """Returns a concurrent.futures.Future for the serialized result of the query"""
+        return self._submit_plan(self.query_factory._cached_plan(query_string), variables)
+
+    def submit_persisted(self, qid, variables=None):
+        """Returns a concurrent.futures.Future for the serialized result of a registered query"""
+        return self._submit_plan(self.query_factory._persisted_plan(qid), variables)
+
+    def run_async(self, query_string, variables=None):
+        """Returns an awaitable for the serialized result of the query
+
+        Must be called from within a running asyncio event loop
+        """
+        return asyncio.wrap_future(self.submit(query_string, variables))
+
+    def run_persisted_async(self, qid, variables=None):
+        """Returns an awaitable for the serialized result of a registered query"""
+        return asyncio.wrap_future(self.submit_persisted(qid, variables))
+
+    @property
+    def metrics(self):
+        """A snapshot of the executor's queue depth and worker utilization"""
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'queue_depth': self._queued,
+                'peak_queue_depth': self._peak_queue_depth,
+                'running': self._running,
+                'completed': self._completed,
+            }
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,62 @@
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
+# Prefixes that turn a SELECT into a request for its query plan, by dialect
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN (FORMAT JSON) ',
+}
+
+
+def _plan_rows(dialect_name, rows):
+    if dialect_name == 'sqlite':
+        return [{'id': r[0], 'parent': r[1], 'detail': r[3]} for r in rows]
+    elif dialect_name == 'postgresql':
+        return rows[0][0]
+    return rows
+
+
+def explain_query(query, session, params=None):
+    """ Returns the SQL, bound parameters and database query plan for a query built
+    by build_query, without fetching any rows
+
+    Returns:
+        dict with keys:
+            sql: the SQL statement as sent to the database
+            params: the bound parameters, as sent to the database
+            plan: the database's plan for the statement (EXPLAIN QUERY PLAN rows on
+                SQLite, EXPLAIN (FORMAT JSON) output on PostgreSQL), or None if the
+                dialect is not supported
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    statement = query.with_labels().statement
+    conn = session.connection()
+    dialect = conn.dialect
+
+    prefix = EXPLAIN_PREFIXES.get(dialect.name)
+    if prefix is None:
+        compiled = statement.compile(dialect=dialect)
+        return {'sql': str(compiled), 'params': compiled.construct_params(params), 'plan': None}
+
+    explained = []
+
+    def explain_statement(conn, cursor, sql, parameters, context, executemany):
+        # Bound parameters (including expanding ones) have been rendered by now,
+        # so the plan is for exactly the statement that would have run
+        explained.append((sql, parameters))
+        return prefix + sql, parameters
+
+    event.listen(conn, 'before_cursor_execute', explain_statement, retval=True)
+    try:
+        result = conn.execute(statement, params or {})
+    finally:
+        event.remove(conn, 'before_cursor_execute', explain_statement)
+    try:
+        # Read from the DBAPI cursor directly, since the result's columns are the plan's
+        # columns rather than the ones the statement selects
+        rows = result.cursor.fetchall()
+    finally:
+        result.close()
+    sql, sql_params = explained[-1]
+    return {'sql': sql, 'params': sql_params, 'plan': _plan_rows(dialect.name, rows)}
@@ -0,0 +1,101 @@
+import json
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import BindParameter, ColumnElement
+from sqlalchemy.types import Boolean, String, TypeDecorator
+
+# Literal lists with more values than this are bound as a single parameter
+LARGE_IN_THRESHOLD = 1000
+
+
+class _JSONList(TypeDecorator):
+    """ Binds a list as a JSON array, after processing each value as item_type """
+    impl = String
+
+    def __init__(self, item_type):
+        super().__init__()
+        self.item_type = item_type
+
+    def process_bind_param(self, value, dialect):
+        process = self.item_type.dialect_impl(dialect).bind_processor(dialect)
+        return json.dumps([process(v) for v in value] if process else list(value))
+
+
+class InList(ColumnElement):
+    """ column IN values (or NOT IN if negate), with values bound as a single
+    parameter rather than one parameter per value
+
+    This keeps statements the same size however long the list is, and below
+    SQLite's limit on the number of variables in a statement. On SQLite the
+    values are bound as a JSON array and read with json_each, on PostgreSQL they
+    are bound as an array and compared with ANY/ALL, and on other databases they
+    fall back to an expanding bind parameter.
+
+    Requires:
+        column: the column expression (or attribute) to compare
+        values: a list of values, or a BindParameter whose name the list is bound
+            to when the query is executed
+    """
+    __visit_name__ = 'shoedog_in_list'
+    type = Boolean()
+
+    def __init__(self, column, values, negate=False):
+        self.column = column.__clause_element__() if hasattr(column, '__clause_element__') else column
+        self.negate = negate
+        if isinstance(values, BindParameter):
+            self.name, self.value = values.key, None
+        else:
+            self.name, self.value = None, list(values)
+
+    def _bind(self, type_, **kwargs):
+        if self.name is not None:
+            return bindparam(self.name, type_=type_, **kwargs)
+        return bindparam(None, self.value, type_=type_, unique=True, **kwargs)
+
+    def self_group(self, against=None):
+        # Already a predicate, so it must not be compared to true on databases
+        # without a native boolean type (which keeps it from using indexes)
+        return self
+
+    def _negate(self):
+        negated = InList.__new__(InList)
+        negated.__dict__ = dict(self.__dict__, negate=not self.negate)
+        return negated
+
+    def get_children(self, **kwargs):
+        return [self.column]
+
+    def _copy_internals(self, clone=None, **kw):
+        if clone is not None:
+            self.column = clone(self.column, **kw)
+
+
+@compiles(InList)
+def _compile_expanding(element, compiler, **kw):
+    param = element._bind(element.column.type, expanding=True)
+    expr = element.column.notin_(param) if element.negate else element.column.in_(param)
+    return compiler.process(expr, **kw)
+
+
+@compiles(InList, 'sqlite')
+def _compile_sqlite(element, compiler, **kw):
+    column = compiler.process(element.column, **kw)
+    param = compiler.process(element._bind(_JSONList(element.column.type)), **kw)
+    op = 'NOT IN' if element.negate else 'IN'
+    return f'{column} {op} (SELECT value FROM json_each({param}))'
+
+
+@compiles(InList, 'postgresql')
+def _compile_postgresql(element, compiler, **kw):
+    column = compiler.process(element.column, **kw)
+    param = compiler.process(element._bind(ARRAY(element.column.type)), **kw)
+    return f'{column} != ALL({param})' if element.negate else f'{column} = ANY({param})'
+
+
+def in_list(attr, values, negate=False):
+    """ Returns attr IN values (or NOT IN if negate), binding values as a single
+    parameter if they are a variable or a literal list longer than LARGE_IN_THRESHOLD """
+    if isinstance(values, BindParameter) or len(values) > LARGE_IN_THRESHOLD:
+        return InList(attr, values, negate)
+    return attr.notin_(values) if negate else attr.in_(values)
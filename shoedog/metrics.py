@@ -0,0 +1,127 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+
+class Histogram:
+    """ Tracks the count and sum of observations, and percentiles over the most
+    recent reservoir_size observations """
+    def __init__(self, reservoir_size=1024):
+        self.count = 0
+        self.sum = 0
+        self._recent = deque(maxlen=reservoir_size)
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self._recent.append(value)
+
+    def percentile(self, p):
+        """ Returns the p-th percentile (0 <= p <= 100) of the recent observations """
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(len(recent) * p / 100))]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class Metrics:
+    """ Histograms of stage durations (in seconds) and of row and byte counts
+    for the queries a QueryFactory executes
+
+    Hooks are called as hook(stage, start_time, duration) after every timed
+    stage, where start_time is seconds since the epoch. They can be used to
+    forward spans to a tracing system.
+    """
+    def __init__(self, reservoir_size=1024):
+        self.reservoir_size = reservoir_size
+        self._stages = {}
+        self._values = {}
+        self._hooks = []
+        self._lock = Lock()
+
+    def _histogram(self, histograms, name):
+        histogram = histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(name, Histogram(self.reservoir_size))
+        return histogram
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def observe_stage(self, stage, duration):
+        self._histogram(self._stages, stage).observe(duration)
+        if self._hooks:
+            start_time = time.time() - duration
+            for hook in self._hooks:
+                hook(stage, start_time, duration)
+
+    def observe_value(self, name, value):
+        self._histogram(self._values, name).observe(value)
+
+    def snapshot(self):
+        """ Returns {'stages': {stage: summary}, 'values': {name: summary}} where each
+        summary has the count, sum, p50, p95 and p99 """
+        return {
+            'stages': {k: h.snapshot() for k, h in list(self._stages.items())},
+            'values': {k: h.snapshot() for k, h in list(self._values.items())},
+        }
+
+    def to_prometheus(self):
+        """ Renders the metrics as summaries in the Prometheus text exposition format """
+        lines = []
+
+        def summary(name, label, histograms):
+            lines.append(f'# TYPE {name} summary')
+            for key, h in sorted(histograms.items()):
+                s = h.snapshot()
+                for quantile, p in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+                    if s[p] is not None:
+                        lines.append(f'{name}{{{label}="{key}",quantile="{quantile}"}} {s[p]}')
+                lines.append(f'{name}_sum{{{label}="{key}"}} {s["sum"]}')
+                lines.append(f'{name}_count{{{label}="{key}"}} {s["count"]}')
+
+        summary('shoedog_stage_seconds', 'stage', dict(self._stages))
+        summary('shoedog_query_values', 'name', dict(self._values))
+        return '\n'.join(lines) + '\n'
+
+
+class StageTimer:
+    """ Times the stages of a single query execution with a monotonic clock
+
+    Durations are recorded into the Metrics and kept in timings, a dict of
+    {stage: total seconds} for this execution. Use as `with timer('stage'): ...`
+    """
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.timings = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, duration):
+        """ Records a duration measured outside of a with block """
+        self.timings[stage] = self.timings.get(stage, 0) + duration
+        if self.metrics is not None:
+            self.metrics.observe_stage(stage, duration)
@@ -0,0 +1,77 @@
+from sqlalchemy import Table, inspect
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.selectable import Alias
+from shoedog.ast import RelationshipNode
+
+# Hints that make a database read a table through a given index, by dialect
+INDEX_HINTS = {
+    'sqlite': 'INDEXED BY {}',
+    'mysql': 'USE INDEX ({})',
+}
+
+
+class IndexedAlias(Alias):
+    """ An alias of a table that the database is told to read through an index,
+    on databases with a hint for it (see INDEX_HINTS) """
+    __visit_name__ = 'shoedog_indexed_alias'
+
+    def _init(self, selectable, name=None, index=None):
+        super()._init(selectable, name=name)
+        self.index = index
+
+
+@compiles(IndexedAlias)
+def _compile_indexed_alias(element, compiler, **kw):
+    text = compiler.visit_alias(element, **kw)
+    hint = INDEX_HINTS.get(compiler.dialect.name)
+    if element.index == 'primary key':
+        # SQLite cannot name the index on its rowid
+        hint, index = (hint, 'PRIMARY') if compiler.dialect.name == 'mysql' else (None, None)
+    else:
+        index = compiler.preparer.quote(element.index)
+    if hint and kw.get('asfrom') and not kw.get('ashint'):
+        text += ' ' + hint.format(index)
+    return text
+
+
+def indexed_alias(model, index):
+    """ Returns an alias of model that is read through index if the database supports
+    it, or a plain alias if index is None or model is not mapped to a single table
+
+    Reading the root table through the index that matches the query's order by
+    makes it the outermost table of the join, so rows come out of the join already
+    sorted rather than being sorted after it.
+    """
+    table = inspect(model).persist_selectable
+    if index is None or not isinstance(table, Table):
+        return aliased(model)
+    return aliased(model, IndexedAlias._construct(table, index=index))
+
+
+def _order_string(order_by):
+    return ', '.join(f'{name} desc' if desc else name for name, desc in order_by)
+
+
+def sorts(ast):
+    """ Returns a list describing every sort in the query an AST evaluates to
+
+    Every entry is a dict of {path, order_by, index}, where index is the index the
+    sort is read from, or None if the rows are sorted after they are fetched.
+    Related objects are always sorted after they are joined.
+    """
+    res = []
+    if ast.order_by:
+        res.append({'path': ast.model.__name__, 'order_by': _order_string(ast.order_by),
+                    'index': ast.order_index})
+
+    def visit(node, path):
+        for c in node.children:
+            if isinstance(c, RelationshipNode):
+                child_path = f'{path}.{c.rel.key}'
+                if c.order_by:
+                    res.append({'path': child_path, 'order_by': _order_string(c.order_by), 'index': None})
+                visit(c, child_path)
+
+    visit(ast, ast.model.__name__)
+    return res
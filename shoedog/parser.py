@@ -1,5 +1,5 @@
 from shoedog.tokenizer import Toks
-from shoedog.ast import RootNode, RelationshipNode, AttributeNode, \
+from shoedog.ast import RootNode, RelationshipNode, AttributeNode, AggregateNode, \
     FilterNode, BinaryLogicNode
 from shoedog.utils import peek
 
@@ -17,6 +17,8 @@ def _tokens_to_ast(root_token, current_model, token_stream, registry):
         return _open_object_to_ast(root_token, current_model, token_stream, registry)
     elif isinstance(root_token, Toks.AttributeToken):
         return _attribute_to_ast(root_token, current_model, token_stream, registry)
+    elif isinstance(root_token, Toks.AggregateToken):
+        return AggregateNode(registry, current_model, root_token.func, root_token.attribute_name), token_stream
     else:
         assert False, f'Should never be calling _tokens_to_ast on {root_token}'
 
@@ -94,9 +96,16 @@ def _attribute_to_ast(root_token, current_model, token_stream, registry):
     assert isinstance(root_token, Toks.AttributeToken), \
         '_attribute_to_ast needs to have AttributeToken as its first token'
 
-    root = AttributeNode(registry, current_model, root_token.attribute_name)
+    filter_only = False
     next_token, token_stream = peek(token_stream)
+    if isinstance(next_token, Toks.FilterOnlyToken):
+        filter_only = True
+        next(token_stream)
+        next_token, token_stream = peek(token_stream)
+    root = AttributeNode(registry, current_model, root_token.attribute_name, filter_only=filter_only)
     if not isinstance(next_token, Toks.FilterStartToken):
+        if filter_only:
+            raise SyntaxError(f'Filter-only attribute {root.attr} has no filters')
         return root, token_stream
 
     child, token_stream = _filters_to_ast(token_stream)
@@ -122,9 +131,17 @@ def _open_object_to_ast(root_token, current_model, token_stream, registry):
     assert isinstance(root_token, Toks.OpenObjectToken), \
         '_open_object_to_ast needs to have OpenObjectToken as its first token'
 
-    root = RelationshipNode(registry, current_model, root_token.rel)
-
+    filter_only, order_by, limit = False, (), None
     token_ptr = next(token_stream)
+    if isinstance(token_ptr, Toks.FilterOnlyToken):
+        filter_only, token_ptr = True, next(token_stream)
+    if isinstance(token_ptr, Toks.OrderByToken):
+        order_by, token_ptr = token_ptr.order_by, next(token_stream)
+    if isinstance(token_ptr, Toks.LimitToken):
+        limit, token_ptr = token_ptr.limit, next(token_stream)
+    root = RelationshipNode(registry, current_model, root_token.rel, order_by=order_by, limit=limit,
+                            filter_only=filter_only)
+
     while not isinstance(token_ptr, Toks.CloseObjectToken):
         child_ast, token_stream = _tokens_to_ast(token_ptr, root.model, token_stream, registry)
         root.add_child(child_ast)
@@ -152,9 +169,12 @@ def _root_query_to_ast(root_token, token_stream, registry):
     assert isinstance(root_token, Toks.RootQueryToken), \
         '_root_query_to_ast needs to have RootQueryToken as its first token'
 
-    root = RootNode(registry, root_token.query_model)
-
+    order_by = ()
     token_ptr = next(token_stream)
+    if isinstance(token_ptr, Toks.OrderByToken):
+        order_by, token_ptr = token_ptr.order_by, next(token_stream)
+    root = RootNode(registry, root_token.query_model, order_by=order_by)
+
     while not isinstance(token_ptr, Toks.CloseObjectToken):
         child_ast, token_stream = _tokens_to_ast(token_ptr, root.model, token_stream, registry)
         root.add_child(child_ast)
@@ -0,0 +1,105 @@
+from threading import Lock
+from sqlalchemy import and_, or_, event, func, inspect
+from sqlalchemy.orm import Session
+from shoedog.writes import flushed_tables
+
+
+def partition_key(model):
+    """ Returns the name of model's primary key attribute, which rows are
+    partitioned on by default """
+    mapper = inspect(model)
+    if len(mapper.primary_key) != 1:
+        raise ValueError(f'Cannot partition {model.__name__} on a composite primary key')
+    return mapper.get_property_by_column(mapper.primary_key[0]).key
+
+
+def _is_integer(column):
+    try:
+        return column.type.python_type is int
+    except NotImplementedError:
+        return False
+
+
+def partition_bounds(session, column, partitions):
+    """ Returns up to partitions - 1 increasing values that split the rows of
+    column's table into ranges
+
+    Integer columns are split into ranges of equal width from their min and max,
+    which is cheap on an indexed column. Other columns are split into ranges with
+    the same number of rows at the column's quantiles.
+    """
+    if _is_integer(column):
+        low, high = session.query(func.min(column), func.max(column)).one()
+        if low is None:
+            return []
+        width = (high - low + 1) / partitions
+        bounds = [low + int(width * i) for i in range(1, partitions)]
+    else:
+        count = session.query(func.count(column)).scalar()
+        bounds = [session.query(column).filter(column.isnot(None)).order_by(column)
+                  .offset(count * i // partitions).limit(1).scalar()
+                  for i in range(1, partitions)]
+    # Drop duplicates (from skewed columns), keeping the order
+    return [b for i, b in enumerate(bounds) if b is not None and (i == 0 or b != bounds[i - 1])]
+
+
+class PartitionBoundsCache:
+    """ Caches the bounds of non-integer partition columns, which take a query per
+    partition to find, until an ORM session flushes a write to their table
+
+    Integer bounds are cheap, and always found afresh. Stale bounds only make the
+    partitions uneven, as partition_filters match every row whatever the bounds.
+    """
+    def __init__(self):
+        self._bounds = {}  # (table name, column name, partitions) -> (generation, bounds)
+        self._generations = {}  # table name -> number of flushes that wrote to it
+        self._lock = Lock()
+        self._installed = False
+
+    def get(self, session, column, partitions):
+        """ Returns partition_bounds(session, column, partitions), cached """
+        if _is_integer(column):
+            return partition_bounds(session, column, partitions)
+        table = column.property.columns[0].table.name
+        key = (table, column.key, partitions)
+        with self._lock:
+            generation = self._generations.get(table, 0)
+            cached = self._bounds.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        bounds = partition_bounds(session, column, partitions)
+        with self._lock:
+            self._bounds[key] = (generation, bounds)
+        return bounds
+
+    def _after_flush(self, session, flush_context):
+        with self._lock:
+            for table in flushed_tables(session):
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    def install(self):
+        """ Starts listening for writes on every SQLAlchemy session """
+        if not self._installed:
+            event.listen(Session, 'after_flush', self._after_flush)
+            self._installed = True
+
+    def uninstall(self):
+        if self._installed:
+            event.remove(Session, 'after_flush', self._after_flush)
+            self._installed = False
+
+
+def partition_filters(column, bounds):
+    """ Returns one filter per partition, in the column's order, that between them
+    match every row exactly once. Nulls are in the first partition """
+    if not bounds:
+        return [None]
+    filters = [or_(column < bounds[0], column.is_(None))]
+    filters += [and_(column >= low, column < high) for low, high in zip(bounds, bounds[1:])]
+    filters.append(column >= bounds[-1])
+    return filters
+
+
+def root_entity(query):
+    """ Returns the (aliased) entity at the root of a query built by build_query """
+    return query.column_descriptions[0]['entity']
@@ -1,20 +1,495 @@
+import json
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import Lock
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+from shoedog.ast import aggregates, fingerprint, tables
+from shoedog.cache import ResultCache
+from shoedog.executor import QueryExecutor
+from shoedog.explain import explain_query
+from shoedog.metrics import Metrics, StageTimer
+from shoedog.ordering import sorts
 from shoedog.tokenizer import tokenize
-from shoedog.eval import eval_ast
+from shoedog.eval import build_query, eval_ast, collect_variables, bind_variables, root_order_by
+from shoedog.errors import ModelNotFoundException, PersistedQueryNotFoundException, \
+    InvalidVariableException, QueryTooExpensiveException, AdmissionTimeoutException, \
+    QueryTimeoutException, SnapshotUnsupportedException, InvalidBatchItemException
 from shoedog.parser import tokens_to_ast
+from shoedog.partition import PartitionBoundsCache, partition_key, partition_filters, root_entity
 from shoedog.registry import build_registry
 from shoedog.serializer import serialize_to_json
+from shoedog.sharding import AGGREGATE_MERGES, AllShards, primary_key_attributes, merge_ordered, \
+    check_mergeable_order, merge_aggregates
+from shoedog.singleflight import SingleFlight
+from shoedog.writes import sees_uncommitted_writes, track_writes
+from shoedog.statements import count_statements
+
+
+Plan = namedtuple('Plan', ['ast', 'query', 'variables', 'fingerprint', 'shape', 'tables'])
+
+# Errors caused by the query itself, which are reported per query in a batch
+QUERY_ERRORS = (SyntaxError, ModelNotFoundException, PersistedQueryNotFoundException,
+                InvalidVariableException, QueryTooExpensiveException, AdmissionTimeoutException,
+                QueryTimeoutException, InvalidBatchItemException)
+
+# Dialects that only give a consistent snapshot across statements at this isolation level
+SNAPSHOT_ISOLATION_DIALECTS = {'postgresql', 'mysql'}
+
+
+def query_id(query_string):
+    """Returns the content hash that a query document is registered under"""
+    return sha256(query_string.encode('utf-8')).hexdigest()
 
 
 class QueryFactory():
-    """Factory class for building queries"""
-    def __init__(self, db):
+    """Factory class for building queries
+
+    Parsed and planned queries are kept in an LRU cache keyed on the query text,
+    holding at most plan_cache_size plans. Queries that take their filter values
+    from $variables share a single plan across every set of values.
+
+    result_cache is an optional ResultCache that serialized results are stored in.
+    It is installed on creation so that ORM writes invalidate its entries. Queries
+    on a session with uncommitted writes to their tables bypass the cache.
+
+    With coalesce, concurrent executions of the same query with the same variable
+    values wait on a single execution and share its serialized result. The
+    executions saved are counted in single_flight.metrics. Queries on a session
+    with uncommitted writes to their tables (including writes in a released
+    savepoint) are never coalesced.
+
+    The duration of every stage of every query (tokenize, parse, plan, compile,
+    execute, hydrate, serialize and encode) and the rows and bytes returned are
+    recorded in metrics. If a SlowQueryLog is given as slow_query_log, every
+    execution is also reported to it.
+
+    admission is an optional cost.AdmissionController that every execution has
+    to be admitted by before it reaches the database.
+
+    If a timeout (in seconds) is given, every query gets a deadline that long
+    after it starts evaluating. The database statement is cancelled once the
+    deadline passes, serialization stops, and QueryTimeoutException is raised.
+
+    The SQL statements each query emits are counted into metrics. If
+    max_statements is given, a query that emits more statements than that (for
+    e.g. because serialization triggered lazy loads) raises TooManyStatementsException.
+
+    snapshot is an optional columnar.ColumnarSnapshot. Queries it can answer are
+    evaluated in memory from it, and all others against the database.
+
+    With partitions, the root rows of every query are split into that many
+    ranges of a column (the primary key, or the one named in partition_columns,
+    a dict of {model: attribute name}). Each range is queried and serialized on
+    its own pooled connection and worker thread, and the results are concatenated
+    in the column's order. Each partition runs in its own transaction, and
+    max_statements applies to each partition. The query factory must then be
+    created within an application context. Call close() to shut down the
+    worker threads of partitioned and sharded queries.
+
+    shards is an optional dict of {shard name: engine} of databases with the
+    same schema. Queries then run concurrently on the shards that shard_router
+    (a sharding.AllShards, the default, or sharding.ShardKeyRouter) routes them
+    to, and the results of every shard are merged in root primary key order.
+
+    replicas is an optional replicas.ReplicaPool of read replicas. Queries are
+    then read on a short-lived read-only session on one of the replicas, which is
+    closed before the results are serialized, rather than on the app's session.
+
+    max_batch_workers caps the number of threads and pooled connections that a
+    single concurrent batch may use, whatever number it asks for.
+    """
+    def __init__(self, db, plan_cache_size=256, result_cache=None, coalesce=False,
+                 slow_query_log=None, admission=None, timeout=None, max_statements=None,
+                 snapshot=None, partitions=None, partition_columns=None, shards=None,
+                 shard_router=None, replicas=None, max_batch_workers=8):
         self.model_registry = build_registry(db)
+        self.max_batch_workers = max_batch_workers
         self.db = db
+        self.metrics = Metrics()
+        self.slow_query_log = slow_query_log
+        self.admission = admission
+        self.timeout = timeout
+        self.max_statements = max_statements
+        self.snapshot = snapshot
+        self.partitions = partitions
+        self.partition_columns = partition_columns or {}
+        self._partition_pool = ThreadPoolExecutor(max_workers=partitions) if partitions else None
+        self._partition_bounds = PartitionBoundsCache() if partitions else None
+        if partitions:
+            self._partition_bounds.install()
+            # Partitions may be evaluated on threads without an application context,
+            # such as the workers of executor()
+            self._partition_engine = db.engine
+            self._partition_session_factory = sessionmaker(bind=self._partition_engine)
+        self.shards = shards
+        self.shard_router = shard_router or AllShards()
+        self.replicas = replicas
+        if shards:
+            self._shard_session_factories = {name: sessionmaker(bind=bind) for name, bind in shards.items()}
+            self._shard_pool = ThreadPoolExecutor(max_workers=len(shards))
+        else:
+            self._shard_pool = None
+        self.single_flight = SingleFlight() if coalesce else None
+        if coalesce:
+            track_writes()
+        self.result_cache = result_cache
+        if result_cache is not None:
+            result_cache.install()
+        self._persisted_queries = {}
+        self._plan_cache = OrderedDict()
+        self._plan_cache_size = plan_cache_size
+        self._plan_cache_lock = Lock()
+
+    def close(self, wait=True):
+        """ Shuts down the worker threads of partitioned and sharded queries, and stops
+        listening for writes. The query factory must not be used afterwards """
+        for pool in (self._partition_pool, self._shard_pool):
+            if pool is not None:
+                pool.shutdown(wait=wait)
+        if self._partition_bounds is not None:
+            self._partition_bounds.uninstall()
+
+    def _timer(self):
+        return StageTimer(self.metrics)
+
+    def _plan(self, query_string, timer=None):
+        """Tokenizes, parses and builds the session-less query for a query string"""
+        timer = self._timer() if timer is None else timer
+        with timer('tokenize'):
+            token_list = tokenize(query_string)
+        with timer('parse'):
+            ast = tokens_to_ast(token_list, self.model_registry)
+        with timer('plan'):
+            return Plan(ast=ast, query=build_query(ast), variables=collect_variables(ast),
+                        fingerprint=fingerprint(ast), shape=fingerprint(ast, strip_literals=True),
+                        tables=tables(ast))
+
+    def _cached_plan(self, query_string, timer=None):
+        with self._plan_cache_lock:
+            plan = self._plan_cache.get(query_string)
+            if plan is not None:
+                self._plan_cache.move_to_end(query_string)
+                return plan
+        plan = self._plan(query_string, timer)
+        with self._plan_cache_lock:
+            self._plan_cache[query_string] = plan
+            while len(self._plan_cache) > self._plan_cache_size:
+                self._plan_cache.popitem(last=False)
+        return plan
+
+    def _evaluate(self, plan, variables, session=None, timer=None, pinned=False):
+        if self.admission is None:
+            return self._evaluate_admitted(plan, variables, session, timer, pinned)
+        with self.admission.admit(plan.ast):
+            return self._evaluate_admitted(plan, variables, session, timer, pinned)
+
+    def _evaluate_admitted(self, plan, variables, session=None, timer=None, pinned=False):
+        """ Evaluates a plan and returns its serialized response
 
-    def parse_query(self, query_string):
-        """Parses a string and returns a SQLAlchemy query"""
-        token_list = tokenize(query_string)
-        ast = tokens_to_ast(token_list, self.model_registry)
-        query_response = eval_ast(ast, self.db.session)
-        json_response = serialize_to_json(query_response)
+        With pinned, the query reads from session itself rather than from the
+        snapshot, replicas or partitions, so that it sees the same data as the other
+        queries on the session. Sharded queries still read from the shards.
+        """
+        timer = self._timer() if timer is None else timer
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        params = bind_variables(plan.variables, variables or {})
+        if self.snapshot is not None and not pinned:
+            try:
+                with timer('snapshot'):
+                    json_response = self.snapshot.evaluate(plan.ast, params)
+            except SnapshotUnsupportedException:
+                pass
+            else:
+                self.metrics.observe_value('rows', len(json_response))
+                return json_response
+        if self.shards:
+            return self._evaluate_sharded(plan, params, timer, deadline)
+        # Aggregates of the roots are a single row already, so are not partitioned
+        if self.partitions and not aggregates(plan.ast) and not pinned:
+            return self._evaluate_partitioned(plan, params, timer, deadline)
+        session = self.db.session if session is None else session
+
+        def fetch(session):
+            return eval_ast(plan.ast, session, query=plan.query, params=params,
+                            timer=timer, deadline=deadline)
+
+        with count_statements(self.max_statements) as statements:
+            # Replica sessions are closed as soon as the rows are fetched, so their
+            # connections are not held while serializing
+            query_response = fetch(session) if self.replicas is None or pinned else self.replicas.read(fetch)
+            with timer('serialize'):
+                json_response = serialize_to_json(query_response, deadline=deadline)
+        self.metrics.observe_value('rows', len(query_response))
+        self.metrics.observe_value('statements', statements.count)
+        self.metrics.observe_value('statement_seconds', statements.total_time)
         return json_response
+
+    def _evaluate_on_new_session(self, plan, query, params, session_factory, deadline):
+        session = session_factory()
+        timer = self._timer()
+        try:
+            with count_statements(self.max_statements) as statements:
+                query_response = eval_ast(plan.ast, session, query=query, params=params,
+                                          timer=timer, deadline=deadline)
+                with timer('serialize'):
+                    json_response = serialize_to_json(query_response, deadline=deadline)
+            return json_response, timer.timings, statements
+        finally:
+            session.close()
+
+    def _evaluate_concurrently(self, pool, plan, queries, params, timer, deadline):
+        """Evaluates each (query, session factory) pair on the pool, returning the
+        responses in order"""
+        results = list(pool.map(
+            lambda q: self._evaluate_on_new_session(plan, q[0], params, q[1], deadline), queries))
+
+        responses, statement_count, statement_seconds = [], 0, 0
+        for response, timings, statements in results:
+            responses.append(response)
+            statement_count += statements.count
+            statement_seconds += statements.total_time
+            # Report the total time spent in each stage, across every query
+            for stage, duration in timings.items():
+                timer.timings[stage] = timer.timings.get(stage, 0) + duration
+        self.metrics.observe_value('rows', sum(len(r) for r in responses))
+        self.metrics.observe_value('statements', statement_count)
+        self.metrics.observe_value('statement_seconds', statement_seconds)
+        return responses
+
+    def _evaluate_partitioned(self, plan, params, timer, deadline):
+        session_factory = self._partition_session_factory
+        key = self.partition_columns.get(plan.ast.model) or partition_key(plan.ast.model)
+        with timer('partition'):
+            session = session_factory()
+            try:
+                bounds = self._partition_bounds.get(session, getattr(plan.ast.model, key), self.partitions)
+            finally:
+                session.close()
+            filters = partition_filters(getattr(root_entity(plan.query), key), bounds)
+
+        dialect_name = self._partition_engine.dialect.name
+        if plan.ast.order_by:
+            check_mergeable_order(plan.ast.model, root_order_by(plan.ast), dialect_name)
+        queries = [(plan.query if f is None else plan.query.filter(f), session_factory) for f in filters]
+        responses = self._evaluate_concurrently(
+            self._partition_pool, plan, queries, params, timer, deadline)
+        if plan.ast.order_by:
+            return merge_ordered(responses, root_order_by(plan.ast), dialect_name)
+        return [r for response in responses for r in response]
+
+    def _evaluate_sharded(self, plan, params, timer, deadline):
+        with timer('route'):
+            names = self.shard_router.route(plan.ast, params, list(self.shards))
+        query = plan.query
+        root_aggregates = aggregates(plan.ast)
+        if root_aggregates:
+            unmergeable = {n.func for n in root_aggregates} - set(AGGREGATE_MERGES)
+            if unmergeable and len(names) > 1:
+                raise SyntaxError(f'Cannot merge {", ".join(sorted(unmergeable))} across shards')
+            queries = [(query, self._shard_session_factories[name]) for name in names]
+            responses = self._evaluate_concurrently(self._shard_pool, plan, queries, params, timer, deadline)
+            with timer('merge'):
+                return merge_aggregates(responses, root_aggregates)
+        if plan.ast.order_by:
+            order_by = root_order_by(plan.ast)
+        else:
+            # Every shard returns its roots in primary key order so they can be
+            # merged, ahead of any ordering of their related objects
+            order_by = [(k, False) for k in primary_key_attributes(plan.ast.model)]
+            root = root_entity(query)
+            query = query.order_by(None).order_by(*[getattr(root, k) for k, _ in order_by],
+                                                  *(query._order_by or ()))
+        # The results of a single shard are already in order
+        dialect_name = self.shards[names[0]].dialect.name if names else None
+        if len(names) > 1:
+            check_mergeable_order(plan.ast.model, order_by, dialect_name)
+        queries = [(query, self._shard_session_factories[name]) for name in names]
+        responses = self._evaluate_concurrently(self._shard_pool, plan, queries, params, timer, deadline)
+        with timer('merge'):
+            return merge_ordered(responses, order_by, dialect_name)
+
+    def _observe(self, plan, timer, rows, session):
+        if self.slow_query_log is None:
+            return
+        session = self.db.session if session is None else session
+
+        def compile_sql():
+            return str(plan.query.statement.compile(dialect=session.get_bind().dialect))
+
+        self.slow_query_log.observe(plan.shape, plan.ast, timer.timings, rows, compile_sql)
+
+    def _execute_json(self, plan, variables, session=None, timer=None, pinned=False):
+        """Executes a plan and returns the response encoded as JSON bytes"""
+        timer = self._timer() if timer is None else timer
+
+        def execute():
+            json_response = self._evaluate(plan, variables, session, timer, pinned)
+            with timer('encode'):
+                res = json.dumps(json_response).encode('utf-8')
+            self.metrics.observe_value('response_bytes', len(res))
+            self._observe(plan, timer, len(json_response), session)
+            return res
+
+        def coalesced_execute():
+            key = ResultCache.key(plan.fingerprint, variables)
+            return self.single_flight.do(key, execute)
+
+        if sees_uncommitted_writes(self.db.session if session is None else session, plan.tables):
+            # Neither read from nor shared with other sessions until the writes are committed
+            return execute()
+        fn = coalesced_execute if self.single_flight is not None else execute
+        if self.result_cache is None:
+            return fn()
+        return self.result_cache.get_or_execute(plan.fingerprint, variables, plan.tables, fn)
+
+    def _execute(self, plan, variables, session=None, timer=None, pinned=False):
+        if self.result_cache is None and self.single_flight is None:
+            timer = self._timer() if timer is None else timer
+            json_response = self._evaluate(plan, variables, session, timer, pinned)
+            self._observe(plan, timer, len(json_response), session)
+            return json_response
+        # Results are shared between callers as serialized bytes, so each caller
+        # gets its own copy
+        return json.loads(self._execute_json(plan, variables, session, timer, pinned))
+
+    def register_query(self, query_string):
+        """Parses and plans a query document ahead of time
+
+        Returns the id (content hash) that the query can be executed with
+        """
+        qid = query_id(query_string)
+        if qid not in self._persisted_queries:
+            self._persisted_queries[qid] = self._plan(query_string)
+        return qid
+
+    def register_queries_from_file(self, path):
+        """Registers every query document in a JSON file containing a list of query strings
+
+        Returns the list of ids, in the order the documents appear in the file
+        """
+        with open(path) as f:
+            query_strings = json.load(f)
+        return [self.register_query(q) for q in query_strings]
+
+    def parse_query(self, query_string, variables=None):
+        """Parses a string and returns a SQLAlchemy query
+
+        variables is a dict of values for the $variables used in the query's filters
+        """
+        timer = self._timer()
+        return self._execute(self._cached_plan(query_string, timer), variables, timer=timer)
+
+    def parse_query_json(self, query_string, variables=None):
+        """Like parse_query, but returns the response encoded as JSON bytes"""
+        timer = self._timer()
+        return self._execute_json(self._cached_plan(query_string, timer), variables, timer=timer)
+
+    def _explain(self, plan, variables):
+        params = bind_variables(plan.variables, variables or {})
+        return dict(explain_query(plan.query, self.db.session, params), sorts=sorts(plan.ast))
+
+    def explain(self, query_string, variables=None):
+        """Returns the SQL, bound parameters and database plan for a query without
+        fetching any rows (see explain.explain_query), along with its sorts (see
+        ordering.sorts). Sorts with no index are done after rows are fetched"""
+        return self._explain(self._cached_plan(query_string), variables)
+
+    def _persisted_plan(self, qid):
+        # Ids from a JSON body may be of any type, and lists and objects cannot be looked up
+        plan = self._persisted_queries.get(qid) if isinstance(qid, str) else None
+        if plan is None:
+            raise PersistedQueryNotFoundException(f'Could not find persisted query with id {qid}')
+        return plan
+
+    def parse_persisted_query(self, qid, variables=None):
+        """Executes a previously registered query, skipping tokenizing and parsing"""
+        return self._execute(self._persisted_plan(qid), variables)
+
+    def explain_persisted(self, qid, variables=None):
+        """Like explain, for a registered query"""
+        return self._explain(self._persisted_plan(qid), variables)
+
+    def parse_persisted_query_json(self, qid, variables=None):
+        """Like parse_persisted_query, but returns the response encoded as JSON bytes"""
+        return self._execute_json(self._persisted_plan(qid), variables)
+
+    def executor(self, max_workers=4, max_queue_depth=None):
+        """Returns a QueryExecutor that runs this factory's queries on a bounded thread pool
+
+        Worker sessions are checked out from the db's engine, so this must be called
+        from within an application context
+        """
+        return QueryExecutor(self, self.db.engine, max_workers=max_workers,
+                             max_queue_depth=max_queue_depth)
+
+    def _batch_item_plan(self, item):
+        if isinstance(item, str):
+            return self._cached_plan(item), None
+        if not isinstance(item, dict) or not isinstance(item.get('id', item.get('query')), str) or \
+                not isinstance(item.get('variables', {}), (dict, type(None))):
+            raise InvalidBatchItemException(
+                'Batch items must be a query document, or an object with a "query" or an "id" '
+                'and optional "variables"')
+        if 'id' in item:
+            return self._persisted_plan(item['id']), item.get('variables')
+        return self._cached_plan(item['query']), item.get('variables')
+
+    def _run_batch_item(self, item, session, savepoint=False):
+        """Runs a batch item, returning its error rather than raising it
+
+        With savepoint, the item runs on session itself (see _evaluate_admitted), in a
+        savepoint that is rolled back if the database fails it, so that the items
+        after it can still use the session"""
+        try:
+            plan, variables = self._batch_item_plan(item)
+        except QUERY_ERRORS as e:
+            return {'error': str(e)}
+        nested = session.begin_nested() if savepoint else None
+        try:
+            data = self._execute(plan, variables, session=session, pinned=savepoint)
+        except QUERY_ERRORS + (DBAPIError,) as e:
+            if nested is not None:
+                nested.rollback()
+            return {'error': str(e)}
+        if nested is not None:
+            nested.commit()
+        return {'data': data}
+
+    def _run_batch_item_on_new_session(self, item, session_factory):
+        session = session_factory()
+        try:
+            return self._run_batch_item(item, session)
+        finally:
+            session.close()
+
+    def parse_batch(self, items, max_workers=None):
+        """Executes a list of queries and returns their results in order
+
+        Each item is a query document, or a dict of the form {"query": ..., "variables": ...}
+        or {"id": ..., "variables": ...}. Each result is {"data": [...]} or, if the query
+        was invalid, {"error": <message>}.
+
+        By default every query runs on the same session, in one transaction and therefore
+        one consistent snapshot, with each query in a savepoint so that a query the database
+        fails does not fail the ones after it. The queries read from that session even if the
+        query factory has a snapshot, replicas or partitions, but sharded queries still read
+        from the shards, each on its own session, so they do not share the snapshot. If
+        max_workers is given, independent queries instead run concurrently on up to
+        max_workers (at most max_batch_workers) pooled connections, each in its own transaction.
+        """
+        if max_workers is not None and max_workers < 1:
+            raise ValueError(f'max_workers must be at least 1, not {max_workers}')
+        if max_workers:
+            session_factory = sessionmaker(bind=self.db.engine)
+            with ThreadPoolExecutor(max_workers=min(max_workers, self.max_batch_workers)) as pool:
+                return list(pool.map(
+                    lambda item: self._run_batch_item_on_new_session(item, session_factory), items))
+
+        session = self.db.session()
+        if session.get_bind().dialect.name in SNAPSHOT_ISOLATION_DIALECTS:
+            # Only takes effect if the request has not already started a transaction
+            session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        return [self._run_batch_item(item, session, savepoint=True) for item in items]
@@ -29,6 +29,38 @@ class ModelRegistry:
             raise ModelNotFoundException(f'Could not find relationship {rel}')
         return model
 
+    def get_index_for_order(self, model, order_by):
+        """ Returns the name of an index on model's table that returns its rows in
+        the order of order_by followed by the primary key, or None if there is none
+
+        An index matches if its columns are exactly the columns in order_by, or
+        begin with them followed by the primary key. Indexes can be scanned in
+        either direction, so every column in order_by must be sorted in the same
+        direction. This assumes index entries are ordered by primary key after
+        the index's columns (as they are on SQLite and MySQL), and an ordering of
+        the primary key itself is matched by 'primary key'.
+
+        Requires:
+            model: the SQLAlchemy model
+            order_by: tuple of (attribute name, descending) pairs
+        """
+        if len({desc for _, desc in order_by}) > 1:
+            return None
+        mapper = inspect(model)
+        columns = [mapper.get_property(name).columns[0].name for name, _ in order_by]
+        primary_key = [c.name for c in mapper.primary_key]
+        if columns == primary_key[:len(columns)]:
+            return 'primary key'
+        if columns[-len(primary_key):] == primary_key:
+            # The primary key already breaks ties
+            columns = columns[:-len(primary_key)]
+        for index in sorted(mapper.local_table.indexes, key=lambda i: i.name):
+            index_columns = [c.name for c in index.columns]
+            if index_columns == columns or \
+                    index_columns[:len(columns) + len(primary_key)] == columns + primary_key:
+                return index.name
+        return None
+
 
 def build_registry(db):
     """Builds a registry object representing a collection of
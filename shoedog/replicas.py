@@ -0,0 +1,137 @@
+import time
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+from sqlalchemy.exc import DBAPIError, DisconnectionError
+from sqlalchemy.orm import Session
+
+# Statements that make the current transaction read-only, by dialect
+READ_ONLY_STATEMENTS = {
+    'sqlite': ('PRAGMA query_only = ON', 'PRAGMA query_only = OFF'),
+    'postgresql': ('SET TRANSACTION READ ONLY', None),
+}
+
+
+@contextmanager
+def read_only_session(bind):
+    """ Yields a session on bind that cannot write, closing it (and so releasing
+    its connection back to the pool) when the with block exits
+
+    Writes are rejected by the database on SQLite (with PRAGMA query_only, which
+    is reset before the connection is released) and PostgreSQL (with SET
+    TRANSACTION READ ONLY). On other databases the session is not flushed, but
+    statements that write are not rejected.
+    """
+    session = Session(bind=bind, autoflush=False)
+    conn = session.connection()
+    enable, disable = READ_ONLY_STATEMENTS.get(conn.dialect.name, (None, None))
+    try:
+        if enable:
+            conn.execution_options(shoedog_internal=True).execute(enable)
+        yield session
+    finally:
+        try:
+            if disable:
+                conn.execution_options(shoedog_internal=True).execute(disable)
+        finally:
+            session.close()
+
+
+def _is_disconnect(error):
+    return isinstance(error, DisconnectionError) or getattr(error, 'connection_invalidated', False)
+
+
+class ReplicaPool:
+    """ Routes reads to a set of replica engines
+
+    Each read goes to a healthy replica, chosen in turn with the round_robin
+    policy or as the one with the fewest reads in flight with least_busy. A
+    replica that cannot be connected to, or whose connection is lost during the
+    read, is marked unhealthy and skipped for retry_after seconds, and the read
+    is retried on another replica. Any other error is raised straight away. Once every replica has failed the
+    read goes to the fallback engine (for e.g. the primary) if there is one, and
+    otherwise to the unhealthy replicas anyway.
+    """
+    def __init__(self, engines, policy='round_robin', fallback=None, retry_after=30):
+        if policy not in ('round_robin', 'least_busy'):
+            raise ValueError(f'Unknown replica policy {policy}')
+        self.engines = list(engines)
+        self.policy = policy
+        self.fallback = fallback
+        self.retry_after = retry_after
+        self._turn = count()
+        self._in_flight = {e: 0 for e in self.engines}
+        self._reads = {e: 0 for e in self.engines}
+        self._unhealthy_until = {}
+        self._lock = Lock()
+
+    def _is_healthy(self, engine, now):
+        return self._unhealthy_until.get(engine, 0) <= now
+
+    def mark_unhealthy(self, engine):
+        with self._lock:
+            self._unhealthy_until[engine] = time.monotonic() + self.retry_after
+
+    def _choose(self, tried):
+        """ Returns the engine to read from next, which must not be in tried """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.engines if e not in tried and self._is_healthy(e, now)]
+            if not candidates:
+                if self.fallback is not None and self.fallback not in tried:
+                    return self.fallback
+                candidates = [e for e in self.engines if e not in tried]
+            turn = next(self._turn)
+            if self.policy == 'least_busy':
+                # Break ties in turn, so idle replicas share the load
+                fewest = min(self._in_flight[e] for e in candidates)
+                candidates = [e for e in candidates if self._in_flight[e] == fewest]
+            engine = candidates[turn % len(candidates)]
+            self._in_flight[engine] += 1
+            self._reads[engine] += 1
+            return engine
+
+    def _release(self, engine):
+        if engine in self._in_flight:
+            with self._lock:
+                self._in_flight[engine] -= 1
+
+    def _can_retry(self, tried):
+        return any(e not in tried for e in self.engines) or \
+            (self.fallback is not None and self.fallback not in tried)
+
+    def read(self, fn):
+        """ Calls fn(session) with a read-only session on a replica and returns its
+        result. The session is closed as soon as fn returns, so fn must load
+        everything it needs """
+        tried = set()
+        while True:
+            engine = self._choose(tried)
+            tried.add(engine)
+            connected = False
+            try:
+                with read_only_session(engine) as session:
+                    connected = True
+                    return fn(session)
+            except (DBAPIError, DisconnectionError) as e:
+                # Errors from the query itself (a missing column, a lock timeout, a
+                # cancelled statement) would fail the same way on every replica
+                if connected and not _is_disconnect(e):
+                    raise
+                if engine is not self.fallback:
+                    self.mark_unhealthy(engine)
+                if not self._can_retry(tried):
+                    raise
+            finally:
+                self._release(engine)
+
+    def stats(self):
+        """ Returns a list of {url, in_flight, reads, healthy} for every replica """
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'url': str(e.url),
+                'in_flight': self._in_flight[e],
+                'reads': self._reads[e],
+                'healthy': self._is_healthy(e, now),
+            } for e in self.engines]
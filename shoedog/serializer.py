@@ -2,9 +2,14 @@ from datetime import datetime, date, time
 import decimal
 import uuid
 from enum import Enum
+from time import monotonic
 
 from sqlalchemy import inspect
 from flask_sqlalchemy.model import Model
+from shoedog.errors import QueryTimeoutException
+
+# Number of root objects serialized between deadline checks
+DEADLINE_CHECK_INTERVAL = 100
 
 
 def _get_primary_keys(model_obj):
@@ -16,7 +21,29 @@ def _get_primary_keys(model_obj):
     return '.'.join([str(key) for key in ident]) if ident else None
 
 
-def serialize_to_json(query_result):
+def serialize_scalar(val):
+    """Converts the value of a scalar (non-relationship) attribute to a JSON-compatible value"""
+    if isinstance(val, (datetime, date, time)):
+        return val.isoformat()
+    elif isinstance(val, uuid.UUID):
+        return str(val)
+    elif isinstance(val, decimal.Decimal):
+        return float(val)
+    elif isinstance(val, Enum):
+        return val.value
+    return val
+
+
+def serialize_to_json(query_result, deadline=None):
+    """Serializes the result of eval_ast into JSON-compatible dicts
+
+    Aggregates of the roots are serialized as they are, and aggregates of
+    relationships (see eval.AggregatedRoots) in place of the relationship.
+    If a deadline (a time.monotonic() value) is given, it is checked between
+    batches of root objects and QueryTimeoutException is raised once it has passed
+    """
+    aggregates = getattr(query_result, 'aggregates', {})
+
     def m_to_d(obj, objects_in_load_path):
         """Converts a SQLAlchemy model to a python dict recursively
 
@@ -29,23 +56,12 @@ def serialize_to_json(query_result):
         relationship_fields = set(obj_inspection.mapper.relationships.keys())
         non_relationship_fields = {x for x in obj_inspection.attrs.keys() if x not in relationship_fields}
         fields = {}
-        new_path = objects_in_load_path.union({(obj.__tablename__, _get_primary_keys(obj))})
+        obj_key = (obj.__tablename__, _get_primary_keys(obj))
+        new_path = objects_in_load_path.union({obj_key})
 
         # Serialize all non-relationship (scalar) attributes in object if non-empty
         for field in non_relationship_fields:
-            val = obj.__getattribute__(field)
-            if isinstance(val, (datetime, date, time)):
-                field_value = val.isoformat()
-            elif isinstance(val, uuid.UUID):
-                field_value = str(val)
-            elif isinstance(val, decimal.Decimal):
-                field_value = float(val)
-            elif isinstance(val, Enum):
-                field_value = val.value
-            else:
-                field_value = val
-
-            fields[field] = field_value
+            fields[field] = serialize_scalar(obj.__getattribute__(field))
 
         # Serialize relationships in object by expanding the fields
         for field in relationship_fields:
@@ -76,6 +92,22 @@ def serialize_to_json(query_result):
             else:
                 fields[field] = m_to_d(val, new_path)
 
+        for field, values in aggregates.get(obj_key, {}).items():
+            fields[field] = {k: serialize_scalar(v) for k, v in values.items()}
+
         return fields
 
-    return [m_to_d(obj, set()) for obj in query_result]
+    def to_d(obj):
+        if isinstance(obj, dict):
+            return {k: serialize_scalar(v) for k, v in obj.items()}
+        return m_to_d(obj, set())
+
+    if deadline is None:
+        return [to_d(obj) for obj in query_result]
+
+    res = []
+    for i, obj in enumerate(query_result):
+        if i % DEADLINE_CHECK_INTERVAL == 0 and monotonic() > deadline:
+            raise QueryTimeoutException('Query was cancelled after exceeding its deadline')
+        res.append(to_d(obj))
+    return res
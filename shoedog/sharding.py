@@ -0,0 +1,126 @@
+import heapq
+from sqlalchemy import inspect
+from shoedog.ast import AttributeNode, BinaryLogicNode, FilterNode
+from shoedog.tokenizer import Variable, variable_bind_key
+
+
+class AllShards:
+    """ Routes every query to every shard """
+    def route(self, ast, params, shards):
+        return list(shards)
+
+
+def _filter_values(ast, params):
+    """ Returns the set of values a tree of filters restricts its attribute to,
+    or None if it can match other values too """
+    if isinstance(ast, BinaryLogicNode):
+        left, right = _filter_values(ast.left, params), _filter_values(ast.right, params)
+        if ast.op == 'and':
+            return right if left is None else left if right is None else left & right
+        return None if left is None or right is None else left | right
+    elif isinstance(ast, FilterNode) and ast.subject == '*' and ast.op in ('==', 'in'):
+        obj = params[variable_bind_key(ast.obj.name)] if isinstance(ast.obj, Variable) else ast.obj
+        return set(obj) if ast.op == 'in' else {obj}
+    return None
+
+
+class ShardKeyRouter:
+    """ Routes queries that filter their root model's shard key to specific values
+    to only the shards holding those values, and all other queries to every shard
+
+    Requires:
+        shard_keys: dict of {model: name of its shard key attribute}
+        shard_for_value: function of (model, value) returning the name of the
+            shard that holds the model's rows with that shard key value
+    """
+    def __init__(self, shard_keys, shard_for_value):
+        self.shard_keys = shard_keys
+        self.shard_for_value = shard_for_value
+
+    def route(self, ast, params, shards):
+        key = self.shard_keys.get(ast.model)
+        if key is None:
+            return list(shards)
+        values = None
+        # Filters on separate lines are and-ed together
+        for c in ast.children:
+            if isinstance(c, AttributeNode) and c.attr.key == key and c.children:
+                child_values = _filter_values(c.children[0], params)
+                if child_values is not None:
+                    values = child_values if values is None else values & child_values
+        if values is None:
+            return list(shards)
+        names = {self.shard_for_value(ast.model, v) for v in values}
+        return [name for name in shards if name in names]
+
+
+def primary_key_attributes(model):
+    """ Returns the names of model's primary key attributes """
+    mapper = inspect(model)
+    return [mapper.get_property_by_column(c).key for c in mapper.primary_key]
+
+
+class _Descending:
+    """ Reverses the order of a sort key """
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+# Dialects that sort nulls after every other value in ascending order, rather than before
+NULLS_LAST_DIALECTS = {'postgresql', 'oracle'}
+# Dialects whose default collation orders strings by code point, as Python compares them
+CODE_POINT_COLLATION_DIALECTS = {'sqlite'}
+
+
+def _sort_key(value, descending, nulls_last):
+    # Nulls sort where the database puts them: before every other value on SQLite and
+    # MySQL, and after every other value on PostgreSQL
+    key = (value is None, value) if nulls_last else (value is not None, value)
+    return _Descending(key) if descending else key
+
+
+def check_mergeable_order(model, order_by, dialect_name):
+    """ Raises SyntaxError unless rows of model that a database of dialect_name
+    returned ordered by order_by, a list of (attribute name, descending) pairs, can
+    be merged in Python into the same order. Strings can only be merged on
+    databases that collate them by code point """
+    if dialect_name in CODE_POINT_COLLATION_DIALECTS:
+        return
+    for name, _ in order_by:
+        try:
+            python_type = getattr(model, name).type.python_type
+        except NotImplementedError:
+            python_type = None
+        if python_type is None or issubclass(python_type, str):
+            raise SyntaxError(f'Cannot merge {model.__name__} ordered by {name} on {dialect_name}, '
+                              f'which may not collate it the way Python compares it')
+
+
+def merge_ordered(responses, order_by, dialect_name):
+    """ Merges lists of serialized root objects that are each ordered by order_by,
+    a list of (attribute name, descending) pairs, on a database of dialect_name into
+    one list ordered by order_by (see check_mergeable_order) """
+    nulls_last = dialect_name in NULLS_LAST_DIALECTS
+    return list(heapq.merge(*responses, key=lambda r: tuple(_sort_key(r[k], d, nulls_last)
+                                                            for k, d in order_by)))
+
+
+# How the aggregates of the roots on every shard combine into the aggregate across shards
+AGGREGATE_MERGES = {'count': sum, 'sum': sum, 'min': min, 'max': max}
+
+
+def merge_aggregates(responses, nodes):
+    """ Merges the root aggregates returned by every shard (each a list of a single
+    dict of aggregates) for the AggregateNodes nodes. Nulls are ignored, as they
+    are by the aggregates themselves """
+    merged = {}
+    for node in nodes:
+        values = [r[0][node.key] for r in responses if r[0][node.key] is not None]
+        merged[node.key] = AGGREGATE_MERGES[node.func](values) if values or node.func == 'count' else None
+    return [merged]
@@ -0,0 +1,53 @@
+from threading import Event, Lock
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls that share a key into a single execution
+
+    The first caller for a key runs the function; callers arriving while it is
+    still running wait for it and share its result (or exception).
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.executions = 0
+        self.saved = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.saved += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self.executions += 1
+            call.done.set()
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return {'executions': self.executions, 'saved': self.saved, 'in_flight': len(self._calls)}
@@ -0,0 +1,93 @@
+import time
+from collections import deque, namedtuple
+from threading import Lock
+from shoedog.ast import AttributeNode, exists_filters
+from shoedog.eval import relationship_blocks
+
+
+SlowQueryRecord = namedtuple('SlowQueryRecord', [
+    'fingerprint',  # literal-stripped fingerprint of the AST
+    'sql',  # SQL compiled from the query built in eval_ast
+    'duration',  # total seconds across every stage
+    'timings',  # dict of {stage: seconds}
+    'rows',  # number of root entities returned
+    'joins',  # number of joins (one per joined relationship)
+    'exists_subqueries',  # number of EXISTS subqueries (one per any/all filter and filter-only relationship)
+    'timestamp',  # seconds since the epoch when the query finished
+])
+
+
+def ast_stats(ast):
+    """ Returns (joins, exists_subqueries) for the query an AST evaluates to. Blocks
+    that share the join of an earlier block are not joined again, and filter-only
+    relationships are EXISTS subqueries rather than joins """
+    joins, exists_subqueries = 0, 0
+    nodes = [ast]
+    for node, _, how in relationship_blocks(ast):
+        nodes.append(node)
+        if how == 'join':
+            joins += 1
+        elif how == 'exists':
+            exists_subqueries += 1
+    exists_subqueries += sum(exists_filters(c) for n in nodes for c in n.children if isinstance(c, AttributeNode))
+    return joins, exists_subqueries
+
+
+class SlowQueryLog:
+    """ Records queries that take longer than threshold seconds
+
+    The last capacity slow queries are kept in a ring buffer (see records), and
+    each one is also passed to sink, if given, as a SlowQueryRecord. The total
+    time of every query, slow or not, is aggregated per literal-stripped
+    fingerprint so the query shapes that cost the most can be found with
+    top_fingerprints.
+    """
+    def __init__(self, threshold=1.0, capacity=100, sink=None):
+        self.threshold = threshold
+        self.sink = sink
+        self._records = deque(maxlen=capacity)
+        self._totals = {}
+        self._lock = Lock()
+
+    def observe(self, fingerprint, ast, timings, rows, compile_sql):
+        """ Records an execution, calling compile_sql() for the SQL only if it was slow """
+        duration = sum(timings.values())
+        with self._lock:
+            totals = self._totals.setdefault(
+                fingerprint, {'fingerprint': fingerprint, 'count': 0, 'total_time': 0, 'max_time': 0})
+            totals['count'] += 1
+            totals['total_time'] += duration
+            totals['max_time'] = max(totals['max_time'], duration)
+        if duration < self.threshold:
+            return None
+
+        joins, exists_subqueries = ast_stats(ast)
+        record = SlowQueryRecord(
+            fingerprint=fingerprint,
+            sql=compile_sql(),
+            duration=duration,
+            timings=dict(timings),
+            rows=rows,
+            joins=joins,
+            exists_subqueries=exists_subqueries,
+            timestamp=time.time(),
+        )
+        with self._lock:
+            self._records.append(record)
+            # Keep the SQL of the latest slow execution of each shape for the report
+            totals['sql'] = record.sql
+        if self.sink is not None:
+            self.sink(record)
+        return record
+
+    def records(self):
+        """ Returns the slow queries in the ring buffer, oldest first """
+        with self._lock:
+            return list(self._records)
+
+    def top_fingerprints(self, n=10):
+        """ Returns the n query shapes with the highest total time, as dicts of
+        fingerprint, count, total_time, max_time and (if it was ever slow) sql """
+        with self._lock:
+            totals = [dict(t) for t in self._totals.values()]
+        return sorted(totals, key=lambda t: t['total_time'], reverse=True)[:n]
@@ -0,0 +1,88 @@
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from shoedog.errors import TooManyStatementsException
+
+_local = threading.local()
+
+
+def _active_counters():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    return counters
+
+
+def _is_counted(context):
+    # Statements shoedog issues for its own bookkeeping (e.g. setting timeouts) are not counted
+    return context is None or not context.execution_options.get('shoedog_internal')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active_counters() and _is_counted(context):
+        conn.info.setdefault('shoedog_statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counters = _active_counters()
+    if counters and _is_counted(context):
+        duration = time.perf_counter() - conn.info['shoedog_statement_start'].pop()
+        for counter in counters:
+            counter.statements.append((statement, duration))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute, so its start time is
+    # dropped here rather than being paired with the connection's next statement
+    starts = exception_context.connection.info.get('shoedog_statement_start') \
+        if exception_context.connection is not None else None
+    if starts and _active_counters() and _is_counted(exception_context.execution_context):
+        starts.pop()
+
+
+class StatementCounter:
+    """ The SQL statements emitted on the current thread while the counter is active
+
+    statements is a list of (sql, seconds spent executing it) tuples
+    """
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def total_time(self):
+        return sum(duration for _, duration in self.statements)
+
+
+@contextmanager
+def count_statements(max_statements=None):
+    """ Counts the SQL statements emitted on this thread within the with block
+
+    Statements are counted on every engine, so this catches any extra SELECTs a
+    query triggers (for e.g. from lazy loads while serializing). If max_statements
+    is given and more statements than that were emitted, TooManyStatementsException
+    is raised when the block exits.
+
+    Yields:
+        StatementCounter
+    """
+    counter = StatementCounter()
+    counters = _active_counters()
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+    if max_statements is not None and counter.count > max_statements:
+        statements = '\n'.join(sql for sql, _ in counter.statements)
+        raise TooManyStatementsException(
+            f'Expected at most {max_statements} statements but {counter.count} were emitted:\n'
+            f'{statements}')
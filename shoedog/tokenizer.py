@@ -1,14 +1,19 @@
 import re
 from collections import namedtuple
-from shoedog.consts import array_only_selectors, valid_ops, valid_selectors, integer_only_ops, array_only_ops
+from shoedog.consts import array_only_selectors, valid_ops, valid_selectors, integer_only_ops, array_only_ops, \
+    aggregate_functions
 
 
 class Toks:
     RootQueryToken = namedtuple('RootQueryToken', ['query_model'])
     CastToken = namedtuple('CastToken', ['cast_class'])
+    OrderByToken = namedtuple('OrderByToken', ['order_by'])
+    LimitToken = namedtuple('LimitToken', ['limit'])
     OpenObjectToken = namedtuple('OpenObjectToken', ['rel'])
     CloseObjectToken = namedtuple('CloseObjectToken', [])
     AttributeToken = namedtuple('AttributeToken', ['attribute_name'])
+    AggregateToken = namedtuple('AggregateToken', ['func', 'attribute_name'])
+    FilterOnlyToken = namedtuple('FilterOnlyToken', [])
     FilterBoolToken = namedtuple('FilterBoolToken', ['sel', 'op', 'val'])
     FilterBinaryLogicToken = namedtuple('FilterBinaryLogicToken', ['logic_op'])
     FilterOpenParanToken = namedtuple('FilterOpenParanToken', [])
@@ -17,18 +22,37 @@ class Toks:
     FilterEndToken = namedtuple('FilterEndToken', [])
 
 
+Variable = namedtuple('Variable', ['name'])
+
+
+def variable_bind_key(name):
+    """ Returns the key of the bound parameter for the variable $name, which is
+    namespaced so it cannot collide with the names SQLAlchemy gives its own """
+    return 'shoedog_var_' + name
+
+
 class LineToks:
-    RootQueryLine = namedtuple('RootQueryLine', ['query_model'])
-    OpenObjectLine = namedtuple('OpenObjectLine', ['rel', 'cast_class'])
-    AttributeLine = namedtuple('AttributeLine', ['attribute_name', 'filters'])
+    RootQueryLine = namedtuple('RootQueryLine', ['query_model', 'order_by'])
+    OpenObjectLine = namedtuple('OpenObjectLine', ['filter_only', 'rel', 'cast_class', 'order_by', 'limit'])
+    AttributeLine = namedtuple('AttributeLine', ['filter_only', 'attribute_name', 'filters'])
+    AggregateLine = namedtuple('AggregateLine', ['func', 'attribute_name'])
     CloseObjectLine = namedtuple('CloseObjectLine', [])
 
 
+order_by_regex = r'\w+( (asc|desc))?(, \w+( (asc|desc))?)*'
+# Marks a relationship or attribute as only filtered on, and not returned
+filter_only_regex = r'(?P<filter_only>filter (?=\w))?'
+
 regexes = {
-    LineToks.RootQueryLine: re.compile(r'^query (?P<query_model>[A-Za-z]\w*) {$'),
-    LineToks.OpenObjectLine: re.compile(r'^(?P<rel>[A-Za-z]\w*)( \((?P<cast_class>[A-Z]\w*)\))? {$'),
+    LineToks.RootQueryLine: re.compile(
+        rf'^query (?P<query_model>[A-Za-z]\w*)( order by (?P<order_by>{order_by_regex}))? {{$'),
+    LineToks.OpenObjectLine: re.compile(
+        rf'^{filter_only_regex}(?P<rel>[A-Za-z]\w*)( \((?P<cast_class>[A-Z]\w*)\))?'
+        rf'( order by (?P<order_by>{order_by_regex}))?( limit (?P<limit>[0-9]+))? {{$'),
     LineToks.CloseObjectLine: re.compile(r'^}$'),
-    LineToks.AttributeLine: re.compile(r"^(?P<attribute_name>\w*)[\s]?(?P<filters>\[.+\])?$")
+    LineToks.AttributeLine: re.compile(rf"^{filter_only_regex}(?P<attribute_name>\w*)[\s]?(?P<filters>\[.+\])?$"),
+    LineToks.AggregateLine: re.compile(
+        rf'^(?P<func>{"|".join(sorted(aggregate_functions))})\((?P<attribute_name>\w*)\)$'),
 }
 
 
@@ -49,6 +73,10 @@ def _convert_and_validate_type(obj):
         if len(obj) < 2 or obj[0] != '[' or obj[-1] != ']':
             raise SyntaxError(f'Invalid filter object {obj} - is this a list?')
         obj = [_convert_and_validate_type(list_obj.strip()) for list_obj in obj[1:-1].split(',')]
+    elif obj[0] == '$':
+        if not re.match(r'^\$[A-Za-z_]\w*$', obj):
+            raise SyntaxError(f'Invalid filter variable {obj}')
+        obj = Variable(name=obj[1:])
     elif obj == 'true':
         obj = True
     elif obj == 'false':
@@ -57,7 +85,7 @@ def _convert_and_validate_type(obj):
         try:
             obj = int(obj)
         except ValueError:
-            raise SyntaxError(f'Invalid filter object {obj} - must be one of \'string\', <int>, true or false')
+            raise SyntaxError(f'Invalid filter object {obj} - must be one of \'string\', <int>, true, false or $variable')
 
     if isinstance(obj, list) and len({type(o) for o in obj}) != 1:
         raise SyntaxError(f'Multiple types detected for obj {obj}')
@@ -65,6 +93,17 @@ def _convert_and_validate_type(obj):
     return obj
 
 
+def _parse_order_by(order_by):
+    """ Converts `attr [asc|desc], ...` to a tuple of (attribute name, descending) pairs """
+    terms = tuple()
+    for term in order_by.split(', '):
+        name, _, direction = term.partition(' ')
+        terms += ((name, direction == 'desc'),)
+    if len({name for name, _ in terms}) != len(terms):
+        raise SyntaxError(f'Attributes are repeated in order by {order_by}')
+    return terms
+
+
 def _validate_and_parse_filter(match_obj, filter_string, lexer_ptr):
     """ Helper to throw errors based on matched filter and also parse the filter
     This helper guarantees to return a triple tuple of (subject, op, obj), where
@@ -88,6 +127,10 @@ def _validate_and_parse_filter(match_obj, filter_string, lexer_ptr):
     # Convert object (currently a string) to appropriate Python type
     obj = _convert_and_validate_type(obj)
 
+    # Variables are validated against their column when values are bound
+    if isinstance(obj, Variable):
+        return s, op, obj
+
     # Validate op on obj
     if op in array_only_ops and not isinstance(obj, list):
         raise SyntaxError(f'Invalid op {op} used on non-list obj {obj}')
@@ -99,7 +142,7 @@ def _validate_and_parse_filter(match_obj, filter_string, lexer_ptr):
     return s, op, obj
 
 
-filter_regex = re.compile(r"(?P<subject>\*|all|any) (?P<op>[^\s]+) (?P<object>(\[('[^']*',? ?)*\])|(\[(([0-9]+|\btrue\b|\bfalse\b),? ?)*\])|('[^']*')|([0-9]+)|\btrue\b|\bfalse\b)")
+filter_regex = re.compile(r"(?P<subject>\*|all|any) (?P<op>[^\s]+) (?P<object>(\[('[^']*',? ?)*\])|(\[(([0-9]+|\btrue\b|\bfalse\b),? ?)*\])|('[^']*')|([0-9]+)|\btrue\b|\bfalse\b|(\$[A-Za-z_]\w*))")
 
 
 def _get_filter_tokens_from_string(filters):
@@ -175,14 +218,28 @@ def tokenize(querystring):
         line_token = match_tok(**match.groupdict())
         if isinstance(line_token, LineToks.RootQueryLine):
             ast_tokens += (Toks.RootQueryToken(query_model=line_token.query_model),)
+            if line_token.order_by:
+                ast_tokens += (Toks.OrderByToken(order_by=_parse_order_by(line_token.order_by)),)
         elif isinstance(line_token, LineToks.OpenObjectLine):
             ast_tokens += (Toks.OpenObjectToken(rel=line_token.rel),)
+            if line_token.filter_only:
+                ast_tokens += (Toks.FilterOnlyToken(),)
             if line_token.cast_class:
                 ast_tokens += (Toks.CastToken(cast_class=line_token.cast_class),)
+            if line_token.order_by:
+                ast_tokens += (Toks.OrderByToken(order_by=_parse_order_by(line_token.order_by)),)
+            if line_token.limit:
+                if int(line_token.limit) < 1:
+                    raise SyntaxError(f'line {i+1}: limit must be at least 1')
+                ast_tokens += (Toks.LimitToken(limit=int(line_token.limit)),)
         elif isinstance(line_token, LineToks.AttributeLine):
             ast_tokens += (Toks.AttributeToken(attribute_name=line_token.attribute_name),)
+            if line_token.filter_only:
+                ast_tokens += (Toks.FilterOnlyToken(),)
             if line_token.filters:
                 ast_tokens += _get_filter_tokens_from_string(line_token.filters)
+        elif isinstance(line_token, LineToks.AggregateLine):
+            ast_tokens += (Toks.AggregateToken(func=line_token.func, attribute_name=line_token.attribute_name),)
         elif isinstance(line_token, LineToks.CloseObjectLine):
             ast_tokens += (Toks.CloseObjectToken(),)
         else:
@@ -0,0 +1,53 @@
+from threading import Lock
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+_installed = False
+_install_lock = Lock()
+
+
+def tables_of_instances(instances):
+    """ Returns the names of the tables the mapped instances are stored in """
+    return {table.name for obj in instances for table in inspect(obj).mapper.tables}
+
+
+def flushed_tables(session):
+    """ Returns the names of the tables a flush of session is about to write to, or
+    has just written to if called from an after_flush listener """
+    return tables_of_instances(session.new) | tables_of_instances(session.dirty) | \
+        tables_of_instances(session.deleted)
+
+
+def written_tables(session):
+    """ Returns the names of the tables session has flushed writes to in its current
+    transaction, which other sessions cannot see yet. Requires track_writes() """
+    return session.info.get('shoedog_written_tables', set())
+
+
+def sees_uncommitted_writes(session, tables):
+    """ Returns whether session has flushed writes to any of tables that it has not
+    committed yet. Its results may include them, so they must not be shared with
+    other sessions. Requires track_writes() """
+    return bool(written_tables(session) & set(tables))
+
+
+def _after_flush(session, flush_context):
+    session.info.setdefault('shoedog_written_tables', set()).update(flushed_tables(session))
+
+
+def _after_transaction_end(session, transaction):
+    # Savepoints and subtransactions end inside a transaction that has yet to be
+    # committed, so their writes are still only visible to this session
+    if transaction.parent is None:
+        session.info.pop('shoedog_written_tables', None)
+
+
+def track_writes():
+    """ Starts recording the tables every SQLAlchemy session writes to, until its
+    transaction ends (see written_tables) """
+    global _installed
+    with _install_lock:
+        if not _installed:
+            event.listen(Session, 'after_flush', _after_flush)
+            event.listen(Session, 'after_transaction_end', _after_transaction_end)
+            _installed = True
@@ -1,5 +1,6 @@
 import os
 import pytest
+from sqlalchemy.orm import sessionmaker
 
 from .mock_app import create_app, db as _db
 from shoedog.api import shoedoggify
@@ -67,3 +68,20 @@ def session(db, request):
 
     request.addfinalizer(teardown)
     return session
+
+
+@pytest.fixture(scope='function')
+def committed_session(db, request):
+    """Creates a session whose changes are committed, for tests that query
+    the database from other connections. Every row is deleted after the test."""
+    session = sessionmaker(bind=db.engine)()
+
+    def teardown():
+        session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            session.execute(table.delete())
+        session.commit()
+        session.close()
+
+    request.addfinalizer(teardown)
+    return session
@@ -35,7 +35,7 @@ class Sample(db.Model):
     self_sample_id = db.Column(db.Integer, db.ForeignKey('samples.id'))
     tube = db.relationship('Tube', uselist=False, foreign_keys=[tube_id])
     tubes = db.relationship('Tube', uselist=True, foreign_keys=[Tube.sample_id])
-    date = db.Column(Date)
+    date = db.Column(Date, index=True)
     name = db.Column(db.String)
     self_sample = db.relationship('Sample', uselist=False)
 
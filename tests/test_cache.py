@@ -0,0 +1,87 @@
+import time
+from shoedog.ast import fingerprint, tables
+from shoedog.cache import InProcessCacheBackend, ResultCache
+from shoedog.query_factory import QueryFactory
+from tests.mock_app import db, Sample, Tube
+
+
+def test_in_process_backend_lru():
+    backend = InProcessCacheBackend(max_entries=2)
+    backend.set('a', b'1', {'samples'})
+    backend.set('b', b'2', {'tubes'})
+    assert backend.get('a') == b'1'
+    # b is now the least recently used entry
+    backend.set('c', b'3', {'samples'})
+    assert backend.get('b') is None
+    assert (backend.get('a'), backend.get('c')) == (b'1', b'3')
+
+    backend.invalidate_tags({'samples'})
+    assert len(backend) == 0
+
+
+def test_in_process_backend_ttl():
+    backend = InProcessCacheBackend(ttl=0.01)
+    backend.set('a', b'1', set())
+    assert backend.get('a') == b'1'
+    time.sleep(0.02)
+    assert backend.get('a') is None
+
+
+def test_result_cache_invalidated_on_flush(session):
+    q = '''
+        query Sample {
+            name [* == 'cached']
+            tubes {
+                type [any == 'a']
+            }
+        }
+    '''
+    cache = ResultCache()
+    qf = QueryFactory(db, result_cache=cache)
+    try:
+        plan = qf._cached_plan(q)
+        assert plan.tables == {'samples', 'tubes'}
+        assert plan.fingerprint == fingerprint(plan.ast)
+
+        assert qf.parse_query(q) == []
+        assert qf.parse_query(q) == []
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        sample = Sample(name='cached', tubes=[Tube(type='a')])
+        session.add(sample)
+        session.flush()
+
+        # The flushed sample is not committed, so the session neither reads the
+        # cache nor caches a result that includes it
+        assert [s['id'] for s in qf.parse_query(q)] == [sample.id]
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert cache.backend.get(cache.key(plan.fingerprint, None)) is None
+
+        session.commit()
+        assert [s['id'] for s in qf.parse_query(q)] == [sample.id]
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        # The cache stores the serialized bytes the endpoint responds with
+        assert qf.parse_query_json(q) == cache.backend.get(cache.key(plan.fingerprint, None))
+        assert cache.hits == 2
+        assert tables(qf._cached_plan('query Tube {\n}').ast) == {'tubes'}
+    finally:
+        cache.uninstall()
+
+
+def test_result_cache_keyed_on_variables(session):
+    q = '''
+        query Sample {
+            name [* == $name]
+        }
+    '''
+    cache = ResultCache()
+    qf = QueryFactory(db, result_cache=cache)
+    try:
+        session.add_all([Sample(name='a'), Sample(name='b')])
+        session.commit()
+        assert [s['name'] for s in qf.parse_query(q, {'name': 'a'})] == ['a']
+        assert [s['name'] for s in qf.parse_query(q, {'name': 'b'})] == ['b']
+        assert (cache.hits, cache.misses) == (0, 2)
+    finally:
+        cache.uninstall()
@@ -0,0 +1,150 @@
+import pytest
+from datetime import date
+from tests.mock_app import db, Sample, Tube
+from shoedog.ast import RootNode
+from shoedog.columnar import ColumnarSnapshot
+from shoedog.errors import SnapshotUnsupportedException
+from shoedog.eval import eval_ast, bind_variables
+from shoedog.query_factory import QueryFactory
+from shoedog.serializer import serialize_to_json
+from tests.test_eval import test_ast_1, mock_registry
+
+
+def _sorted(res):
+    """ Orders results and related lists by id, since SQL does not order them """
+    if isinstance(res, list):
+        return sorted((_sorted(r) for r in res), key=lambda r: r['id'])
+    elif isinstance(res, dict):
+        return {k: _sorted(v) for k, v in res.items()}
+    return res
+
+
+def _add_samples(session):
+    session.add(Sample(name='a', date=date(2017, 1, 2), tubes=[
+        Tube(name='tube_1_1', type='a', date=date(2017, 1, 1)),
+        Tube(name='tube_1_2', type='c'),
+    ], tube=Tube(name='own_1', type='b')))
+    session.add(Sample(name='b', date=date(2016, 12, 31), tubes=[
+        Tube(name='tube_2_1', type='a'),
+        Tube(name=None, type=None),
+    ], tube=Tube(name='own_2', type='a')))
+    session.add(Sample(name=None, date=date(2017, 1, 2), tubes=[
+        Tube(name='tube_3_1', type='c'),
+        Tube(name='tube_3_2', type='c'),
+    ]))
+    session.add(Sample(name='d', date=None, tubes=[
+        Tube(name='tube_4_1', type='d'),
+    ], tube=Tube(name='own_4', type=None)))
+    session.add(Sample(name='e'))
+    session.flush()
+
+
+def _sql(qf, session, query_string, variables=None):
+    # Compare against a fresh session, so objects the test created are not reused
+    session.expunge_all()
+    return _sorted(qf.parse_query(query_string, variables))
+
+
+@pytest.mark.parametrize('query_string,variables', [
+    ('query Sample {\n id\n}', None),
+    ('query Sample {\n name [* in [\'a\', \'b\', \'d\']]\n}', None),
+    ('query Sample {\n name [* != \'a\' or * < \'b\']\n date\n}', None),
+    ('query Sample {\n tubes {\n type [any == \'a\']\n }\n}', None),
+    ('query Sample {\n tubes {\n type [all != \'c\']\n }\n}', None),
+    ('query Sample {\n tubes {\n name [all > \'tube_1\' and any in [\'tube_2_1\', \'x\']]\n }\n}', None),
+    ('query Sample {\n tubes {\n name\n }\n tube {\n type [* == \'b\' or * == \'a\']\n }\n}', None),
+    ('query Sample {\n id [* > $min]\n tube {\n name\n }\n}', {'min': 1}),
+    ('query Sample {\n id [* < $max]\n tubes {\n type\n date\n }\n}', {'max': 3}),
+    ('query Tube {\n type [* == \'a\']\n}', None),
+])
+def test_snapshot_matches_sql(session, query_string, variables):
+    _add_samples(session)
+    qf = QueryFactory(db)
+    snapshot = ColumnarSnapshot(session.connection(), [Sample, Tube])
+    plan = qf._plan(query_string)
+    params = bind_variables(plan.variables, variables or {})
+
+    assert _sorted(snapshot.evaluate(plan.ast, params)) == _sql(qf, session, query_string, variables)
+
+
+@pytest.mark.parametrize('query_string,variables', [
+    ('query Sample {\n date [* == \'2017-01-02\']\n}', None),
+    ('query Sample {\n date [* >= \'2017-01-02\']\n}', None),
+    ('query Sample {\n date [* < $before]\n tubes {\n type\n }\n}', {'before': '2017-01-01'}),
+])
+def test_snapshot_date_filters_fall_back(session, query_string, variables):
+    # SQLite compares dates with the datetimes they are bound as as strings, so
+    # only the database knows which rows match
+    _add_samples(session)
+    snapshot = ColumnarSnapshot(session.connection(), [Sample, Tube])
+    qf = QueryFactory(db, snapshot=snapshot)
+    plan = qf._plan(query_string)
+    with pytest.raises(SnapshotUnsupportedException):
+        snapshot.evaluate(plan.ast, bind_variables(plan.variables, variables or {}))
+
+    res = _sql(qf, session, query_string, variables)
+    assert res == _sql(QueryFactory(db), session, query_string, variables)
+    assert qf.metrics.snapshot()['stages']['execute']['count'] == 1
+
+
+def test_snapshot_matches_eval(session):
+    _add_samples(session)
+    snapshot = ColumnarSnapshot(session.connection(), [Sample, Tube])
+    # Without the date filter, which is left to the database
+    ast = RootNode(mock_registry, 'Sample', children=test_ast_1.children[:2])
+    res = _sorted(snapshot.evaluate(ast))
+    session.expunge_all()
+    assert res == _sorted(serialize_to_json(eval_ast(ast, session)))
+    assert len(res) == 3
+
+
+def test_snapshot_unsupported(session):
+    _add_samples(session)
+    qf = QueryFactory(db)
+    snapshot = ColumnarSnapshot(session.connection(), [Sample, Tube])
+
+    # Tube is reached twice, and its relationships are loaded at one of them
+    plan = qf._plan('query Tube {\n self_tube {\n name\n }\n}')
+    with pytest.raises(SnapshotUnsupportedException):
+        snapshot.evaluate(plan.ast)
+
+    for query_string in ('query Sample {\n tubes limit 1 {\n name\n }\n}', 'query Sample order by name {\n id\n}',
+                         'query Sample {\n count()\n}', 'query Sample {\n filter tubes {\n id\n }\n}'):
+        with pytest.raises(SnapshotUnsupportedException):
+            snapshot.evaluate(qf._plan(query_string).ast)
+
+    # Sample is not in the snapshot
+    plan = qf._plan('query Sample {\n id\n}')
+    with pytest.raises(SnapshotUnsupportedException):
+        ColumnarSnapshot(session.connection(), [Tube]).evaluate(plan.ast)
+
+
+def test_query_factory_snapshot(session):
+    _add_samples(session)
+    snapshot = ColumnarSnapshot(session.connection(), [Sample, Tube])
+    qf = QueryFactory(db, snapshot=snapshot)
+    session.expunge_all()
+
+    res = qf.parse_query('query Sample {\n name [* == \'a\']\n tubes {\n name\n }\n}')
+    assert [r['name'] for r in res] == ['a']
+    assert qf.metrics.snapshot()['stages']['snapshot']['count'] == 1
+    assert 'execute' not in qf.metrics.snapshot()['stages']
+
+    # Unsupported queries fall back to the database
+    res = qf.parse_query('query Tube {\n name [* == \'tube_1_1\']\n self_tube {\n name\n }\n}')
+    assert res == []
+    assert qf.metrics.snapshot()['stages']['execute']['count'] == 1
+
+
+def test_snapshot_refresh(session):
+    _add_samples(session)
+    qf = QueryFactory(db)
+    snapshot = ColumnarSnapshot(session.connection(), [Sample, Tube])
+    plan = qf._plan('query Sample {\n name [* == \'f\']\n}')
+    assert snapshot.evaluate(plan.ast) == []
+
+    session.add(Sample(name='f'))
+    session.flush()
+    assert snapshot.evaluate(plan.ast) == []
+    snapshot.refresh()
+    assert [r['name'] for r in snapshot.evaluate(plan.ast)] == ['f']
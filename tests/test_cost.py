@@ -0,0 +1,97 @@
+import pytest
+from threading import Event, Thread
+from shoedog.cost import AdmissionController, collect_row_counts, estimate_cost
+from shoedog.errors import QueryTooExpensiveException, AdmissionTimeoutException
+from shoedog.query_factory import QueryFactory
+from tests.mock_app import db, Sample, Tube
+
+qf = QueryFactory(db)
+
+
+def _ast(q):
+    return qf._cached_plan(q).ast
+
+
+def test_estimate_cost():
+    # An unfiltered root query pays for reading the whole table
+    assert estimate_cost(_ast('query Sample {\n id\n}')) == 10
+    assert estimate_cost(_ast('query Sample {\n id [* == 1]\n}')) == 0
+
+    # A many-to-one join costs a join, a one-to-many join also multiplies by fan_out
+    assert estimate_cost(_ast('query Sample {\n id [* == 1]\n tube {\n }\n}')) == 1
+    assert estimate_cost(_ast('query Sample {\n id [* == 1]\n tubes {\n }\n}')) == 4
+
+    # Everything beneath a one-to-many relationship is multiplied by fan_out
+    assert estimate_cost(_ast('''query Sample {
+        tubes {
+            type [any == 'a']
+            self_tube {
+            }
+        }
+    }''')) == 4 + 4 * 2 + 4 * 1
+
+    assert estimate_cost(_ast('query Sample {\n id\n}'), weights={'unfiltered_root': 1}) == 1
+
+
+def test_estimate_cost_filter_only_and_shared_joins():
+    # A filter-only relationship is an EXISTS subquery, not a one-to-many join
+    assert estimate_cost(_ast('query Sample {\n filter tubes {\n type [* == \'a\']\n }\n}')) == 2
+    assert estimate_cost(_ast('''query Sample {
+        filter tubes {
+            filter self_tube {
+                type [* == 'a']
+            }
+        }
+    }''')) == 2 + 2 * 4
+
+    # Blocks for the same relationship share its join
+    assert estimate_cost(_ast('''query Sample {
+        id [* == 1]
+        tube {
+            name
+        }
+        tube {
+            type
+        }
+    }''')) == 1
+
+
+def test_estimate_cost_with_row_counts(session):
+    session.add_all([Sample(tubes=[Tube() for _ in range(9)])] + [Sample() for _ in range(99)])
+    session.flush()
+    row_counts = collect_row_counts(session, [Sample, Tube])
+    assert row_counts == {'samples': 100, 'tubes': 9}
+    assert estimate_cost(_ast('query Sample {\n id\n}'), row_counts=row_counts) == 30
+
+
+def test_admission_rejects_expensive_queries(session):
+    admission_qf = QueryFactory(db, admission=AdmissionController(max_cost=5))
+    assert admission_qf.parse_query('query Sample {\n id [* == 1]\n}') == []
+    with pytest.raises(QueryTooExpensiveException) as e:
+        admission_qf.parse_query('query Sample {\n id\n}')
+    assert str(e.value) == 'Query cost 10.0 is over the budget of 5'
+
+
+def test_admission_queues_expensive_queries_separately():
+    admission = AdmissionController(expensive_cost=5, max_cheap=1, max_expensive=1, timeout=0.01)
+    expensive, cheap = _ast('query Sample {\n id\n}'), _ast('query Sample {\n id [* == 1]\n}')
+    admitted, release = Event(), Event()
+
+    def hold_expensive_slot():
+        with admission.admit(expensive):
+            admitted.set()
+            release.wait()
+
+    t = Thread(target=hold_expensive_slot)
+    t.start()
+    admitted.wait()
+    try:
+        with pytest.raises(AdmissionTimeoutException):
+            with admission.admit(expensive):
+                pass
+        # Cheap queries still get through while the expensive slot is taken
+        with admission.admit(cheap) as cost:
+            assert cost == 0
+    finally:
+        release.set()
+        t.join()
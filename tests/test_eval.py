@@ -1,7 +1,12 @@
+import pytest
+import time
 from datetime import date
+from sqlalchemy import func
 from tests.mock_app import db, Sample, Tube
+from shoedog.errors import QueryTimeoutException
 from shoedog.registry import build_registry
-from shoedog.eval import eval_ast
+from shoedog.eval import build_query, eval_ast
+from shoedog.serializer import serialize_to_json
 from shoedog.ast import RootNode, AttributeNode, RelationshipNode, BinaryLogicNode, \
     FilterNode
 
@@ -186,3 +191,34 @@ def test_eval_2(session):
     e = eval_ast(test_ast_2, session)
     assert len(e) == 1
     assert {s.id for s in e} == {sample_1.id}
+
+
+def test_eval_deadline(session):
+    session.add_all([Sample(name=f'slow-{i}') for i in range(20)])
+    session.flush()
+
+    def slow(value):
+        time.sleep(0.01)
+        return value
+
+    session.connection().connection.create_function('slow', 1, slow)
+    ast = RootNode(mock_registry, 'Sample', children=[AttributeNode(mock_registry, Sample, 'id')])
+    slow_query = build_query(ast).filter(func.slow(Sample.name).isnot(None))
+
+    start = time.monotonic()
+    with pytest.raises(QueryTimeoutException):
+        eval_ast(ast, session, query=slow_query, deadline=time.monotonic() + 0.05)
+    assert time.monotonic() - start < 0.15
+
+    # The connection is still usable once the statement has been cancelled
+    assert len(eval_ast(ast, session, query=slow_query, deadline=time.monotonic() + 5)) == 20
+    assert len(eval_ast(ast, session)) == 20
+
+
+def test_serialize_deadline(session):
+    session.add(Sample())
+    session.flush()
+    samples = eval_ast(RootNode(mock_registry, 'Sample'), session)
+    with pytest.raises(QueryTimeoutException):
+        serialize_to_json(samples, deadline=time.monotonic() - 1)
+    assert len(serialize_to_json(samples, deadline=time.monotonic() + 5)) == 1
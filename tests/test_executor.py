@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from threading import Event
+from shoedog.errors import ExecutorFullException
+from shoedog.query_factory import QueryFactory
+from tests.mock_app import db, Sample
+
+qf = QueryFactory(db)
+
+q = '''
+    query Sample {
+        id
+        name [* == $name]
+    }
+'''
+
+
+def test_executor_submit(committed_session):
+    samples = [Sample(name=f'executor-{i}') for i in range(6)]
+    committed_session.add_all(samples)
+    committed_session.commit()
+
+    executor = qf.executor(max_workers=3)
+    try:
+        futures = [executor.submit(q, {'name': s.name}) for s in samples]
+        assert [[r['id'] for r in f.result()] for f in futures] == [[s.id] for s in samples]
+        metrics = executor.metrics
+        assert (metrics['queue_depth'], metrics['running'], metrics['completed']) == (0, 0, 6)
+        assert metrics['peak_queue_depth'] <= 6
+    finally:
+        executor.shutdown()
+
+
+def test_executor_run_async(committed_session):
+    samples = [Sample(name=f'executor-async-{i}') for i in range(3)]
+    committed_session.add_all(samples)
+    committed_session.commit()
+
+    executor = qf.executor(max_workers=2)
+
+    async def fan_out():
+        return await asyncio.gather(*[executor.run_async(q, {'name': s.name}) for s in samples])
+
+    try:
+        results = asyncio.run(fan_out())
+        assert [[r['id'] for r in res] for res in results] == [[s.id] for s in samples]
+    finally:
+        executor.shutdown()
+
+
+def test_executor_max_queue_depth(committed_session):
+    executor = qf.executor(max_workers=1, max_queue_depth=1)
+    blocker = Event()
+    try:
+        # Occupy the only worker, then fill the queue
+        executor._pool.submit(blocker.wait)
+        executor.submit(q, {'name': 'queued'})
+        assert executor.metrics['queue_depth'] == 1
+        with pytest.raises(ExecutorFullException):
+            executor.submit(q, {'name': 'rejected'})
+    finally:
+        blocker.set()
+        executor.shutdown()
+    assert executor.metrics['completed'] == 1
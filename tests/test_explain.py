@@ -0,0 +1,38 @@
+from shoedog.api import shoedoggify
+from shoedog.query_factory import QueryFactory
+from tests.mock_app import create_app, db, Sample, Tube
+
+qf = QueryFactory(db)
+
+q = '''
+    query Sample {
+        id [* in $ids]
+        tubes {
+            type [any == 'a']
+        }
+    }
+'''
+
+
+def test_explain(session):
+    session.add(Sample(tubes=[Tube(type='a')]))
+    session.flush()
+
+    res = qf.explain(q, {'ids': [1, 2, 3]})
+    assert res['sql'].startswith('SELECT')
+    assert 'JOIN tubes' in res['sql']
+    assert list(res['params']) == ['[1, 2, 3]', 'a']  # in lists are bound as one JSON array
+    assert res['plan']
+    assert all(set(row) == {'id', 'parent', 'detail'} for row in res['plan'])
+    assert any('samples' in row['detail'] for row in res['plan'])
+
+
+def test_explain_endpoint(session):
+    session.add(Sample(name='explain'))
+    session.flush()
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db)
+    res = app.test_client().post('/shoedog?explain=1', json={'query': q, 'variables': {'ids': [1]}})
+    assert res.status_code == 200
+    assert set(res.get_json()) == {'sql', 'params', 'plan', 'sorts'}
@@ -0,0 +1,65 @@
+from shoedog.api import shoedoggify
+from shoedog.metrics import Histogram, Metrics, StageTimer
+from shoedog.query_factory import QueryFactory
+from tests.mock_app import create_app, db, Sample
+
+
+def test_histogram_percentiles():
+    h = Histogram(reservoir_size=100)
+    for i in range(1, 101):
+        h.observe(i)
+    assert h.snapshot() == {'count': 100, 'sum': 5050, 'p50': 51, 'p95': 96, 'p99': 100}
+
+    # Percentiles only cover the most recent observations
+    for i in range(100):
+        h.observe(1000)
+    assert h.percentile(50) == 1000
+    assert h.count == 200
+
+
+def test_stage_timer_hooks():
+    metrics = Metrics()
+    spans = []
+    metrics.add_hook(lambda stage, start_time, duration: spans.append((stage, duration)))
+
+    timer = StageTimer(metrics)
+    with timer('a'):
+        pass
+    with timer('a'):
+        pass
+    assert [stage for stage, _ in spans] == ['a', 'a']
+    assert timer.timings['a'] == sum(duration for _, duration in spans)
+    assert metrics.snapshot()['stages']['a']['count'] == 2
+
+
+def test_query_factory_metrics(session):
+    session.add_all([Sample(name='metrics'), Sample(name='metrics')])
+    session.flush()
+
+    qf = QueryFactory(db)
+    res = qf.parse_query_json('query Sample {\n name [* == \'metrics\']\n}')
+
+    snapshot = qf.metrics.snapshot()
+    assert set(snapshot['stages']) == \
+        {'tokenize', 'parse', 'plan', 'compile', 'execute', 'hydrate', 'serialize', 'encode'}
+    assert all(s['count'] == 1 for s in snapshot['stages'].values())
+    assert snapshot['values']['rows']['sum'] == 2
+    assert snapshot['values']['response_bytes']['sum'] == len(res)
+
+
+def test_metrics_route(session):
+    session.add(Sample(name='metrics-route'))
+    session.flush()
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db, metrics_route=True)
+    client = app.test_client()
+    client.post('/shoedog', data='query Sample {\n}')
+
+    res = client.get('/shoedog/metrics')
+    assert res.status_code == 200
+    text = res.get_data(as_text=True)
+    assert '# TYPE shoedog_stage_seconds summary' in text
+    assert 'shoedog_stage_seconds_count{stage="request"} 1' in text
+    assert 'shoedog_stage_seconds{stage="execute",quantile="0.99"}' in text
+    assert 'shoedog_query_values_count{name="rows"} 1' in text
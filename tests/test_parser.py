@@ -1,7 +1,7 @@
 import pytest
 from shoedog.tokenizer import Toks
 from shoedog.ast import RootNode, RelationshipNode, \
-    AttributeNode, FilterNode, BinaryLogicNode
+    AttributeNode, AggregateNode, FilterNode, BinaryLogicNode, is_filter_only
 from shoedog.parser import tokens_to_ast
 from shoedog.registry import build_registry
 from tests.mock_app import db, Sample, Tube
@@ -152,3 +152,133 @@ test_token_ast_2 = RootNode(mock_registry, 'Sample', children=[
 def test_tokens_to_ast_2():
     root = tokens_to_ast(test_token_gen_2, mock_registry)
     assert root == test_token_ast_2
+
+
+def test_tokens_to_ast_order_by_limit():
+    tokens = (t for t in (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.OrderByToken(order_by=(('date', True),)),
+        Toks.LimitToken(limit=5),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.CloseObjectToken(),
+        Toks.CloseObjectToken(),
+    ))
+    root = tokens_to_ast(tokens, mock_registry)
+    assert root == RootNode(mock_registry, 'Sample', children=[
+        RelationshipNode(mock_registry, Sample, 'tubes', order_by=(('date', True),), limit=5, children=[
+            AttributeNode(mock_registry, Tube, 'name'),
+        ]),
+    ])
+    assert root != RootNode(mock_registry, 'Sample', children=[
+        RelationshipNode(mock_registry, Sample, 'tubes', limit=5, children=[
+            AttributeNode(mock_registry, Tube, 'name'),
+        ]),
+    ])
+
+    with pytest.raises(SyntaxError) as e:
+        RelationshipNode(mock_registry, Sample, 'tube', limit=1)
+    assert str(e.value) == 'Cannot order or limit singular relationship Sample.tube'
+
+    with pytest.raises(SyntaxError) as e:
+        RelationshipNode(mock_registry, Sample, 'tubes', order_by=(('self_tube', False),))
+    assert str(e.value) == 'Cannot order Tube by self_tube: it is not a column'
+
+
+def test_tokens_to_ast_aggregates():
+    tokens = (t for t in (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.AggregateToken(func='count', attribute_name=''),
+        Toks.AggregateToken(func='max', attribute_name='date'),
+        Toks.CloseObjectToken(),
+        Toks.CloseObjectToken(),
+    ))
+    root = tokens_to_ast(tokens, mock_registry)
+    assert root == RootNode(mock_registry, 'Sample', children=[
+        AttributeNode(mock_registry, Sample, 'name'),
+        RelationshipNode(mock_registry, Sample, 'tubes', children=[
+            AggregateNode(mock_registry, Tube, 'count'),
+            AggregateNode(mock_registry, Tube, 'max', 'date'),
+        ]),
+    ])
+    assert [c.key for c in root.children[1].children] == ['count', 'max_date']
+    assert AggregateNode(mock_registry, Tube, 'max', 'date') != AggregateNode(mock_registry, Tube, 'min', 'date')
+
+    with pytest.raises(SyntaxError) as e:
+        AggregateNode(mock_registry, Tube, 'count', 'date')
+    assert str(e.value) == 'count() does not take an attribute, but received date'
+
+    with pytest.raises(SyntaxError) as e:
+        AggregateNode(mock_registry, Sample, 'sum', 'tubes')
+    assert str(e.value) == 'Cannot take sum of Sample.tubes: it is not a column'
+
+    with pytest.raises(SyntaxError) as e:
+        AggregateNode(mock_registry, Sample, 'sum', 'name')
+    assert str(e.value) == 'Cannot take sum of Sample.name: it is not numeric'
+    with pytest.raises(SyntaxError):
+        AggregateNode(mock_registry, Tube, 'avg', 'date')
+    assert AggregateNode(mock_registry, Tube, 'avg', 'id').key == 'avg_id'
+    assert AggregateNode(mock_registry, Tube, 'max', 'name').key == 'max_name'
+
+
+def test_tokens_to_ast_filter_only():
+    tokens = (t for t in (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.FilterOnlyToken(),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.CloseObjectToken(),
+        Toks.OpenObjectToken(rel='tube'),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.FilterOnlyToken(),
+        Toks.FilterStartToken(),
+        Toks.FilterBoolToken(sel='*', op='==', val='a'),
+        Toks.FilterEndToken(),
+        Toks.CloseObjectToken(),
+        Toks.CloseObjectToken(),
+    ))
+    root = tokens_to_ast(tokens, mock_registry)
+    assert root == RootNode(mock_registry, 'Sample', children=[
+        RelationshipNode(mock_registry, Sample, 'tubes', filter_only=True, children=[
+            AttributeNode(mock_registry, Tube, 'name'),
+        ]),
+        RelationshipNode(mock_registry, Sample, 'tube', children=[
+            AttributeNode(mock_registry, Tube, 'name', filter_only=True, children=[FilterNode('*', '==', 'a')]),
+        ]),
+    ])
+    # A relationship with only filter-only attributes is filter-only too
+    assert [is_filter_only(c) for c in root.children] == [True, True]
+    assert root != RootNode(mock_registry, 'Sample', children=[
+        RelationshipNode(mock_registry, Sample, 'tubes', children=[AttributeNode(mock_registry, Tube, 'name')]),
+        root.children[1],
+    ])
+
+    tokens = (t for t in (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.FilterOnlyToken(),
+        Toks.CloseObjectToken(),
+    ))
+    with pytest.raises(SyntaxError) as e:
+        tokens_to_ast(tokens, mock_registry)
+    assert str(e.value) == 'Filter-only attribute Sample.name has no filters'
+
+
+def test_root_order_index():
+    def order_index(*order_by):
+        return RootNode(mock_registry, 'Sample', order_by=order_by).order_index
+
+    assert order_index(('date', True)) == 'ix_samples_date'
+    assert order_index(('date', False), ('id', False)) == 'ix_samples_date'
+    assert order_index(('id', True)) == 'primary key'
+    assert order_index(('name', False)) is None
+    assert order_index(('date', False), ('name', False)) is None
+    # An index can only be scanned in one direction at a time
+    assert order_index(('date', False), ('id', True)) is None
+    # Filtering the roots leaves the database free to choose an index for the filters
+    filtered = RootNode(mock_registry, 'Sample', children=[
+        AttributeNode(mock_registry, Sample, 'id', [FilterNode('*', '==', 3)])], order_by=(('date', True),))
+    assert filtered.order_index is None
+    assert RootNode(mock_registry, 'Sample', order_by=(('date', True),)) != RootNode(mock_registry, 'Sample')
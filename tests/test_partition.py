@@ -0,0 +1,91 @@
+import pytest
+from datetime import date
+from tests.mock_app import db, Sample, Tube
+from shoedog.partition import PartitionBoundsCache, partition_key, partition_bounds, partition_filters
+from shoedog.query_factory import QueryFactory
+
+
+def _add_samples(session):
+    for i in range(10):
+        session.add(Sample(name=f'partition-{i % 4}', date=date(2018, 1, 1 + i),
+                           tubes=[Tube(name=f'partition-tube-{i}-{j}') for j in range(i % 3)]))
+    session.add(Sample(name=None))
+
+
+def test_partition_bounds(session):
+    _add_samples(session)
+    session.flush()
+    ids = [i for i, in session.query(Sample.id).order_by(Sample.id)]
+
+    bounds = partition_bounds(session, Sample.id, 3)
+    assert len(bounds) == 2 and ids[0] < bounds[0] < bounds[1] <= ids[-1]
+
+    # Names are split at quantiles, and duplicate bounds are dropped
+    bounds = partition_bounds(session, Sample.name, 8)
+    assert bounds == sorted(set(bounds))
+    assert set(bounds) <= {f'partition-{i}' for i in range(4)}
+
+    # Every row is in exactly one partition, including those with null names
+    counts = [session.query(Sample).filter(f).count() for f in partition_filters(Sample.name, bounds)]
+    assert sum(counts) == len(ids)
+    assert partition_filters(Sample.name, []) == [None]
+    assert partition_key(Sample) == 'id'
+
+
+def test_partition_bounds_cache(session):
+    _add_samples(session)
+    session.flush()
+    cache = PartitionBoundsCache()
+    cache.install()
+    try:
+        bounds = cache.get(session, Sample.name, 3)
+        assert bounds == partition_bounds(session, Sample.name, 3)
+
+        # Cached until a write to the table is flushed
+        session.query(Sample).filter(Sample.name.isnot(None)).update({'name': 'updated'},
+                                                                    synchronize_session=False)
+        assert cache.get(session, Sample.name, 3) == bounds
+        session.add(Sample(name='added'))
+        session.flush()
+        assert cache.get(session, Sample.name, 3) == ['updated']
+    finally:
+        cache.uninstall()
+
+
+def test_partitioned_query(committed_session, request):
+    # Partitions run on their own connections, so the data has to be committed
+    _add_samples(committed_session)
+    committed_session.commit()
+    query_string = 'query Sample {\n name [* != \'partition-3\']\n tubes {\n name\n }\n}'
+
+    qf = QueryFactory(db)
+    expected = qf._evaluate(qf._plan(query_string), None, session=committed_session)
+    qf = QueryFactory(db, partitions=3)
+    request.addfinalizer(qf.close)
+    res = qf.parse_query(query_string)
+    assert sorted(res, key=lambda r: r['id']) == sorted(expected, key=lambda r: r['id'])
+    assert qf.metrics.snapshot()['stages']['execute']['count'] == 3
+
+    # Executor workers have no application context
+    executor = qf.executor(max_workers=1)
+    try:
+        res = executor.submit(query_string).result()
+    finally:
+        executor.shutdown()
+    assert sorted(res, key=lambda r: r['id']) == sorted(expected, key=lambda r: r['id'])
+
+    qf = QueryFactory(db, partitions=2, partition_columns={Sample: 'date'})
+    request.addfinalizer(qf.close)
+    res = qf.parse_query('query Sample {\n date [* > \'2018-01-03\']\n}')
+    assert sorted(r['date'] for r in res) == [f'2018-01-{d:02}' for d in range(4, 11)]
+
+    # Ordered partitions are merged back into the order of the unpartitioned query
+    query_string = 'query Sample order by name desc, date {\n id\n}'
+    expected = QueryFactory(db)._evaluate(qf._plan(query_string), None, session=committed_session)
+    qf = QueryFactory(db, partitions=3)
+    res = qf.parse_query(query_string)
+    assert [r['id'] for r in res] == [r['id'] for r in expected]
+
+    qf.close()
+    with pytest.raises(RuntimeError):
+        qf.parse_query(query_string)
@@ -1,7 +1,14 @@
+import json
+import pytest
 from datetime import date
+from shoedog.api import shoedoggify
+from shoedog.cost import AdmissionController
+from shoedog.errors import InvalidVariableException, PersistedQueryNotFoundException, \
+    QueryTimeoutException
 from shoedog.registry import build_registry
-from shoedog.query_factory import QueryFactory
-from tests.mock_app import db, Sample, Tube
+import shoedog.query_factory
+from shoedog.query_factory import QueryFactory, query_id
+from tests.mock_app import create_app, db, Sample, Tube
 
 mock_registry = build_registry(db)
 
@@ -285,3 +292,607 @@ def test_end_to_end_3(session):
                    'self_tube_id': None,
                    'type': None},
           'tube_id': 1}]
+
+
+def test_persisted_query(session):
+    q = '''
+        query Sample {
+            id
+            name [* == 'persisted']
+        }
+    '''
+    qid = qf.register_query(q)
+    assert qid == query_id(q)
+    assert qf.register_query(q) == qid
+
+    sample_1 = Sample(name='persisted')
+    session.add(sample_1)
+    session.add(Sample(name='not persisted'))
+    session.flush()
+
+    json_response = qf.parse_persisted_query(qid)
+    assert [s['id'] for s in json_response] == [sample_1.id]
+
+    with pytest.raises(PersistedQueryNotFoundException):
+        qf.parse_persisted_query('not-a-registered-id')
+
+
+def test_persisted_query_endpoint(session, tmp_path):
+    q = '''
+        query Sample {
+            name [* == 'persisted-endpoint']
+        }
+    '''
+    path = tmp_path / 'queries.json'
+    path.write_text(json.dumps([q]))
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db, persisted_queries=str(path))
+
+    sample_1 = Sample(name='persisted-endpoint')
+    session.add(sample_1)
+    session.flush()
+
+    res = app.test_client().post('/shoedog', json={'id': query_id(q)})
+    assert res.status_code == 200
+    assert [s['id'] for s in res.get_json()] == [sample_1.id]
+
+
+def test_query_variables(session):
+    q = '''
+        query Sample {
+            id
+            date [* > $after]
+            tubes {
+                type [any in $types]
+            }
+        }
+    '''
+    sample_1 = Sample(date=date(year=2017, month=1, day=2), tubes=[Tube(type='a')])
+    sample_2 = Sample(date=date(year=2017, month=1, day=2), tubes=[Tube(type='b')])
+    sample_3 = Sample(date=date(year=2015, month=1, day=2), tubes=[Tube(type='a')])
+    session.add_all([sample_1, sample_2, sample_3])
+    session.flush()
+
+    json_response = qf.parse_query(q, {'after': '2016-01-01', 'types': ['a']})
+    assert [s['id'] for s in json_response] == [sample_1.id]
+
+    json_response = qf.parse_query(q, {'after': '2014-01-01', 'types': ['a', 'b']})
+    assert sorted(s['id'] for s in json_response) == sorted([sample_1.id, sample_2.id, sample_3.id])
+
+    # Both executions share a single plan
+    assert list(qf._plan_cache).count(q) == 1
+
+    # A variable can filter several columns of the same type
+    q = "query Sample {\n name [* == $name]\n tubes {\n name [any == $name]\n }\n}"
+    sample_4 = Sample(name='shared-variable', tubes=[Tube(name='shared-variable')])
+    session.add(sample_4)
+    session.flush()
+    assert [s['id'] for s in qf.parse_query(q, {'name': 'shared-variable'})] == [sample_4.id]
+    with pytest.raises(SyntaxError):
+        qf.parse_query("query Sample {\n name [* == $value]\n id [* == $value]\n}", {'value': 1})
+
+    # Variables named like the bound parameters SQLAlchemy generates do not collide with them
+    q = "query Sample {\n name [* == 'shared-variable']\n id [* == $name_1]\n}"
+    assert [s['id'] for s in qf.parse_query(q, {'name_1': sample_4.id})] == [sample_4.id]
+
+
+def test_query_variables_type_checked(session):
+    q = '''
+        query Sample {
+            id [* == $id]
+        }
+    '''
+    with pytest.raises(InvalidVariableException) as e:
+        qf.parse_query(q, {'id': 'not-an-int'})
+    assert str(e.value) == 'Variable $id must be of type int to filter on id'
+
+    with pytest.raises(InvalidVariableException) as e:
+        qf.parse_query(q, {'id': [1]})
+    assert str(e.value) == 'Variable $id must be a single value'
+
+    with pytest.raises(InvalidVariableException) as e:
+        qf.parse_query(q, {})
+    assert str(e.value) == 'No value provided for variable $id'
+
+    with pytest.raises(InvalidVariableException) as e:
+        qf.parse_query(q, {'id': 1, 'other': 2})
+    assert str(e.value) == "Unknown variables ['other']"
+
+
+def test_large_in_lists(session):
+    samples = [Sample(name='large-in', tubes=[Tube(type='a'), Tube(type=t)]) for t in ('a', 'b')]
+    session.add_all(samples)
+    session.flush()
+    ids = [s.id for s in samples]
+
+    # More values than SQLite allows variables in one statement
+    many_ids = ids + list(range(10 ** 6, 10 ** 6 + 40000))
+    res = qf.parse_query('query Sample {\n id [* in $ids]\n}', {'ids': many_ids})
+    assert [s['id'] for s in res] == ids
+
+    # Long literal lists are bound as a single parameter on every path
+    types = ', '.join(f"'{t}'" for t in ['a'] + [f'type-{i}' for i in range(2000)])
+    ids = ', '.join(str(i) for i in many_ids[:2000])
+    q = f'query Sample {{\n id [* in [{ids}]]\n tubes {{\n type [all in [{types}]]\n }}\n}}'
+    assert [s['id'] for s in qf.parse_query(q)] == [samples[0].id]
+    assert len(qf.explain(q)['params']) == 2
+    q = f'query Sample {{\n id [* in [{ids}]]\n tubes {{\n type [any in [{types}]]\n }}\n}}'
+    assert [s['id'] for s in qf.parse_query(q)] == [s.id for s in samples]
+
+
+def test_relationship_order_by_limit(session):
+    samples = [
+        Sample(name='top-n', tubes=[Tube(name=f'tube-{i}-{j}', date=date(2018, 1, day))
+                                    for j, day in enumerate([1, 3, 5, 2, 5])])
+        for i in range(3)
+    ]
+    session.add_all(samples)
+    session.flush()
+    # Otherwise the tubes collections already loaded in the session are serialized
+    session.expire_all()
+
+    q = '''
+        query Sample {
+            name [* == 'top-n']
+            tubes order by date desc, name limit 2 {
+                name
+                date
+                type [all == 'none']
+            }
+        }
+    '''
+    res = qf.parse_query(q)
+    assert sorted(s['id'] for s in res) == [s.id for s in samples]
+    for s in res:
+        i = [sample.id for sample in samples].index(s['id'])
+        assert [t['name'] for t in s['tubes']] == [f'tube-{i}-2', f'tube-{i}-4']
+
+    session.expire_all()
+    q = '''
+        query Sample {
+            name [* == 'top-n']
+            tubes order by name desc {
+                name
+            }
+        }
+    '''
+    for s in qf.parse_query(q):
+        i = [sample.id for sample in samples].index(s['id'])
+        assert [t['name'] for t in s['tubes']] == [f'tube-{i}-{j}' for j in reversed(range(5))]
+
+
+def test_relationship_limit_numbers_matching_rows(session):
+    sample = Sample(name='top-n-nested', tubes=[Tube(name='a'), Tube(name='b', self_tube=Tube(name='x'))])
+    session.add(sample)
+    session.flush()
+    session.expire_all()
+
+    # The first tube by name has no self_tube, so the limit only counts the tubes that do
+    q = '''
+        query Sample {
+            name [* == 'top-n-nested']
+            tubes order by name limit 1 {
+                name
+                self_tube {
+                    name [* == 'x']
+                }
+            }
+        }
+    '''
+    res = qf.parse_query(q)
+    assert [t['name'] for s in res for t in s['tubes']] == ['b']
+
+
+def test_aggregates(session):
+    samples = [
+        Sample(name='aggregate', date=date(2018, 1, 1), tubes=[
+            Tube(type='c', date=date(2018, 2, 1)), Tube(type='c', date=date(2018, 2, 3)), Tube(type='d')]),
+        Sample(name='aggregate', date=date(2018, 1, 5), tubes=[Tube(type='d')]),
+        Sample(name='aggregate'),
+    ]
+    session.add_all(samples)
+    session.flush()
+
+    # Samples joined to several matching tubes are only counted once
+    q = '''
+        query Sample {
+            count()
+            max(date)
+            name [* == 'aggregate']
+            tubes {
+                type [any == 'c' or any == 'd']
+            }
+        }
+    '''
+    assert qf.parse_query(q) == [{'count': 2, 'max_date': '2018-01-05'}]
+    assert 'DISTINCT' in qf.explain(q)['sql']
+    assert qf.parse_query("query Sample {\n count()\n name [* == 'aggregate']\n}") == [{'count': 3}]
+
+    q = '''
+        query Sample {
+            name [* == 'aggregate']
+            tubes {
+                count()
+                min(date)
+                type [* == 'c']
+            }
+        }
+    '''
+    res = sorted(qf.parse_query(q), key=lambda s: s['id'])
+    assert [s['id'] for s in res] == [s.id for s in samples]
+    assert [s['tubes'] for s in res] == [
+        {'count': 2, 'min_date': '2018-02-01'},
+        {'count': 0, 'min_date': None},
+        {'count': 0, 'min_date': None},
+    ]
+    # Tubes are aggregated in correlated subqueries rather than joined and loaded
+    assert 'JOIN' not in qf.explain(q)['sql']
+
+    # any and all filters still filter the samples
+    res = qf.parse_query("query Sample {\n name [* == 'aggregate']\n tubes {\n count()\n type [any == 'd']\n }\n}")
+    assert sorted((s['id'], s['tubes']['count']) for s in res) == [(samples[0].id, 3), (samples[1].id, 1)]
+
+    for q in ('query Sample order by name {\n count()\n}',
+              'query Sample {\n count()\n name\n}',
+              'query Sample {\n count()\n tubes {\n count()\n }\n}',
+              'query Sample {\n tube {\n count()\n }\n}',
+              'query Sample {\n tubes {\n count()\n name\n }\n}'):
+        with pytest.raises(SyntaxError):
+            qf.parse_query(q)
+
+
+def test_filter_only(session):
+    samples = [
+        Sample(name='filter-only', tubes=[Tube(type='c', name=f'tube-{i}') for i in range(5)]),
+        Sample(name='filter-only', tubes=[Tube(type='d')]),
+        Sample(name='filter-only'),
+    ]
+    session.add_all(samples)
+    session.flush()
+    session.expire_all()
+
+    q = '''
+        query Sample {
+            name [* == 'filter-only']
+            filter tubes {
+                type [* == 'c']
+                name [* == 'tube-3']
+            }
+        }
+    '''
+    res = qf.parse_query(q)
+    assert [s['id'] for s in res] == [samples[0].id]
+    assert 'tubes' not in res[0]
+    sql = qf.explain(q)['sql']
+    assert 'JOIN' not in sql and sql.count('EXISTS') == 1
+
+    # A relationship whose attributes are all filter-only is filter-only too, and
+    # keeps the same samples as the joined relationship
+    q = '''
+        query Sample {
+            name [* == 'filter-only']
+            tubes {
+                filter type [any == 'd']
+            }
+        }
+    '''
+    res = qf.parse_query(q)
+    assert [s['id'] for s in res] == [samples[1].id]
+    assert 'tubes' not in res[0] and 'JOIN' not in qf.explain(q)['sql']
+    assert [s['id'] for s in qf.parse_query(q.replace('filter type', 'type'))] == [samples[1].id]
+
+    # Aggregates of the roots need no DISTINCT over filter-only relationships
+    q = "query Sample {\n count()\n name [* == 'filter-only']\n filter tubes {\n id\n }\n}"
+    assert qf.parse_query(q) == [{'count': 2}]
+    assert 'DISTINCT' not in qf.explain(q)['sql']
+    assert qf.parse_query("query Sample {\n count()\n}") == [{'count': session.query(Sample).count()}]
+
+    with pytest.raises(SyntaxError):
+        qf.parse_query('query Sample {\n filter tubes limit 1 {\n id\n }\n}')
+
+
+def test_repeated_relationships_share_joins(session):
+    tube = Tube(name='shared', type='c')
+    samples = [
+        Sample(name='shared-joins', tube=tube, tubes=[Tube(name='a', type='c', self_tube=Tube(name='c')),
+                                                      Tube(name='b', type='d')]),
+        Sample(name='shared-joins', tube=Tube(name='shared', type='d'), tubes=[Tube(name='a', type='d')]),
+    ]
+    session.add_all(samples)
+    session.flush()
+    session.expire_all()
+
+    def joins(q):
+        return qf.explain(q)['sql'].count('JOIN')
+
+    q = '''
+        query Sample {
+            name [* == 'shared-joins']
+            tubes {
+                name
+            }
+            tubes {
+                type [any == 'c']
+            }
+        }
+    '''
+    assert joins(q) == 1
+    res = qf.parse_query(q)
+    assert [s['id'] for s in res] == [samples[0].id]
+    assert sorted(t['name'] for t in res[0]['tubes']) == ['a', 'b']
+
+    # A singular relationship joins the same row for every block, which has to
+    # pass the filters of all of them
+    session.expire_all()
+    q = '''
+        query Sample {
+            name [* == 'shared-joins']
+            tube {
+                name [* == 'shared']
+            }
+            tube {
+                type [* == 'c']
+            }
+        }
+    '''
+    assert joins(q) == 1
+    assert [s['tube']['id'] for s in qf.parse_query(q)] == [tube.id]
+
+    # Blocks are merged at every level of a shared path
+    q = '''
+        query Sample {
+            tube {
+                self_tube {
+                    name
+                }
+            }
+            tube {
+                self_tube {
+                    type [* == 'c']
+                }
+            }
+        }
+    '''
+    assert joins(q) == 2
+
+    # Only one block restricts the tubes joined, so the tubes returned are the ones it joins
+    session.expire_all()
+    q = '''
+        query Sample {
+            name [* == 'shared-joins']
+            tubes {
+                self_tube {
+                    name [* == 'c']
+                }
+            }
+            tubes {
+                name
+            }
+        }
+    '''
+    assert joins(q) == 2
+    res = qf.parse_query(q)
+    assert [(t['name'], t['self_tube']['name']) for s in res for t in s['tubes']] == [('a', 'c')]
+
+    # Blocks that each restrict the related rows they join, or that are limited
+    # differently, keep their own joins
+    q = '''
+        query Sample {
+            tubes {
+                self_tube {
+                    name
+                }
+            }
+            tubes {
+                self_tube {
+                    name [* == 'c']
+                }
+            }
+        }
+    '''
+    assert joins(q) == 4
+    assert joins('query Sample {\n tubes {\n name\n }\n tubes limit 1 {\n name\n }\n}') == 2
+    # A limited join only numbers the rows of its first block, so later blocks cannot restrict it
+    assert joins('query Sample {\n tubes limit 1 {\n name\n }\n tubes limit 1 {\n self_tube {\n name\n }\n }\n}') == 3
+
+
+def test_root_order_by(session):
+    samples = [Sample(name=f'ordered-{i % 3}', date=date(2018, 1, 1 + i % 2), tubes=[Tube(), Tube()])
+               for i in range(6)]
+    session.add_all(samples)
+    session.flush()
+    session.expire_all()
+
+    q = '''
+        query Sample order by date desc, name {
+            name [* in ['ordered-0', 'ordered-1', 'ordered-2']]
+            tubes order by id desc {
+                id
+            }
+        }
+    '''
+    res = qf.parse_query(q)
+    expected = sorted(samples, key=lambda s: (-s.date.toordinal(), s.name, s.id))
+    assert [s['id'] for s in res] == [s.id for s in expected]
+    # Each sample's tubes are loaded from consecutive rows, in order
+    assert all(len(s['tubes']) == 2 and s['tubes'][0]['id'] > s['tubes'][1]['id'] for s in res)
+
+    sql = qf.explain(q)['sql']
+    assert 'INDEXED BY' not in sql and sql.endswith('ORDER BY samples_1.date DESC, samples_1.name ASC, '
+                                                   'samples_1.id ASC, tubes_1.id DESC')
+    assert qf.explain(q)['sorts'] == [
+        {'path': 'Sample', 'order_by': 'date desc, name', 'index': None},
+        {'path': 'Sample.tubes', 'order_by': 'id desc', 'index': None},
+    ]
+
+    # Sorting unfiltered roots by an indexed column reads them through the index
+    q = '''
+        query Sample order by date desc {
+            name
+        }
+    '''
+    res = qf.parse_query(q)
+    assert [s['id'] for s in res] == [s.id for s in sorted(samples, key=lambda s: (s.date, s.id), reverse=True)]
+    explained = qf.explain(q)
+    assert 'FROM samples AS samples_1 INDEXED BY ix_samples_date' in explained['sql']
+    assert explained['sorts'] == [{'path': 'Sample', 'order_by': 'date desc', 'index': 'ix_samples_date'}]
+    assert not any('TEMP B-TREE' in row['detail'] for row in explained['plan'])
+
+    # Filtered roots are left to the database, which looks them up by primary key here
+    explained = qf.explain('query Sample order by date {\n id [* == $id]\n}', {'id': samples[2].id})
+    assert 'INDEXED BY' not in explained['sql']
+    assert explained['sorts'] == [{'path': 'Sample', 'order_by': 'date', 'index': None}]
+    assert not any(row['detail'].startswith('SCAN') for row in explained['plan'])
+
+
+def test_query_variables_endpoint(session):
+    q = '''
+        query Sample {
+            name [* == $name]
+        }
+    '''
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db)
+
+    sample_1 = Sample(name='variables-endpoint')
+    session.add(sample_1)
+    session.flush()
+
+    res = app.test_client().post('/shoedog', json={'query': q, 'variables': {'name': 'variables-endpoint'}})
+    assert res.status_code == 200
+    assert [s['id'] for s in res.get_json()] == [sample_1.id]
+
+    res = app.test_client().post('/shoedog', json={'variables': {'name': 'variables-endpoint'}})
+    assert res.status_code == 400
+    assert 'error' in res.get_json()
+
+
+def test_endpoint_error_statuses(session):
+    def post(app, body, **kwargs):
+        res = app.test_client().post('/shoedog', json=body, **kwargs)
+        assert res.is_json and 'error' in res.get_json()
+        return res.status_code
+
+    session.add(Sample(name='error-statuses'))
+    session.flush()
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db)
+    q = 'query Sample {\n name [* == $name]\n}'
+    assert post(app, {'query': 'query Sample {\n name [* ==\n}'}) == 400
+    assert post(app, {'query': 'query Nothing {\n id\n}'}) == 400
+    assert post(app, {'query': q, 'variables': {'name': 1}}) == 400
+    assert post(app, {'query': q, 'variables': ['name']}) == 400
+    assert post(app, {'id': 'missing'}) == 400
+    assert post(app, {'id': ['unhashable']}) == 400
+    assert post(app, {'id': ['unhashable']}, query_string={'explain': 1}) == 400
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db, admission=AdmissionController(max_cost=5))
+    assert post(app, {'query': 'query Sample {\n id\n}'}) == 429
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db, admission=AdmissionController(max_cheap=0, max_expensive=0, timeout=0.01))
+    assert post(app, {'query': 'query Sample {\n id\n}'}) == 503
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db, timeout=0)
+    assert post(app, {'query': 'query Sample {\n id\n}'}) == 504
+
+
+def test_batch(session):
+    q = '''
+        query Sample {
+            name [* == $name]
+        }
+    '''
+    sample_1 = Sample(name='batch-1')
+    sample_2 = Sample(name='batch-2')
+    session.add_all([sample_1, sample_2])
+    session.flush()
+
+    app = create_app(__name__, {'TESTING': True})
+    shoedoggify(app, db)
+    res = app.test_client().post('/shoedog/batch', json=[
+        {'query': q, 'variables': {'name': 'batch-2'}},
+        'query Sample {\n name [* == \'batch-1\']\n}',
+        {'query': 'query NotAModel {\n}'},
+        {'query': q, 'variables': {'name': 1}},
+    ])
+    assert res.status_code == 200
+    results = res.get_json()
+    assert [s['id'] for s in results[0]['data']] == [sample_2.id]
+    assert [s['id'] for s in results[1]['data']] == [sample_1.id]
+    assert results[2] == {'error': 'Could not find model with name NotAModel'}
+    assert results[3] == {'error': 'Variable $name must be of type str to filter on name'}
+
+    assert app.test_client().post('/shoedog/batch', json={'query': q}).status_code == 400
+    res = app.test_client().post('/shoedog/batch?max_workers=-1', json=[q])
+    assert res.status_code == 400
+    assert res.get_json() == {'error': 'max_workers must be at least 1'}
+
+
+def test_batch_item_errors(session, monkeypatch):
+    sample = Sample(name='batch-errors')
+    session.add(sample)
+    session.flush()
+    q = "query Sample {\n name [* == 'batch-errors']\n}"
+    execute = QueryFactory._execute
+
+    def failing_execute(self, plan, variables, session=None, timer=None, pinned=False):
+        if variables == {'fail': True}:
+            session.execute('SELECT * FROM missing_table')
+        return execute(self, plan, variables, session, timer, pinned)
+
+    monkeypatch.setattr(QueryFactory, '_execute', failing_execute)
+    results = QueryFactory(db).parse_batch([
+        {'variables': {}},
+        ['not', 'a', 'query'],
+        {'query': q, 'variables': 'not variables'},
+        {'query': 1},
+        {'query': q, 'variables': {'fail': True}},
+        q,
+    ])
+    assert all('error' in r for r in results[:5])
+    assert 'missing_table' in results[4]['error']
+    # The failed query is rolled back to its savepoint, keeping the session's own writes
+    assert [s['id'] for s in results[5]['data']] == [sample.id]
+
+
+def test_batch_max_workers(monkeypatch):
+    workers = []
+    pool = shoedog.query_factory.ThreadPoolExecutor
+
+    def recording_pool(max_workers):
+        workers.append(max_workers)
+        return pool(max_workers=max_workers)
+
+    monkeypatch.setattr(shoedog.query_factory, 'ThreadPoolExecutor', recording_pool)
+    QueryFactory(db, max_batch_workers=2).parse_batch([], max_workers=1000)
+    assert workers == [2]
+
+    for max_workers in (0, -1):
+        with pytest.raises(ValueError):
+            QueryFactory(db).parse_batch([], max_workers=max_workers)
+
+
+def test_batch_concurrent(committed_session):
+    # Concurrent batches run on their own connections, so the data has to be committed
+    samples = [Sample(name=f'batch-concurrent-{i}') for i in range(4)]
+    committed_session.add_all(samples)
+    committed_session.commit()
+
+    results = qf.parse_batch([
+        {'query': 'query Sample {\n name [* == $name]\n}', 'variables': {'name': s.name}}
+        for s in samples
+    ], max_workers=2)
+    assert [[r['id'] for r in res['data']] for res in results] == [[s.id] for s in samples]
+
+
+def test_query_timeout(session):
+    session.add(Sample(name='timeout'))
+    session.flush()
+
+    with pytest.raises(QueryTimeoutException):
+        QueryFactory(db, timeout=0).parse_query('query Sample {\n id\n}')
+    assert len(QueryFactory(db, timeout=5).parse_query('query Sample {\n id\n}')) == 1
@@ -0,0 +1,119 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from tests.mock_app import db, Sample
+import shoedog.query_factory
+from shoedog.query_factory import QueryFactory
+from shoedog.replicas import ReplicaPool, read_only_session
+
+
+@pytest.fixture
+def replicas(tmp_path):
+    """ Two SQLite replicas with the same samples """
+    engines = []
+    for n in range(2):
+        engine = create_engine(f'sqlite:///{tmp_path / f"replica_{n}.db"}')
+        db.Model.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all([Sample(id=i, name=f'replica-{i}') for i in range(1, 4)])
+        session.commit()
+        session.close()
+        engines.append(engine)
+    yield engines
+    for engine in engines:
+        engine.dispose()
+
+
+def _broken_engine(tmp_path):
+    return create_engine(f'sqlite:///{tmp_path / "missing" / "replica.db"}')
+
+
+def test_read_only_session(replicas):
+    with read_only_session(replicas[0]) as session:
+        assert session.query(Sample).count() == 3
+        with pytest.raises(OperationalError):
+            session.execute(Sample.__table__.insert().values(name='write'))
+
+    # The connection is writable again once it is released
+    session = sessionmaker(bind=replicas[0])()
+    session.execute(Sample.__table__.insert().values(name='write'))
+    session.commit()
+    session.close()
+
+
+def test_round_robin(db, replicas):
+    pool = ReplicaPool(replicas)
+    qf = QueryFactory(db, replicas=pool)
+    for _ in range(4):
+        assert [r['name'] for r in qf.parse_query('query Sample {\n id [* < 3]\n}')] == \
+            ['replica-1', 'replica-2']
+    assert [s['reads'] for s in pool.stats()] == [2, 2]
+    assert [s['in_flight'] for s in pool.stats()] == [0, 0]
+
+
+def test_least_busy(replicas):
+    pool = ReplicaPool(replicas, policy='least_busy')
+
+    def nested_read(session):
+        # The first replica is busy, so the nested read goes to the second
+        return pool.read(lambda s: s.get_bind().url)
+
+    assert pool.read(nested_read) == replicas[1].url
+
+
+def test_health_fallback(db, replicas, tmp_path):
+    broken = _broken_engine(tmp_path)
+    pool = ReplicaPool([broken, replicas[0]], retry_after=60)
+    qf = QueryFactory(db, replicas=pool)
+    for _ in range(3):
+        assert len(qf.parse_query('query Sample {\n id\n}')) == 3
+    assert [s['healthy'] for s in pool.stats()] == [False, True]
+    assert [s['reads'] for s in pool.stats()] == [1, 3]
+
+    # Once every replica has failed, reads go to the fallback
+    pool = ReplicaPool([broken], fallback=replicas[1])
+    assert pool.read(lambda session: session.query(Sample).count()) == 3
+    with pytest.raises(OperationalError):
+        ReplicaPool([broken]).read(lambda session: session.query(Sample).count())
+
+
+def test_query_errors_do_not_fail_over(replicas):
+    pool = ReplicaPool(replicas)
+    reads = []
+
+    def bad_query(session):
+        reads.append(session.get_bind())
+        return session.execute('SELECT missing_column FROM samples').fetchall()
+
+    with pytest.raises(OperationalError):
+        pool.read(bad_query)
+    assert len(reads) == 1
+    assert [s['healthy'] for s in pool.stats()] == [True, True]
+
+
+def test_released_before_serialization(db, replicas, monkeypatch):
+    checked_in = []
+    event.listen(replicas[0], 'checkin', lambda *args: checked_in.append(True))
+    serialize_to_json = shoedog.query_factory.serialize_to_json
+
+    def checked_serialize(*args, **kwargs):
+        assert checked_in
+        return serialize_to_json(*args, **kwargs)
+
+    monkeypatch.setattr(shoedog.query_factory, 'serialize_to_json', checked_serialize)
+    qf = QueryFactory(db, replicas=ReplicaPool(replicas[:1]))
+    assert len(qf.parse_query('query Sample {\n id\n}')) == 3
+
+
+def test_batch_reads_from_its_session(session, replicas, request):
+    session.add(Sample(name='batch-pinned'))
+    session.flush()
+    qf = QueryFactory(db, replicas=ReplicaPool(replicas), partitions=2)
+    request.addfinalizer(qf.close)
+    q = "query Sample {\n name [* == 'batch-pinned']\n}"
+
+    # Every query of a batch sees the batch's session, uncommitted writes included
+    assert [len(r['data']) for r in qf.parse_batch([q, q])] == [1, 1]
+    assert qf.parse_query(q) == []
+    assert [s['reads'] for s in qf.replicas.stats()] == [0, 0]
@@ -0,0 +1,96 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tests.mock_app import db, Sample, Tube
+from shoedog.query_factory import QueryFactory
+from shoedog.sharding import ShardKeyRouter, check_mergeable_order, merge_ordered
+
+
+@pytest.fixture
+def shards(tmp_path):
+    """ Three SQLite databases with the app's schema, holding samples named
+    'shard-<n>' with ids interleaved across them """
+    shards = {}
+    for n in range(3):
+        engine = create_engine(f'sqlite:///{tmp_path / f"shard_{n}.db"}')
+        db.Model.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        for i in range(n, 12, 3):
+            session.add(Sample(id=i + 1, name=f'shard-{n}', tubes=[Tube(name=f'tube-{i}')]))
+        session.commit()
+        session.close()
+        shards[f'shard-{n}'] = engine
+    yield shards
+    for engine in shards.values():
+        engine.dispose()
+
+
+def test_all_shards(db, shards, request):
+    qf = QueryFactory(db, shards=shards)
+    request.addfinalizer(qf.close)
+    res = qf.parse_query('query Sample {\n name\n tubes {\n name\n }\n}')
+    assert [r['id'] for r in res] == list(range(1, 13))
+    assert [r['tubes'][0]['name'] for r in res] == [f'tube-{i}' for i in range(12)]
+    assert qf.metrics.snapshot()['stages']['execute']['count'] == 3
+
+    res = qf.parse_query('query Sample {\n id [* > 6]\n}')
+    assert [r['id'] for r in res] == list(range(7, 13))
+
+    res = qf.parse_query('query Sample order by name desc {\n id [* < 8]\n}')
+    assert [r['id'] for r in res] == [6, 3, 5, 2, 7, 4, 1]
+
+    # Ordering related objects does not change the order roots are merged in
+    res = qf.parse_query('query Sample {\n tubes order by name desc limit 1 {\n name\n }\n}')
+    assert [r['id'] for r in res] == list(range(1, 13))
+
+    res = qf.parse_query('query Sample {\n count()\n max(id)\n id [* < 8]\n}')
+    assert res == [{'count': 7, 'max_id': 7}]
+    with pytest.raises(SyntaxError):
+        qf.parse_query('query Sample {\n avg(id)\n}')
+
+
+def test_shard_key_routing(db, shards, request):
+    router = ShardKeyRouter({Sample: 'name'}, lambda model, value: value)
+    qf = QueryFactory(db, shards=shards, shard_router=router)
+    request.addfinalizer(qf.close)
+
+    res = qf.parse_query('query Sample {\n name [* == \'shard-1\']\n}')
+    assert [r['id'] for r in res] == [2, 5, 8, 11]
+    assert qf.metrics.snapshot()['stages']['execute']['count'] == 1
+
+    res = qf.parse_query('query Sample {\n name [* in $names]\n}', {'names': ['shard-0', 'shard-2']})
+    assert [r['id'] for r in res] == [1, 3, 4, 6, 7, 9, 10, 12]
+    assert qf.metrics.snapshot()['stages']['execute']['count'] == 3
+
+    # Filters that do not pin the shard key go to every shard
+    assert router.route(qf._plan('query Sample {\n name [* != \'shard-1\']\n}').ast, {}, shards) == \
+        list(shards)
+    assert router.route(qf._plan('query Tube {\n name [* == \'shard-1\']\n}').ast, {}, shards) == \
+        list(shards)
+    assert router.route(qf._plan(
+        'query Sample {\n name [* == \'shard-1\' or * == \'shard-2\']\n id [* > 1]\n}').ast, {}, shards) == \
+        ['shard-1', 'shard-2']
+
+
+def test_merge_ordered_dialects():
+    responses = [[{'id': 1, 'date': None}, {'id': 3, 'date': '2018-01-02'}], [{'id': 2, 'date': '2018-01-01'}]]
+    # Nulls come first ascending on SQLite, and last on PostgreSQL
+    assert [r['id'] for r in merge_ordered(responses, [('date', False)], 'sqlite')] == [1, 2, 3]
+    responses[0].reverse()
+    assert [r['id'] for r in merge_ordered(responses, [('date', False)], 'postgresql')] == [2, 3, 1]
+
+    check_mergeable_order(Sample, [('name', False)], 'sqlite')
+    check_mergeable_order(Sample, [('date', True), ('id', True)], 'postgresql')
+    with pytest.raises(SyntaxError):
+        check_mergeable_order(Sample, [('date', False), ('name', False)], 'postgresql')
+
+
+def test_batch_reads_from_shards(db, session, shards, request):
+    qf = QueryFactory(db, shards=shards)
+    request.addfinalizer(qf.close)
+    session.add(Sample(name='shard-0'))
+    session.flush()
+
+    # Sharded queries in a batch read from the shards, not from the batch's session
+    results = qf.parse_batch(["query Sample {\n name [* == 'shard-0']\n}"])
+    assert [r['id'] for r in results[0]['data']] == [1, 4, 7, 10]
@@ -0,0 +1,107 @@
+import time
+from threading import Event, Thread
+from shoedog.query_factory import QueryFactory
+from shoedog.singleflight import SingleFlight
+from tests.mock_app import db, Sample
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out waiting for condition'
+        time.sleep(0.001)
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    sf = SingleFlight()
+    release = Event()
+    calls = []
+    results = []
+
+    def fn():
+        calls.append(1)
+        release.wait()
+        return 'result'
+
+    threads = [Thread(target=lambda: results.append(sf.do('key', fn))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    _wait_for(lambda: sf.saved == 4)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ['result'] * 5
+    assert sf.metrics == {'executions': 1, 'saved': 4, 'in_flight': 0}
+
+    # Once the call has finished, the next call executes again
+    assert sf.do('key', lambda: 'new result') == 'new result'
+    assert sf.executions == 2
+
+
+def test_single_flight_shares_errors():
+    sf = SingleFlight()
+    release = Event()
+    errors = []
+
+    def fn():
+        release.wait()
+        raise SyntaxError('bad query')
+
+    def call():
+        try:
+            sf.do('key', fn)
+        except SyntaxError as e:
+            errors.append(str(e))
+
+    threads = [Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    _wait_for(lambda: sf.saved == 2)
+    release.set()
+    for t in threads:
+        t.join()
+    assert errors == ['bad query'] * 3
+
+
+def test_query_factory_coalesce(committed_session):
+    sample = Sample(name='coalesced')
+    committed_session.add(sample)
+    committed_session.commit()
+
+    qf = QueryFactory(db, coalesce=True)
+    release = Event()
+    evaluate = qf._evaluate
+
+    def blocking_evaluate(*args, **kwargs):
+        release.wait()
+        return evaluate(*args, **kwargs)
+
+    qf._evaluate = blocking_evaluate
+    executor = qf.executor(max_workers=4)
+    try:
+        q = 'query Sample {\n name [* == $name]\n}'
+        futures = [executor.submit(q, {'name': 'coalesced'}) for _ in range(4)]
+        _wait_for(lambda: qf.single_flight.saved == 3)
+        release.set()
+        assert [[s['id'] for s in f.result()] for f in futures] == [[sample.id]] * 4
+        assert qf.single_flight.executions == 1
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_query_factory_coalesce_skips_uncommitted_writes(session):
+    qf = QueryFactory(db, coalesce=True)
+    q = 'query Sample {\n name [* == \'uncommitted\']\n}'
+
+    # Writes in a savepoint are still uncommitted once it is released
+    with session.begin_nested():
+        session.add(Sample(name='uncommitted'))
+    assert len(qf.parse_query(q)) == 1
+    assert qf.single_flight.executions == 0
+
+    session.commit()
+    assert len(qf.parse_query(q)) == 1
+    assert qf.single_flight.executions == 1
@@ -0,0 +1,74 @@
+from shoedog.query_factory import QueryFactory
+from shoedog.slowlog import SlowQueryLog, ast_stats
+from tests.mock_app import db, Sample, Tube
+
+q = '''
+    query Sample {
+        name [* == '%s']
+        tube {
+            name
+        }
+        tubes {
+            type [any == 'a' or all != 'b']
+        }
+    }
+'''
+
+
+def test_ast_stats():
+    qf = QueryFactory(db)
+    assert ast_stats(qf._cached_plan(q % 'x').ast) == (2, 2)
+
+
+def test_ast_stats_filter_only_and_shared_joins():
+    qf = QueryFactory(db)
+    assert ast_stats(qf._cached_plan('''query Sample {
+        tubes {
+            name
+        }
+        tubes {
+            type [any == 'a']
+        }
+        filter tubes {
+            filter self_tube {
+                type [* == 'a']
+            }
+        }
+    }''').ast) == (1, 3)
+
+
+def test_slow_query_log(session):
+    session.add(Sample(name='slow', tube=Tube(), tubes=[Tube(type='a')]))
+    session.flush()
+
+    sunk = []
+    slow_query_log = SlowQueryLog(threshold=0, capacity=2, sink=sunk.append)
+    qf = QueryFactory(db, slow_query_log=slow_query_log)
+    for name in ('slow', 'not slow', 'also not slow'):
+        qf.parse_query(q % name)
+
+    records = slow_query_log.records()
+    assert len(records) == 2
+    assert sunk[1:] == records
+    record = records[-1]
+    assert (record.rows, record.joins, record.exists_subqueries) == (0, 2, 2)
+    assert sunk[0].rows == 1
+    assert 'JOIN tubes' in record.sql and 'EXISTS' in record.sql
+    assert {'execute', 'hydrate', 'serialize'} <= set(record.timings)
+    assert record.duration == sum(record.timings.values())
+
+    # Queries that only differ in their literals share a fingerprint
+    assert len({r.fingerprint for r in sunk}) == 1
+    [top] = slow_query_log.top_fingerprints()
+    assert top['count'] == 3
+    assert top['total_time'] == sum(r.duration for r in sunk)
+    assert top['sql'] == record.sql
+
+
+def test_slow_query_log_threshold(session):
+    slow_query_log = SlowQueryLog(threshold=60)
+    qf = QueryFactory(db, slow_query_log=slow_query_log)
+    qf.parse_query(q % 'fast')
+    assert slow_query_log.records() == []
+    assert slow_query_log.top_fingerprints()[0]['count'] == 1
+    assert 'sql' not in slow_query_log.top_fingerprints()[0]
@@ -0,0 +1,72 @@
+import pytest
+from threading import Thread
+from sqlalchemy.exc import DBAPIError
+from shoedog.errors import TooManyStatementsException
+from shoedog.query_factory import QueryFactory
+from shoedog.statements import count_statements
+from tests.mock_app import db, Sample, Tube
+
+q = '''
+    query Sample {
+        id
+        tubes {
+            type [any == 'a']
+            self_tube {
+            }
+        }
+    }
+'''
+
+
+def test_query_is_a_single_statement(session):
+    session.add(Sample(tubes=[Tube(type='a', self_tube=Tube())]))
+    session.flush()
+    session.expire_all()
+
+    qf = QueryFactory(db, max_statements=1)
+    with count_statements() as counter:
+        assert len(qf.parse_query(q)) == 1
+    assert counter.count == 1
+    assert counter.statements[0][0].startswith('SELECT')
+    assert counter.total_time == counter.statements[0][1]
+    assert qf.metrics.snapshot()['values']['statements']['sum'] == 1
+
+
+def test_count_statements_strict(session):
+    sample = Sample(tubes=[Tube(type='a')])
+    session.add(sample)
+    session.flush()
+    session.expire_all()
+
+    with pytest.raises(TooManyStatementsException) as e:
+        with count_statements(max_statements=1):
+            # Refreshing the expired sample and lazy loading its tubes are two statements
+            assert len(sample.tubes) == 1
+    assert str(e.value).startswith('Expected at most 1 statements but 2 were emitted')
+
+
+def test_count_statements_is_per_thread(session):
+    engine = db.engine
+    counts = []
+
+    def run():
+        with count_statements() as thread_counter:
+            engine.execute('SELECT 1')
+        counts.append(thread_counter.count)
+
+    with count_statements() as counter:
+        t = Thread(target=run)
+        t.start()
+        t.join()
+    assert counts == [1]
+    assert counter.count == 0
+
+
+def test_count_statements_failed_statement(session):
+    conn = session.connection()
+    with count_statements() as counter:
+        with pytest.raises(DBAPIError):
+            conn.execute('SELECT * FROM missing_table')
+        conn.execute('SELECT 1')
+    assert counter.count == 1
+    assert not conn.info.get('shoedog_statement_start')
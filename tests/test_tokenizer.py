@@ -1,5 +1,5 @@
 import pytest
-from shoedog.tokenizer import Toks, tokenize
+from shoedog.tokenizer import Toks, Variable, tokenize
 
 
 def test_basic_tokenizer_no_fields():
@@ -166,6 +166,24 @@ def test_tokenizer_filters7():
     )
 
 
+def test_tokenizer_filter_variables():
+    query = '''
+       query Sample {
+         field1 [* > $min_value and * in $values]
+       }
+    '''
+    assert tuple(tokenize(query)) == (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.AttributeToken(attribute_name='field1'),
+        Toks.FilterStartToken(),
+        Toks.FilterBoolToken(sel='*', op='>', val=Variable(name='min_value')),
+        Toks.FilterBinaryLogicToken(logic_op='and'),
+        Toks.FilterBoolToken(sel='*', op='in', val=Variable(name='values')),
+        Toks.FilterEndToken(),
+        Toks.CloseObjectToken(),
+    )
+
+
 def test_tokenizer_subobject_filters1():
     query = '''
        query Sample {
@@ -217,6 +235,111 @@ def test_tokenizer_subobject_filters2():
     )
 
 
+def test_tokenizer_order_by_limit():
+    query = '''
+       query Sample {
+         tubes order by date desc, name limit 5 {
+           name
+         }
+         tubes order by name asc {
+           name
+         }
+       }
+    '''
+    assert tuple(tokenize(query)) == (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.OrderByToken(order_by=(('date', True), ('name', False))),
+        Toks.LimitToken(limit=5),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.CloseObjectToken(),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.OrderByToken(order_by=(('name', False),)),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.CloseObjectToken(),
+        Toks.CloseObjectToken(),
+    )
+
+    assert tuple(tokenize('query Sample order by date desc, id {\n name\n}')) == (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.OrderByToken(order_by=(('date', True), ('id', False))),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.CloseObjectToken(),
+    )
+
+    with pytest.raises(SyntaxError) as e:
+        tuple(tokenize('query Sample {\n tubes limit 0 {\n name\n }\n}'))
+    assert str(e.value) == 'line 2: limit must be at least 1'
+
+    with pytest.raises(SyntaxError) as e:
+        tuple(tokenize('query Sample {\n tubes order by name, name desc {\n name\n }\n}'))
+    assert str(e.value) == 'Attributes are repeated in order by name, name desc'
+
+
+def test_tokenizer_aggregates():
+    query = '''
+       query Sample {
+         count()
+         tubes {
+           max(date)
+           type [* == 'c']
+         }
+       }
+    '''
+    assert tuple(tokenize(query)) == (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.AggregateToken(func='count', attribute_name=''),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.AggregateToken(func='max', attribute_name='date'),
+        Toks.AttributeToken(attribute_name='type'),
+        Toks.FilterStartToken(),
+        Toks.FilterBoolToken(sel='*', op='==', val='c'),
+        Toks.FilterEndToken(),
+        Toks.CloseObjectToken(),
+        Toks.CloseObjectToken(),
+    )
+
+    with pytest.raises(SyntaxError):
+        tuple(tokenize('query Sample {\n median(date)\n}'))
+
+
+def test_tokenizer_filter_only():
+    query = '''
+       query Sample {
+         filter tubes {
+           type [* == 'c']
+         }
+         tube {
+           filter name [* == 'a']
+         }
+         filter [* == 1]
+       }
+    '''
+    assert tuple(tokenize(query)) == (
+        Toks.RootQueryToken(query_model='Sample'),
+        Toks.OpenObjectToken(rel='tubes'),
+        Toks.FilterOnlyToken(),
+        Toks.AttributeToken(attribute_name='type'),
+        Toks.FilterStartToken(),
+        Toks.FilterBoolToken(sel='*', op='==', val='c'),
+        Toks.FilterEndToken(),
+        Toks.CloseObjectToken(),
+        Toks.OpenObjectToken(rel='tube'),
+        Toks.AttributeToken(attribute_name='name'),
+        Toks.FilterOnlyToken(),
+        Toks.FilterStartToken(),
+        Toks.FilterBoolToken(sel='*', op='==', val='a'),
+        Toks.FilterEndToken(),
+        Toks.CloseObjectToken(),
+        # An attribute named filter
+        Toks.AttributeToken(attribute_name='filter'),
+        Toks.FilterStartToken(),
+        Toks.FilterBoolToken(sel='*', op='==', val=1),
+        Toks.FilterEndToken(),
+        Toks.CloseObjectToken(),
+    )
+
+
 def test_tokenizer_parser_test_1():
     query = '''
         query Sample {